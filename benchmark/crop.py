@@ -0,0 +1,33 @@
+"""Per-box extract_face loop against the batched extract_faces, on frames with many faces.
+
+    python -m benchmark.crop
+"""
+import timeit
+
+import numpy as np
+
+from handler.kv_media_handler import box_array, extract_face, extract_faces
+
+
+def random_boxes(count, rng):
+    # faces spread over the frame, some crossing its borders once grown
+    size = rng.uniform(0.03, 0.3, (count, 2))
+    corner = rng.uniform(-0.05, 1.0, (count, 2))
+    return [{"Left": l, "Top": t, "Width": w, "Height": h} for (l, t), (w, h) in zip(corner, size)]
+
+
+def main(repeat=200):
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 255, (1080, 1920, 3), dtype=np.uint8)
+    print(f"{'faces':>6} {'loop us':>10} {'batch us':>10} {'batch+thumb us':>15}")
+    for count in (1, 10, 50, 200):
+        boxes = random_boxes(count, rng)
+        loop = timeit.timeit(lambda: [extract_face(frame, b, box_ratio=2) for b in boxes], number=repeat)
+        batch = timeit.timeit(lambda: extract_faces(frame, box_array(boxes), box_ratio=2), number=repeat)
+        thumbs = timeit.timeit(lambda: extract_faces(frame, box_array(boxes), box_ratio=2, size=(160, 160)),
+                               number=max(1, repeat // 10)) * 10
+        print(f"{count:>6} {loop / repeat * 1e6:>10.1f} {batch / repeat * 1e6:>10.1f} {thumbs / repeat * 1e6:>15.1f}")
+
+
+if __name__ == "__main__":
+    main()
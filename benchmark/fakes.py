@@ -0,0 +1,221 @@
+"""In-process stand-ins for the AWS services of the Lambda, plus synthetic video and Kinesis batches.
+
+The clients only answer the calls the handlers make. Every call sleeps for the latency set
+for its service, so a run can mimic a region without an AWS account.
+"""
+import base64
+import io
+import json
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+from handler import mkv
+
+STREAM_ARN = "arn:aws:kinesisvideo:us-east-1:000000000000:stream/benchmark-camera/1"
+# sequence number of the first record of an event
+SEQUENCE = 49605974038509424079760656864102544007131587071340642306
+
+
+def exp_golomb(value):
+    code = format(value + 1, "b")
+    return "0" * (len(code) - 1) + code
+
+
+def h264_sps(mb_width, mb_height):
+    # baseline profile, POC type 0, one reference frame, frame only, no cropping and no VUI
+    bits = "11111" + "0" + exp_golomb(mb_width - 1) + exp_golomb(mb_height - 1) + "1000" + "1"
+    bits += "0" * (-len(bits) % 8)
+    return bytes([0x67, 0x42, 0x00, 0x1e]) + int(bits, 2).to_bytes(len(bits) // 8, "big")
+
+
+def h264_frame(mb_width, mb_height, rng):
+    """An IDR slice of uncompressed I_PCM macroblocks holding random samples, sharp enough for the quality gate."""
+    slice_data = bytearray(bytes.fromhex("05888421a0"))
+    for i in range(mb_width * mb_height):
+        if i > 0:
+            slice_data += bytes.fromhex("0d00")
+        slice_data += rng.randbytes(256) + bytes([128]) * 128
+    slice_data += b"\x80"
+    return bytes(slice_data)
+
+
+def mkv_fragment(width=640, height=480, frames=20, fps=10, seed=0):
+    """One GetMedia fragment: an H.264 Matroska document with a keyframe every frame."""
+    rng = random.Random(seed)
+    mb_width, mb_height = width // 16, height // 16
+    sps = h264_sps(mb_width, mb_height)
+    pps = bytes.fromhex("68ce3880")
+    avcc = bytes([1, 0x42, 0x00, 0x1e, 0xff, 0xe1]) + len(sps).to_bytes(2, "big") + sps + \
+        bytes([1]) + len(pps).to_bytes(2, "big") + pps
+    header = mkv.element(mkv.EBML, mkv.element(0x4282, b"matroska") + mkv.uint_element(0x4287, 2))
+    info = mkv.element(mkv.INFO, mkv.uint_element(mkv.TIMECODE_SCALE, 1000000))
+    video = mkv.element(0xE0, mkv.uint_element(0xB0, mb_width * 16) + mkv.uint_element(0xBA, mb_height * 16))
+    track = mkv.element(mkv.TRACK_ENTRY, mkv.uint_element(mkv.TRACK_NUMBER, 1) + mkv.uint_element(0x73C5, 1) +
+                        mkv.uint_element(mkv.TRACK_TYPE, 1) + mkv.element(0x86, b"V_MPEG4/ISO/AVC") +
+                        mkv.element(0x63A2, avcc) + video)
+    # a few distinct pictures are enough, the decoder does the same work for each
+    pictures = [h264_frame(mb_width, mb_height, rng) for _ in range(min(frames, 4))]
+    blocks = mkv.uint_element(mkv.TIMECODE, 0)
+    for i in range(frames):
+        nal = pictures[i % len(pictures)]
+        relative = i * 1000 // fps
+        blocks += mkv.element(mkv.SIMPLE_BLOCK, bytes([0x81]) + relative.to_bytes(2, "big") + bytes([0x80]) +
+                              len(nal).to_bytes(4, "big") + nal)
+    return header + mkv.element(mkv.SEGMENT, info + mkv.element(mkv.TRACKS, track) + mkv.element(mkv.CLUSTER, blocks))
+
+
+def kinesis_event(records, faces, fragments=1, matched=0.8, people=20, duration=2.0, seed=0, start=1586930696.336):
+    """A Lambda batch of stream processor records, `faces` faces per frame spread over `fragments` fragments.
+
+    A `matched` share of the faces comes with a FaceId out of `people` known ones, the rest have to be indexed.
+    """
+    rng = random.Random(seed)
+    columns = max(1, int(faces ** 0.5 + 0.999))
+    kinesis_records = []
+    for r in range(records):
+        fragment = r * fragments // records
+        face_search_responses = []
+        for f in range(faces):
+            # a grid of faces, each inside the frame once grown by the crop ratio
+            size = 0.5 / columns
+            box = {"Width": size * 0.8, "Height": size * 0.8,
+                   "Left": 0.25 + (f % columns) * size, "Top": 0.25 + (f // columns) * size}
+            matched_faces = []
+            if rng.random() < matched:
+                matched_faces.append({"Similarity": 99.0,
+                                      "Face": {"FaceId": "face-%d" % rng.randrange(people), "BoundingBox": box}})
+            face_search_responses.append({"DetectedFace": {"BoundingBox": box, "Confidence": 99.9},
+                                          "MatchedFaces": matched_faces})
+        record = {
+            "InputInformation": {"KinesisVideo": {
+                "StreamArn": STREAM_ARN,
+                "FragmentNumber": str(91343852333181670082121365578051976898440285580 + seed * 1000 + fragment),
+                "ServerTimestamp": start + fragment * duration + 1,
+                "ProducerTimestamp": start + fragment * duration,
+                "FrameOffsetInSeconds": rng.uniform(0, duration - 0.1),
+            }},
+            "StreamProcessorInformation": {"Status": "RUNNING"},
+            "FaceSearchResponse": face_search_responses,
+        }
+        data = base64.b64encode(json.dumps(record).encode()).decode()
+        kinesis_records.append({"kinesis": {"data": data, "partitionKey": str(r), "sequenceNumber": str(SEQUENCE + r)},
+                                "eventSource": "aws:kinesis"})
+    return {"Records": kinesis_records}
+
+
+class StreamingBody:
+    """Only read and close, like the GetMedia payload."""
+
+    def __init__(self, data):
+        self.stream = io.BytesIO(data)
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+    def close(self):
+        self.stream.close()
+
+
+class FakeClient:
+    """One boto3 client of any service, answering the calls of the handlers after the injected latency."""
+
+    def __init__(self, service, latency=0.0, fragment=None):
+        self.service = service
+        self.latency = latency
+        self.fragment = fragment
+        self.lock = threading.Lock()
+        self.faces = 0
+        self.objects = {}
+        self.items = {}
+
+    def wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    # Kinesis Video Streams
+    def get_data_endpoint(self, **kwargs):
+        self.wait()
+        return {"DataEndpoint": "https://media.benchmark.local"}
+
+    def get_media(self, **kwargs):
+        self.wait()
+        return {"ContentType": "video/webm", "Payload": StreamingBody(self.fragment)}
+
+    # Rekognition
+    def index_faces(self, **kwargs):
+        self.wait()
+        with self.lock:
+            self.faces += 1
+            face_id = "indexed-%d" % self.faces
+        return {"FaceRecords": [{"Face": {"FaceId": face_id,
+                                          "BoundingBox": {"Top": 0.1, "Left": 0.1, "Height": 0.8, "Width": 0.8}}}]}
+
+    def search_faces_by_image(self, **kwargs):
+        self.wait()
+        return {"FaceMatches": []}
+
+    # S3
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.wait()
+        with self.lock:
+            self.objects[Key] = len(Body)
+
+    def head_object(self, Bucket, Key):
+        self.wait()
+        with self.lock:
+            if Key not in self.objects:
+                raise ClientError({"Error": {"Code": "404", "Message": "Not Found"}}, "HeadObject")
+            return {"ContentLength": self.objects[Key]}
+
+    # DynamoDB, writes are counted rather than stored
+    def put_item(self, TableName, Item, **kwargs):
+        self.wait()
+        with self.lock:
+            self.items[len(self.items)] = Item
+
+    def update_item(self, **kwargs):
+        self.wait()
+        with self.lock:
+            self.items[len(self.items)] = kwargs["Key"]
+
+    def transact_write_items(self, TransactItems):
+        self.wait()
+        with self.lock:
+            for item in TransactItems:
+                self.items[len(self.items)] = item["Update"]["Key"]
+
+    def batch_write_item(self, RequestItems):
+        self.wait()
+        with self.lock:
+            for requests in RequestItems.values():
+                for request in requests:
+                    self.items[len(self.items)] = request["PutRequest"]["Item"]
+        return {"UnprocessedItems": {}}
+
+
+class FakeAWS:
+    """Builds the fake clients in place of boto3.client, e.g. mock.patch("boto3.client", FakeAWS(...).client)."""
+
+    # the data plane of Kinesis Video Streams is its own client
+    SERVICES = {"kinesis-video-media": "kinesisvideo"}
+
+    def __init__(self, latency=None, fragment=None):
+        # seconds per call, keyed by service: kinesisvideo, rekognition, s3, dynamodb
+        self.latency = latency or {}
+        self.fragment = fragment if fragment is not None else mkv_fragment()
+        self.clients = []
+
+    def client(self, service, **kwargs):
+        latency = self.latency.get(self.SERVICES.get(service, service), 0.0)
+        client = FakeClient(service, latency, self.fragment)
+        self.clients.append(client)
+        return client
+
+    def uploaded(self):
+        return sum(len(c.objects) for c in self.clients)
+
+    def written(self):
+        return sum(len(c.items) for c in self.clients)
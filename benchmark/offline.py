@@ -0,0 +1,198 @@
+"""Throughput and per-stage latency of the record-to-archive path against in-process fakes of AWS.
+
+    python -m benchmark.offline --records 50 --faces 4 --latency rekognition=80 --latency s3=20 \
+        --output results.json [--compare previous.json] [--allocations]
+
+Latencies are in milliseconds per call. Nothing leaves the machine.
+"""
+import argparse
+import contextlib
+import io
+import json
+import platform
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from unittest import mock
+
+from benchmark.fakes import STREAM_ARN, FakeAWS, kinesis_event, mkv_fragment
+
+
+def percentile(values, q):
+    # nearest rank, good enough to compare runs
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+
+def summary(values):
+    return {"count": len(values), "p50": percentile(values, 50), "p99": percentile(values, 99),
+            "mean": sum(values) / len(values) if values else None}
+
+
+def run_lambda(args, aws):
+    import lambda_function
+    from handler import kv_media_handler, registry, throttle
+
+    registry.reset()
+    throttle.reset()
+    kv_media_handler.reset_endpoints()
+    kv_media_handler.fragment_cache.clear()
+    stages = {}
+    counters = {}
+    invocations = []
+    peaks = []
+    records = 0
+    with mock.patch("boto3.client", aws.client), mock.patch.object(lambda_function, "MIN_INTERVAL", args.min_interval), \
+            mock.patch.object(throttle, "ENABLED", args.rate_limits):
+        for i in range(args.invocations):
+            # new fragments every time, the fragment cache only helps within a batch
+            event = kinesis_event(args.records, args.faces, args.fragments, matched=args.matched, seed=i)
+            if args.allocations:
+                tracemalloc.start()
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                lambda_function.lambda_handler(event, None)
+            invocations.append((time.perf_counter() - start) * 1000)
+            if args.allocations:
+                peaks.append(tracemalloc.get_traced_memory()[1] / 1024)
+                tracemalloc.stop()
+            records += args.records
+            for name, value in lambda_function.metrics.snapshot().items():
+                if isinstance(value, list):
+                    stages.setdefault(name, []).extend(value)
+                else:
+                    counters[name] = counters.get(name, 0) + value
+
+    # the first call pays for the clients and the imports, it is reported on its own
+    warm = invocations[1:] or invocations
+    result = {
+        "records_per_second": records / (sum(invocations) / 1000),
+        "first_invocation_ms": invocations[0],
+        "invocation_ms": summary(warm),
+        "stages_ms": {name: summary(values) for name, values in sorted(stages.items())
+                      if name not in ("Invocation", "FacesPerFrame")},
+        "counters": counters,
+        "s3_objects": aws.uploaded(),
+        "dynamodb_writes": aws.written(),
+    }
+    if peaks:
+        result["peak_memory_kb"] = summary(peaks)
+    return result
+
+
+def timed(repeat, function):
+    values = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        values.append((time.perf_counter() - start) * 1000)
+    return summary(values)
+
+
+def run_handlers(args, aws):
+    import lambda_function
+    from handler import kv_media_handler, throttle
+    from handler.dynamo_handler import DynamoHandler
+    from handler.kv_media_handler import KVMediaHandler, encode_image
+    from handler.quality import QualityGate
+    from handler.reko_handler import RekoHanlder
+    from handler.s3_handler import S3Handler
+
+    repeat = args.repeat
+    with mock.patch("boto3.client", aws.client), mock.patch.object(throttle, "ENABLED", args.rate_limits):
+        media = KVMediaHandler(STREAM_ARN)
+        reko = RekoHanlder("Faces", "FaceDetect")
+        s3 = S3Handler("visitor-images")
+        dynamo = DynamoHandler("visitors")
+        gate = QualityGate(*lambda_function.QUALITY)
+
+        def fetch():
+            kv_media_handler.fragment_cache.clear()
+            return media.get_images_from_fragment("1", 1586930696.336, [0.5, 1.5])
+
+        frame = fetch()[0]
+        record = lambda_function.decode_base64_and_load_json(
+            kinesis_event(1, args.faces)["Records"][0]["kinesis"]["data"])
+        crops = [c for c in lambda_function.crop_faces(record, frame) if c is not None]
+        face = crops[0]
+        face_bytes = encode_image(face)
+
+        def write_photos():
+            for i in range(args.faces):
+                dynamo.buffer_image("face-%d" % i, s3.bucket_name, "key-%d.jpg" % i, 1586930696336 + i)
+            dynamo.flush()
+
+        return {
+            "KVMediaHandler.get_images_from_fragment": timed(max(1, repeat // 10), fetch),
+            "crop_faces": timed(repeat, lambda: lambda_function.crop_faces(record, frame)),
+            "QualityGate.accept": timed(repeat, lambda: gate.accept(face, face.shape[0])),
+            "encode_image": timed(repeat, lambda: encode_image(face)),
+            "RekoHanlder.index_faces": timed(repeat, lambda: reko.index_faces(image_bytes=face_bytes, max_faces=1)),
+            "S3Handler.upload_bytes": timed(repeat, lambda: s3.upload_bytes(face_bytes, "face.jpg")),
+            "DynamoHandler.flush": timed(repeat, write_photos),
+        }
+
+
+def compare(current, previous):
+    # p50 of every stage and handler, old against new
+    rows = [("records/s", previous["lambda"]["records_per_second"], current["lambda"]["records_per_second"])]
+    for section, key in (("lambda", "stages_ms"), (None, "handlers")):
+        old = previous[section][key] if section else previous[key]
+        new = current[section][key] if section else current[key]
+        for name in sorted(set(old) & set(new)):
+            rows.append((name + " p50 ms", old[name]["p50"], new[name]["p50"]))
+    print(f"{'':>45} {'before':>10} {'after':>10} {'change':>8}")
+    for name, before, after in rows:
+        change = (after - before) / before * 100 if before else 0.0
+        print(f"{name:>45} {before:>10.2f} {after:>10.2f} {change:>+7.1f}%")
+
+
+def parse_latency(values):
+    latency = {}
+    for value in values:
+        service, milliseconds = value.split("=")
+        latency[service] = float(milliseconds) / 1000
+    return latency
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--records", type=int, default=50, help="records per batch")
+    parser.add_argument("--faces", type=int, default=4, help="faces per frame")
+    parser.add_argument("--fragments", type=int, default=5, help="fragments the records of a batch fall in")
+    parser.add_argument("--matched", type=float, default=0.8, help="share of faces already matched")
+    parser.add_argument("--invocations", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=200, help="calls per handler")
+    parser.add_argument("--min-interval", type=float, default=0, help="MIN_INTERVAL of the Lambda")
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("--height", type=int, default=480)
+    parser.add_argument("--latency", action="append", default=[], metavar="SERVICE=MS",
+                        help="kinesisvideo, rekognition, s3 or dynamodb")
+    parser.add_argument("--allocations", action="store_true", help="trace the peak memory of every invocation")
+    parser.add_argument("--rate-limits", action="store_true",
+                        help="keep the client side rate limits of handler/throttle.py, off to measure the code alone")
+    parser.add_argument("--output", help="JSON file the results are written to")
+    parser.add_argument("--compare", help="JSON file of an earlier run")
+    args = parser.parse_args()
+
+    aws = FakeAWS(parse_latency(args.latency), mkv_fragment(args.width, args.height))
+    results = {
+        "date": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        "lambda": run_lambda(args, aws),
+        "handlers": run_handlers(args, aws),
+    }
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    if args.compare:
+        with open(args.compare) as file:
+            compare(results, json.load(file))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+"""Captures face-stream records and replays them into the Lambda at a chosen speed.
+
+    python -m benchmark.replay capture --event event.json records.jsonl.gz
+    python -m benchmark.replay capture --stream face-stream records.jsonl.gz
+    python -m benchmark.replay capture --synthetic 600 --faces 2 records.jsonl.gz
+    python -m benchmark.replay replay records.jsonl.gz --speed 10 --parallel 4 --latency rekognition=80
+
+A capture is gzipped JSON lines of [arrival time, decoded record]. Replay feeds the records to the
+handler on their original schedule divided by --speed, in batches like the Kinesis event source,
+against the fakes of benchmark/fakes.py unless --aws is given. Parallel batches share the process,
+so the metrics printed by the Lambda are mixed; the report here is what counts.
+"""
+import argparse
+import base64
+import collections
+import contextlib
+import gzip
+import importlib
+import io
+import json
+import sys
+import threading
+import time
+from unittest import mock
+
+from benchmark.fakes import SEQUENCE, FakeAWS, kinesis_event
+from benchmark.offline import parse_latency, summary
+
+
+def write_capture(path, entries):
+    with gzip.open(path, "wt") as file:
+        for arrival, record in entries:
+            file.write(json.dumps([arrival, record], separators=(",", ":")) + "\n")
+
+
+def read_capture(path):
+    with gzip.open(path, "rt") as file:
+        entries = [json.loads(line) for line in file if line.strip()]
+    return sorted(entries, key=lambda entry: entry[0])
+
+
+def decode(data):
+    return json.loads(base64.b64decode(data).decode("utf8"))
+
+
+def arrival_time(record):
+    kinesis_video = record["InputInformation"]["KinesisVideo"]
+    return kinesis_video.get("ServerTimestamp", kinesis_video["ProducerTimestamp"])
+
+
+def capture_event(path):
+    # a Lambda event, like the fixture of test.py
+    with open(path) as file:
+        event = json.load(file)
+    for record in event["Records"]:
+        face_recognition_record = decode(record["kinesis"]["data"])
+        arrival = record["kinesis"].get("approximateArrivalTimestamp") or arrival_time(face_recognition_record)
+        yield arrival, face_recognition_record
+
+
+def capture_stream(name, limit):
+    from handler.kinesis_handler import KDSHandler
+
+    kds_handler = KDSHandler(name)
+    count = 0
+    for shard_id in kds_handler.list_shards():
+        for record in kds_handler.read_records(shard_id):
+            yield record["ApproximateArrivalTimestamp"].timestamp(), json.loads(record["Data"])
+            count += 1
+            if count >= limit:
+                return
+
+
+def capture_synthetic(records, faces, fps):
+    # one record per frame with faces, at the rate of the stream processor
+    event = kinesis_event(records, faces, fragments=max(1, int(records / fps / 2)))
+    for i, record in enumerate(event["Records"]):
+        yield 1586930696.336 + i / fps, decode(record["kinesis"]["data"])
+
+
+class Replayer:
+    """Releases the records on their schedule and hands them out in batches to `parallel` workers."""
+
+    def __init__(self, handler, speed=1.0, parallel=1, batch_size=100, batch_window=1.0, sample_every=0.5):
+        self.handler = handler
+        self.speed = speed
+        self.parallel = parallel
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.sample_every = sample_every
+        self.backlog = collections.deque()
+        self.condition = threading.Condition()
+        self.done = False
+        self.processed = 0
+        self.failed = 0
+        self.delays = []
+        self.batches = []
+        self.samples = []
+
+    def produce(self, entries, start):
+        first = entries[0][0]
+        for i, (arrival, record) in enumerate(entries):
+            delay = start + (arrival - first) / self.speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            data = base64.b64encode(json.dumps(record).encode()).decode()
+            # the handler reports failed records and counts their attempts by sequence number
+            kinesis_record = {"kinesis": {"data": data, "approximateArrivalTimestamp": arrival,
+                                          "sequenceNumber": str(SEQUENCE + i)}}
+            with self.condition:
+                self.backlog.append((time.perf_counter(), kinesis_record))
+                self.condition.notify()
+        with self.condition:
+            self.done = True
+            self.condition.notify_all()
+
+    def next_batch(self):
+        with self.condition:
+            while not self.backlog and not self.done:
+                self.condition.wait()
+            # like the event source mapping, wait for a full batch up to the batching window
+            deadline = time.perf_counter() + self.batch_window
+            while len(self.backlog) < self.batch_size and not self.done:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            batch = [self.backlog.popleft() for _ in range(min(self.batch_size, len(self.backlog)))]
+        return batch
+
+    def consume(self):
+        while True:
+            batch = self.next_batch()
+            if not batch:
+                return
+            started = time.perf_counter()
+            failed = 0
+            try:
+                response = self.handler({"Records": [record for _, record in batch]}, None)
+                failures = (response or {}).get("batchItemFailures") or []
+                if failures:
+                    # Kinesis would read the batch again from the first failed record
+                    sequence_numbers = [record["kinesis"]["sequenceNumber"] for _, record in batch]
+                    failed = len(batch) - sequence_numbers.index(failures[0]["itemIdentifier"])
+                    print("Batch failed from record", failures[0]["itemIdentifier"], file=sys.stderr)
+            except Exception as e:
+                print("Batch failed: ", e, file=sys.stderr)
+                failed = len(batch)
+            finished = time.perf_counter()
+            with self.condition:
+                self.failed += failed
+                self.processed += len(batch)
+                self.batches.append((finished - started) * 1000)
+                self.delays.extend((finished - released) * 1000 for released, _ in batch)
+
+    def sample(self, start):
+        while True:
+            with self.condition:
+                self.samples.append((time.perf_counter() - start, len(self.backlog), self.processed))
+                if self.done and not self.backlog:
+                    return
+            time.sleep(self.sample_every)
+
+    def run(self, entries):
+        start = time.perf_counter()
+        threads = [threading.Thread(target=self.produce, args=(entries, start))]
+        threads += [threading.Thread(target=self.consume) for _ in range(self.parallel)]
+        threads.append(threading.Thread(target=self.sample, args=(start,)))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        return self.report(entries, elapsed)
+
+    def report(self, entries, elapsed):
+        span = (entries[-1][0] - entries[0][0]) / self.speed
+        times = [t for t, _, _ in self.samples]
+        backlogs = [b for _, b, _ in self.samples]
+        return {
+            "records": len(entries),
+            "failed_records": self.failed,
+            "offered_per_second": len(entries) / span if span > 0 else None,
+            "sustained_per_second": self.processed / elapsed,
+            "elapsed_seconds": elapsed,
+            # records per second the backlog grows by, above zero the consumers cannot keep up
+            "backlog_growth_per_second": slope(times, backlogs),
+            "max_backlog": max(backlogs, default=0),
+            "batch_ms": summary(self.batches),
+            "record_delay_ms": summary(self.delays),
+        }
+
+
+def slope(xs, ys):
+    # least squares
+    if len(xs) < 2:
+        return 0.0
+    mean_x, mean_y = sum(xs) / len(xs), sum(ys) / len(ys)
+    variance = sum((x - mean_x) ** 2 for x in xs)
+    return sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / variance if variance else 0.0
+
+
+def load_handler(target):
+    module, _, function = target.partition(":")
+    return getattr(importlib.import_module(module), function or "lambda_handler")
+
+
+def replay(args):
+    entries = read_capture(args.capture) * args.loops
+    if args.loops > 1:
+        # every loop starts where the previous one ended
+        span = entries[-1][0] - entries[0][0] + 1
+        count = len(entries) // args.loops
+        entries = [[arrival + (i // count) * span, record] for i, (arrival, record) in enumerate(entries)]
+    handler = load_handler(args.target)
+    replayer = Replayer(handler, args.speed, args.parallel, args.batch_size, args.batch_window)
+    with contextlib.ExitStack() as stack:
+        if not args.aws:
+            stack.enter_context(mock.patch("boto3.client", FakeAWS(parse_latency(args.latency)).client))
+            if not args.rate_limits:
+                stack.enter_context(mock.patch("handler.throttle.ENABLED", False))
+        # the Lambda prints one metrics line per batch
+        stack.enter_context(contextlib.redirect_stdout(io.StringIO()))
+        report = replayer.run(entries)
+    print(json.dumps(report, indent=2))
+
+
+def capture(args):
+    if args.event:
+        entries = capture_event(args.event)
+    elif args.stream:
+        entries = capture_stream(args.stream, args.limit)
+    else:
+        entries = capture_synthetic(args.synthetic, args.faces, args.fps)
+    entries = list(entries)
+    write_capture(args.capture, entries)
+    print("Captured", len(entries), "records to", args.capture)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    capture_parser = commands.add_parser("capture")
+    capture_parser.add_argument("capture", help="file written, gzipped JSON lines")
+    source = capture_parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--event", help="JSON file of a Lambda event")
+    source.add_argument("--stream", help="Kinesis data stream read from the oldest record")
+    source.add_argument("--synthetic", type=int, help="number of generated records")
+    capture_parser.add_argument("--limit", type=int, default=10000, help="records read from the stream")
+    capture_parser.add_argument("--faces", type=int, default=2, help="faces per generated record")
+    capture_parser.add_argument("--fps", type=float, default=5, help="generated records per second")
+
+    replay_parser = commands.add_parser("replay")
+    replay_parser.add_argument("capture")
+    replay_parser.add_argument("--speed", type=float, default=1.0, help="time compression, 10 replays 10x faster")
+    replay_parser.add_argument("--loops", type=int, default=1, help="times the capture is played back to back")
+    replay_parser.add_argument("--parallel", type=int, default=1, help="batches handled at the same time")
+    replay_parser.add_argument("--batch-size", type=int, default=100)
+    replay_parser.add_argument("--batch-window", type=float, default=1.0, help="seconds to wait for a full batch")
+    replay_parser.add_argument("--target", default="lambda_function:lambda_handler", help="module:function")
+    replay_parser.add_argument("--latency", action="append", default=[], metavar="SERVICE=MS",
+                               help="latency of a fake service")
+    replay_parser.add_argument("--aws", action="store_true", help="call the real services instead of the fakes")
+    replay_parser.add_argument("--rate-limits", action="store_true",
+                               help="keep the client side rate limits, always on with --aws")
+
+    args = parser.parse_args()
+    if args.command == "capture":
+        capture(args)
+    else:
+        replay(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Cold start of the Lambda: import time and time to the first record, each run in a fresh interpreter.
+
+    python -m benchmark.startup [--runs 10] [--event event.json]
+
+Without --event the first record is a batch with no faces, which needs no AWS account.
+An event with faces calls the real services of aws_env.yaml.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from base64 import b64encode
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# runs in the child, prints one JSON line
+CHILD = """
+import json, sys, time
+start = time.perf_counter()
+import lambda_function
+imported = time.perf_counter()
+event = json.load(sys.stdin)
+with open("/dev/null", "w") as null:
+    stdout, sys.stdout = sys.stdout, null
+    lambda_function.lambda_handler(event, None)
+    sys.stdout = stdout
+done = time.perf_counter()
+print(json.dumps({
+    "import_ms": (imported - start) * 1000,
+    "first_record_ms": (done - imported) * 1000,
+    "loaded": [m for m in ("yaml", "boto3", "botocore", "numpy", "cv2") if m in sys.modules],
+}))
+"""
+
+# a stream processor record without any face
+EMPTY_RECORD = {
+    "InputInformation": {"KinesisVideo": {"StreamArn": "arn", "FragmentNumber": "1",
+                                          "ServerTimestamp": 0, "ProducerTimestamp": 0,
+                                          "FrameOffsetInSeconds": 0}},
+    "StreamProcessorInformation": {"Status": "RUNNING"},
+    "FaceSearchResponse": [],
+}
+
+
+def empty_event():
+    return {"Records": [{"kinesis": {"data": b64encode(json.dumps(EMPTY_RECORD).encode()).decode()}}]}
+
+
+def run_once(event):
+    # the event goes through stdin so the child imports nothing but the Lambda
+    output = subprocess.run([sys.executable, "-c", CHILD], input=json.dumps(event),
+                            cwd=ROOT, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--event", help="JSON file of a Kinesis event to send as the first record")
+    args = parser.parse_args()
+
+    if args.event:
+        with open(args.event) as file:
+            event = json.load(file)
+    else:
+        event = empty_event()
+    results = [run_once(event) for _ in range(args.runs)]
+    for name in ("import_ms", "first_record_ms"):
+        values = [r[name] for r in results]
+        print(f"{name:>16}: median {statistics.median(values):8.1f}  min {min(values):8.1f}  max {max(values):8.1f}")
+    print(f"{'modules loaded':>16}: {', '.join(results[-1]['loaded']) or '-'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""Long-running reader of face-stream through the enhanced fan-out consumer, one process per shard.
+
+    python consumer.py [--stream face-stream] [--consumer face_consumer]
+                       [--checkpoints ./checkpoints | --checkpoint-table consumer-checkpoints] [--polling]
+
+Each batch goes through the same process_records as the Lambda. The sequence number of the last
+processed record is checkpointed after every batch, so a restarted worker resumes right after it.
+A batch is read again from its first failed record until that record succeeds or goes to the
+dead letters (at least once, like the Lambda).
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import signal
+from time import perf_counter, sleep
+
+import lambda_function
+from handler import throttle
+from handler.checkpoint import SHARD_END, DynamoCheckpoints, FileCheckpoints
+from handler.dead_letter import DeadLetters
+from handler.kinesis_handler import KDSHandler
+from handler.metrics import metrics
+
+# seconds between two checks for new shards and dead workers
+REFRESH_INTERVAL = 10
+# where a shard without a checkpoint starts, "LATEST" or "TRIM_HORIZON"
+INITIAL_POSITION = os.environ.get("INITIAL_POSITION", "LATEST")
+# seconds before a batch is read again from its first failed record
+RETRY_DELAY = 1
+
+
+def starting_position(sequence_number, initial=INITIAL_POSITION):
+    if sequence_number is None:
+        return {"Type": initial}
+    return {"Type": "AFTER_SEQUENCE_NUMBER", "SequenceNumber": sequence_number}
+
+
+def open_checkpoints(stream_name, consumer_name, directory=None, table=None):
+    if table is not None:
+        return DynamoCheckpoints(table, stream_name + "/" + consumer_name)
+    return FileCheckpoints(os.path.join(directory or "checkpoints", stream_name + "-" + consumer_name))
+
+
+def process_batch(records, function_name, dead_letters):
+    # the Lambda path without the base64 of the event, one metrics line per batch; returns the sequence
+    # numbers of the failed records
+    metrics.reset()
+    throttle.budget.reset()
+    start = perf_counter()
+    try:
+        face_records = []
+        for record in records:
+            try:
+                face_recognition_record = json.loads(record["Data"])
+                has_faces = len(face_recognition_record["FaceSearchResponse"]) > 0
+            except (ValueError, KeyError, TypeError) as e:
+                dead_letters.put(record, e, record["SequenceNumber"])
+                continue
+            if has_faces:
+                face_records.append((record["SequenceNumber"], face_recognition_record))
+        metrics.count("Records", len(face_records))
+        return lambda_function.process_face_records(face_records, dead_letters)
+    finally:
+        metrics.record("Invocation", (perf_counter() - start) * 1000, "Milliseconds")
+        print(metrics.emf(lambda_function.METRICS_NAMESPACE, {"Function": function_name}))
+
+
+def consume_shard(kds_handler, consumer_arn, shard_id, checkpoints, stop=None, batch_size=lambda_function.MAX_RECORDS,
+                  dead_letters=None):
+    """Reads one shard until it is closed or `stop` is set; a subscription that expired is renewed."""
+    resume = checkpoints.get(shard_id)
+    if resume == SHARD_END:
+        return
+    if dead_letters is None:
+        dead_letters = DeadLetters(lambda_function.DEAD_LETTER_DIR)
+    function_name = kds_handler.name + "/" + shard_id
+    while stop is None or not stop.is_set():
+        position = starting_position(resume)
+        if consumer_arn is None:
+            events = kds_handler.poll(shard_id, position)
+        else:
+            events = kds_handler.subscribe(consumer_arn, shard_id, position)
+        for event in events:
+            records = event["Records"]
+            # fan-out pushes up to 10000 records at once, they go through in Lambda sized batches
+            for start in range(0, len(records), batch_size):
+                batch = records[start:start + batch_size]
+                while True:
+                    failures = process_batch(batch, function_name, dead_letters)
+                    done = [r["SequenceNumber"] for r in batch].index(failures[0]) if failures else len(batch)
+                    if done > 0:
+                        checkpoints.put(shard_id, batch[done - 1]["SequenceNumber"])
+                    if not failures:
+                        break
+                    if stop is not None and stop.is_set():
+                        return
+                    batch = batch[done:]
+                    sleep(RETRY_DELAY)
+            if event.get("ContinuationSequenceNumber") is not None:
+                resume = event["ContinuationSequenceNumber"]
+            if event["ShardEnded"]:
+                checkpoints.put(shard_id, SHARD_END)
+                print("Shard", shard_id, "closed")
+                return
+            if stop is not None and stop.is_set():
+                return
+
+
+def run_worker(stream_name, consumer_name, shard_id, directory, table, polling, stop):
+    # every process builds its own clients, boto3 clients are not shared across processes
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    kds_handler = KDSHandler(stream_name)
+    consumer_arn = None if polling else kds_handler.get_consumer_arn(consumer_name)
+    checkpoints = open_checkpoints(stream_name, consumer_name, directory, table)
+    consume_shard(kds_handler, consumer_arn, shard_id, checkpoints, stop)
+
+
+def ready_shards(shards, checkpoints):
+    # after a reshard the children wait until their parents have been read to the end
+    ids = {shard["ShardId"] for shard in shards}
+    ready = []
+    for shard in shards:
+        if checkpoints.get(shard["ShardId"]) == SHARD_END:
+            continue
+        parents = [shard.get("ParentShardId"), shard.get("AdjacentParentShardId")]
+        if any(p in ids and checkpoints.get(p) != SHARD_END for p in parents if p):
+            continue
+        ready.append(shard["ShardId"])
+    return ready
+
+
+def run(stream_name, consumer_name, directory=None, table=None, polling=False, refresh=REFRESH_INTERVAL):
+    context = multiprocessing.get_context("spawn")
+    stop = context.Event()
+    kds_handler = KDSHandler(stream_name)
+    checkpoints = open_checkpoints(stream_name, consumer_name, directory, table)
+    workers = {}
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    try:
+        while not stop.is_set():
+            for shard_id in ready_shards(kds_handler.describe_shards(), checkpoints):
+                worker = workers.get(shard_id)
+                if worker is not None and worker.is_alive():
+                    continue
+                if worker is not None and worker.exitcode != 0:
+                    print("Restarting the worker of", shard_id, "after exit code", worker.exitcode)
+                workers[shard_id] = context.Process(
+                    target=run_worker, name=shard_id,
+                    args=(stream_name, consumer_name, shard_id, directory, table, polling, stop))
+                workers[shard_id].start()
+            stop.wait(refresh)
+    except KeyboardInterrupt:
+        stop.set()
+    finally:
+        # workers finish their batch and checkpoint it
+        for worker in workers.values():
+            worker.join(timeout=60)
+            if worker.is_alive():
+                worker.terminate()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stream", default="face-stream")
+    parser.add_argument("--consumer", default="face_consumer")
+    parser.add_argument("--checkpoints", help="directory of the checkpoint files, ./checkpoints by default")
+    parser.add_argument("--checkpoint-table", help="DynamoDB table of the checkpoints instead of files")
+    parser.add_argument("--polling", action="store_true", help="read with GetRecords instead of enhanced fan-out")
+    args = parser.parse_args()
+    run(args.stream, args.consumer, args.checkpoints, args.checkpoint_table, args.polling)
+
+
+if __name__ == "__main__":
+    main()
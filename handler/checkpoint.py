@@ -0,0 +1,70 @@
+import json
+import os
+
+from util import aws_client
+
+# written once a closed shard has been read to the end, its children can start
+SHARD_END = "SHARD_END"
+
+
+class FileCheckpoints:
+    """Last processed sequence number of every shard, one file per shard, for a consumer on one host."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, shard_id):
+        return os.path.join(self.directory, shard_id + ".json")
+
+    def get(self, shard_id):
+        try:
+            with open(self.path(shard_id)) as file:
+                return json.load(file)["sequenceNumber"]
+        except FileNotFoundError:
+            return None
+
+    def put(self, shard_id, sequence_number):
+        # replaced in one go, a crash never leaves half a checkpoint
+        path = self.path(shard_id)
+        with open(path + ".tmp", "w") as file:
+            json.dump({"sequenceNumber": sequence_number}, file)
+        os.replace(path + ".tmp", path)
+
+
+class DynamoCheckpoints:
+    """The same in DynamoDB, so a consumer moved to another host resumes where it stopped."""
+
+    def __init__(self, table, prefix):
+        self.table_name = table
+        # stream and consumer name, one table can hold the checkpoints of several consumers
+        self.prefix = prefix
+        self.client = aws_client("dynamodb")
+
+    def create(self):
+        print("Creating DynamoDB: ", self.table_name)
+        try:
+            self.client.create_table(
+                TableName=self.table_name,
+                KeySchema=[{'AttributeName': 'shardKey', 'KeyType': 'HASH'}],
+                AttributeDefinitions=[{'AttributeName': 'shardKey', 'AttributeType': 'S'}],
+                BillingMode='PAY_PER_REQUEST'
+            )
+            print('Done...')
+        except Exception as e:
+            print(e)
+        print("")
+
+    def key(self, shard_id):
+        return {"shardKey": {"S": self.prefix + "/" + shard_id}}
+
+    def get(self, shard_id):
+        response = self.client.get_item(TableName=self.table_name, Key=self.key(shard_id), ConsistentRead=True)
+        item = response.get("Item")
+        return item["sequenceNumber"]["S"] if item is not None else None
+
+    def put(self, shard_id, sequence_number):
+        self.client.put_item(
+            TableName=self.table_name,
+            Item={**self.key(shard_id), "sequenceNumber": {"S": sequence_number}}
+        )
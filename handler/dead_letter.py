@@ -0,0 +1,67 @@
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from handler.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# times a record may fail in this process before it is set aside, so one bad record cannot hold up its shard
+MAX_RECORD_ATTEMPTS = int(os.environ.get("MAX_RECORD_ATTEMPTS", 3))
+# failing records whose attempts are remembered
+TRACKED_RECORDS = 10000
+
+
+class DeadLetters:
+    """Records given up on, appended as JSON lines to one file per day in directory."""
+
+    def __init__(self, directory, max_attempts=MAX_RECORD_ATTEMPTS):
+        self.directory = directory
+        self.max_attempts = max_attempts
+        # sequence number -> failed attempts so far
+        self.attempts = OrderedDict()
+        self.lock = threading.Lock()
+
+    def give_up(self, sequence_number, record, error):
+        """Counts a failed attempt; returns True once the record went to the dead letters."""
+        with self.lock:
+            attempts = self.attempts.pop(sequence_number, 0) + 1
+            if attempts < self.max_attempts:
+                self.attempts[sequence_number] = attempts
+                while len(self.attempts) > TRACKED_RECORDS:
+                    self.attempts.popitem(last=False)
+                return False
+        self.put(record, error, sequence_number, attempts)
+        return True
+
+    def put(self, record, error, sequence_number=None, attempts=1):
+        now = datetime.now(timezone.utc)
+        entry = {
+            "sequenceNumber": sequence_number,
+            "attempts": attempts,
+            "error": repr(error),
+            "failedAt": now.isoformat(),
+            "record": record,
+        }
+        logger.error("Dead letter %s after %d attempts: %r", sequence_number, attempts, error)
+        metrics.count("DeadLetters")
+        with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self.path(now), "a") as file:
+                # bytes and timestamps of a raw Kinesis record are kept as text
+                file.write(json.dumps(entry, default=str) + "\n")
+
+    def path(self, now):
+        return os.path.join(self.directory, now.strftime("%Y-%m-%d") + ".jsonl")
+
+    def read(self):
+        entries = []
+        if not os.path.isdir(self.directory):
+            return entries
+        for name in sorted(os.listdir(self.directory)):
+            with open(os.path.join(self.directory, name)) as file:
+                entries += [json.loads(line) for line in file if line.strip()]
+        return entries
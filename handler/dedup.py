@@ -0,0 +1,169 @@
+import threading
+from time import time
+
+from handler import throttle
+from handler.metrics import metrics
+from util import aws_client
+
+
+def face_score(detected_face):
+    # a sharp detection of a large face makes the best archive photo
+    box = detected_face["BoundingBox"]
+    return detected_face.get("Confidence", 100.0) / 100 * box["Width"] * box["Height"]
+
+
+class WindowStore:
+    """Keeps the sampling windows in DynamoDB, so they are shared by concurrent containers.
+
+    Items expire through the table TTL once the window is over.
+    """
+
+    def __init__(self, table):
+        self.table_name = table
+        self.client = aws_client("dynamodb")
+
+    def create(self):
+        print("Creating DynamoDB: ", self.table_name)
+        try:
+            self.client.create_table(
+                TableName=self.table_name,
+                KeySchema=[{'AttributeName': 'faceId', 'KeyType': 'HASH'}],
+                AttributeDefinitions=[{'AttributeName': 'faceId', 'AttributeType': 'S'}],
+                BillingMode='PAY_PER_REQUEST'
+            )
+            self.client.get_waiter('table_exists').wait(TableName=self.table_name)
+            self.client.update_time_to_live(
+                TableName=self.table_name,
+                TimeToLiveSpecification={'Enabled': True, 'AttributeName': 'expiresAt'}
+            )
+            print('Done...')
+        except Exception as e:
+            print(e)
+        print("")
+
+    def delete(self):
+        print("Deleting DynamoDB: ", self.table_name)
+        try:
+            self.client.delete_table(TableName=self.table_name)
+            print('Done...')
+        except Exception as e:
+            print(e)
+        print("")
+
+    def load(self, face_ids):
+        windows = {}
+        face_ids = list(face_ids)
+        # BatchGetItem takes at most 100 keys
+        for start in range(0, len(face_ids), 100):
+            keys = [{"faceId": {"S": face_id}} for face_id in face_ids[start:start + 100]]
+            requests = {self.table_name: {"Keys": keys}}
+            attempt = 0
+            while True:
+                response = throttle.call("dynamodb", "Read", self.client.batch_get_item, timer="DynamoDBRead",
+                                         cost=len(requests[self.table_name]["Keys"]), RequestItems=requests)
+                for item in response["Responses"].get(self.table_name, []):
+                    # TTL deletion is lazy, expired items may still be returned
+                    if float(item["expiresAt"]["N"]) > time():
+                        windows[item["faceId"]["S"]] = float(item["windowStart"]["N"])
+                requests = response.get("UnprocessedKeys") or {}
+                if not requests:
+                    break
+                # the keys left out when the table is at capacity
+                throttle.throttled("dynamodb", "Read")
+                error = RuntimeError(f"{len(requests[self.table_name]['Keys'])} windows still unprocessed by DynamoDB")
+                throttle.backoff("dynamodb", "Read", attempt, error)
+                attempt += 1
+        return windows
+
+    def save(self, face_id, window_start, min_interval):
+        throttle.call(
+            "dynamodb", "Write", self.client.put_item, timer="DynamoDBWrite",
+            TableName=self.table_name,
+            Item={
+                "faceId": {"S": face_id},
+                "windowStart": {"N": str(window_start)},
+                "expiresAt": {"N": str(int(time() + min_interval) + 1)},
+            }
+        )
+
+    def forget(self, face_id):
+        throttle.call("dynamodb", "Write", self.client.delete_item, timer="DynamoDBWrite",
+                      TableName=self.table_name, Key={"faceId": {"S": face_id}})
+
+
+class FaceSampler:
+    """Archives at most one photo of a face per min_interval seconds of video, the best scored one.
+
+    Windows live as long as the container, and in a WindowStore when a table is given.
+    """
+
+    def __init__(self, min_interval, table=None):
+        self.min_interval = min_interval
+        self.store = WindowStore(table) if table else None
+        # face id -> capture time starting the window its last photo belongs to
+        self.windows = {}
+        self.kept = 0
+        self.skipped = 0
+        self.lock = threading.Lock()
+
+    def load(self, face_ids):
+        # called with the lock held
+        if self.store is not None:
+            self.windows.update(self.store.load(f for f in set(face_ids) if f not in self.windows))
+
+    def archived(self, candidates):
+        """Indexes of the (face_id, captured_at, score) candidates in a window that already has its photo."""
+        with self.lock:
+            self.load(face_id for face_id, _, _ in candidates)
+            return [i for i, (face_id, captured_at, _) in enumerate(candidates)
+                    if face_id in self.windows and captured_at < self.windows[face_id] + self.min_interval]
+
+    def forget(self, face_id, captured_at):
+        """Drops the window of a photo that could not be archived, so the record read again is not sampled out."""
+        with self.lock:
+            window = self.windows.get(face_id)
+            if window is None or not window <= captured_at < window + self.min_interval:
+                return
+            del self.windows[face_id]
+            if self.store is not None:
+                self.store.forget(face_id)
+
+    def select(self, candidates):
+        """candidates are (face_id, captured_at, score) tuples, returns the indexes to archive."""
+        by_face = {}
+        for i, (face_id, _, _) in enumerate(candidates):
+            by_face.setdefault(face_id, []).append(i)
+
+        selected = []
+        with self.lock:
+            self.load(by_face)
+            for face_id, indexes in by_face.items():
+                indexes.sort(key=lambda i: candidates[i][1])
+                window = self.windows.get(face_id)
+                # best is only set for a window opened by this batch, an older one is already archived
+                best = None
+                for i in indexes:
+                    _, captured_at, score = candidates[i]
+                    if window is not None and captured_at < window + self.min_interval:
+                        if best is not None and score > candidates[best][2]:
+                            best = i
+                        continue
+                    if best is not None:
+                        selected.append(best)
+                    window = captured_at
+                    best = i
+                if best is not None:
+                    selected.append(best)
+                    self.windows[face_id] = window
+                    if self.store is not None:
+                        self.store.save(face_id, window, self.min_interval)
+
+            if candidates:
+                # forget the windows that no record can fall into anymore
+                latest = max(captured_at for _, captured_at, _ in candidates)
+                for face_id in [f for f, w in self.windows.items() if w + 2 * self.min_interval < latest]:
+                    del self.windows[face_id]
+            self.kept += len(selected)
+            self.skipped += len(candidates) - len(selected)
+        metrics.count("SampledOut", len(candidates) - len(selected))
+        return sorted(selected)
@@ -1,37 +1,101 @@
-import boto3
+import logging
+import os
+import threading
+from time import time
 
-from util import yaml_handler
+from botocore.exceptions import ClientError
 
-env = yaml_handler('./aws_env.yaml')
+from handler import throttle
+from util import aws_client, not_found
+
+logger = logging.getLogger(__name__)
+
+# "list" keeps every photo of a face in one item, "timeseries" stores one item per photo
+# under faceId + capturedAt, so a write costs the same however many photos a face has
+LIST = "list"
+TIME_SERIES = "timeseries"
+LAYOUT = os.environ.get("DYNAMO_LAYOUT", LIST)
+SORT_KEY = "capturedAt"
+
+# TransactWriteItems takes at most 100 items, BatchWriteItem 25, BatchGetItem 100 keys
+TRANSACTION_SIZE = 100
+BATCH_SIZE = 25
+GET_BATCH_SIZE = 100
+# photos of a face per update, each adds a condition and a condition expression takes at most 4 KB
+PHOTOS_PER_UPDATE = 50
+# retried on top of the throttling errors handler.throttle knows
+RETRYABLE_ERRORS = {
+    "TransactionCanceledException",
+    "TransactionConflictException",
+    "TransactionInProgressException",
+}
+
+
+def photo_item(bucket, key):
+    return {
+        "M": {
+            "objectKey": {
+                "S": key
+            },
+            "bucket": {
+                "S": bucket
+            }
+        }
+    }
+
+
+def already_written(error):
+    # the condition of an update failed: one of its photos is in the item, its record was read again
+    code = throttle.error_code(error)
+    if code == "ConditionalCheckFailedException":
+        return True
+    reasons = error.response.get("CancellationReasons") or []
+    return code == "TransactionCanceledException" and any(r.get("Code") == "ConditionalCheckFailed" for r in reasons)
+
+
+def retryable(error):
+    return throttle.error_code(error) in RETRYABLE_ERRORS and not already_written(error)
 
 
 class DynamoHandler:
-    def __init__(self, table, index="faceId"):
+    def __init__(self, table, index="faceId", layout=LAYOUT):
         self.table_name = table
         self.index = index
-        self.client = boto3.client(
-            "dynamodb",
-            region_name=env['aws_default_region']
-        )
+        self.layout = layout
+        self.client = aws_client("dynamodb")
+        self.buffer = {}
+        self.lock = threading.Lock()
+        self.listeners = []
 
     def create(self, index="faceId"):
         print("Creating DynamoDB: ", self.table_name)
         try:
             self.index = index
+            key_schema = [
+                {
+                    'AttributeName': index,
+                    'KeyType': 'HASH'
+                }
+            ]
+            attributes = [
+                {
+                    'AttributeName': index,
+                    'AttributeType': 'S'
+                }
+            ]
+            if self.layout == TIME_SERIES:
+                key_schema.append({
+                    'AttributeName': SORT_KEY,
+                    'KeyType': 'RANGE'
+                })
+                attributes.append({
+                    'AttributeName': SORT_KEY,
+                    'AttributeType': 'N'
+                })
             self.client.create_table(
                 TableName=self.table_name,
-                KeySchema=[
-                    {
-                        'AttributeName': index,
-                        'KeyType': 'HASH'
-                    }
-                ],
-                AttributeDefinitions=[
-                    {
-                        'AttributeName': index,
-                        'AttributeType': 'S'
-                    }
-                ],
+                KeySchema=key_schema,
+                AttributeDefinitions=attributes,
                 ProvisionedThroughput={
                     'ReadCapacityUnits': 25,
                     'WriteCapacityUnits': 25
@@ -53,6 +117,15 @@ class DynamoHandler:
             print(e)
         print("")
 
+    def query_status(self):
+        try:
+            response = self.client.describe_table(TableName=self.table_name)
+        except ClientError as e:
+            if not_found(e):
+                return None
+            raise
+        return response["Table"]["TableStatus"]
+
     def create_image_record(self, face_id, bucket, key):
         item = {
             "faceId": {
@@ -123,3 +196,209 @@ class DynamoHandler:
                 return False
             else:
                 raise e
+
+    def on_write(self, listener):
+        # listener(face_ids) is called once photos of these faces are written, e.g. to drop cached reads
+        self.listeners.append(listener)
+
+    def written(self, face_ids):
+        for listener in self.listeners:
+            listener(face_ids)
+
+    def get_images(self, face_ids, limit=None):
+        """face id -> its photos as {"bucket", "objectKey"}, the last `limit` ones if given.
+
+        One BatchGetItem per 100 faces; the time series layout queries every face instead.
+        """
+        face_ids = list(dict.fromkeys(face_ids))
+        if self.layout == TIME_SERIES:
+            return {face_id: self.latest_images(face_id, limit=limit or 100)[0] for face_id in face_ids}
+        images = {}
+        for start in range(0, len(face_ids), GET_BATCH_SIZE):
+            keys = [{self.index: {"S": face_id}} for face_id in face_ids[start:start + GET_BATCH_SIZE]]
+            requests = {self.table_name: {"Keys": keys, "ProjectionExpression": f"{self.index}, photos"}}
+            attempt = 0
+            while True:
+                response = throttle.call("dynamodb", "Read", self.client.batch_get_item, timer="DynamoDBRead",
+                                         cost=len(requests[self.table_name]["Keys"]), RequestItems=requests)
+                for item in response["Responses"].get(self.table_name, []):
+                    photos = [{"bucket": p["M"]["bucket"]["S"], "objectKey": p["M"]["objectKey"]["S"]}
+                              for p in item.get("photos", {}).get("L", [])]
+                    images[item[self.index]["S"]] = photos[-limit:] if limit else photos
+                requests = response.get("UnprocessedKeys") or {}
+                if not requests:
+                    break
+                # like UnprocessedItems, the keys left out when the table is at capacity
+                throttle.throttled("dynamodb", "Read")
+                error = RuntimeError(f"{len(requests[self.table_name]['Keys'])} keys still unprocessed by DynamoDB")
+                throttle.backoff("dynamodb", "Read", attempt, error)
+                attempt += 1
+        return images
+
+    def update_request(self, face_id, photos):
+        # creates the item and the list on first sight, appends otherwise; the keys of the photos are kept
+        # in a string set too, so a photo already listed fails the condition instead of being appended twice
+        object_keys = sorted({p["M"]["objectKey"]["S"] for p in photos})
+        values = {
+            ':i': {
+                "L": photos
+            },
+            ':empty': {
+                "L": []
+            },
+            ':keys': {
+                "SS": object_keys
+            },
+        }
+        conditions = []
+        for n, key in enumerate(object_keys):
+            values[f":k{n}"] = {"S": key}
+            conditions.append(f"NOT contains(photoKeys, :k{n})")
+        return {
+            "TableName": self.table_name,
+            "Key": {
+                self.index: {
+                    'S': face_id
+                }
+            },
+            "UpdateExpression": "SET photos = list_append(if_not_exists(photos, :empty), :i) ADD photoKeys :keys",
+            "ConditionExpression": " AND ".join(conditions),
+            "ExpressionAttributeValues": values,
+        }
+
+    def time_series_item(self, face_id, bucket, key, captured_at):
+        return {
+            self.index: {
+                "S": face_id
+            },
+            SORT_KEY: {
+                "N": str(captured_at)
+            },
+            "objectKey": {
+                "S": key
+            },
+            "bucket": {
+                "S": bucket
+            }
+        }
+
+    def upsert_image(self, face_id, bucket, key, captured_at=None):
+        if self.layout == TIME_SERIES:
+            captured_at = captured_at if captured_at is not None else int(time() * 1000)
+            throttle.call(
+                "dynamodb", "Write", self.client.put_item, timer="DynamoDBWrite",
+                TableName=self.table_name,
+                Item=self.time_series_item(face_id, bucket, key, captured_at)
+            )
+        else:
+            self.write([(face_id, [photo_item(bucket, key)])])
+        self.written([face_id])
+
+    def buffer_image(self, face_id, bucket, key, captured_at=None):
+        with self.lock:
+            if self.layout == TIME_SERIES:
+                captured_at = captured_at if captured_at is not None else int(time() * 1000)
+                # BatchWriteItem rejects a key that appears twice
+                self.buffer[(face_id, captured_at)] = self.time_series_item(face_id, bucket, key, captured_at)
+            else:
+                photos = self.buffer.setdefault(face_id, [])
+                # a content key comes back for a byte-identical crop, it is listed once
+                if photo_item(bucket, key) not in photos:
+                    photos.append(photo_item(bucket, key))
+
+    def flush(self):
+        with self.lock:
+            buffered, self.buffer = self.buffer, {}
+        if self.layout == TIME_SERIES:
+            items = list(buffered.values())
+            for start in range(0, len(items), BATCH_SIZE):
+                self.put_batch(items[start:start + BATCH_SIZE])
+                self.written({item[self.index]["S"] for item in items[start:start + BATCH_SIZE]})
+            return
+        # the photos of a face are merged, so a face is written once per flush unless it has more photos
+        # than an update takes; its next photos go in the next round, a transaction names a face once
+        rounds = []
+        for face_id, photos in buffered.items():
+            for n, start in enumerate(range(0, len(photos), PHOTOS_PER_UPDATE)):
+                if n == len(rounds):
+                    rounds.append([])
+                rounds[n].append((face_id, photos[start:start + PHOTOS_PER_UPDATE]))
+        for updates in rounds:
+            for start in range(0, len(updates), TRANSACTION_SIZE):
+                self.write(updates[start:start + TRANSACTION_SIZE])
+                self.written([face_id for face_id, _ in updates[start:start + TRANSACTION_SIZE]])
+
+    def put_batch(self, items):
+        requests = {self.table_name: [{"PutRequest": {"Item": item}} for item in items]}
+        attempt = 0
+        while True:
+            # one write unit per item of up to 1 KB
+            response = throttle.call("dynamodb", "Write", self.client.batch_write_item, timer="DynamoDBWrite",
+                                     cost=len(requests[self.table_name]), RequestItems=requests)
+            requests = response.get("UnprocessedItems") or {}
+            if not requests:
+                return
+            # DynamoDB leaves items out instead of failing the call when the table is at capacity
+            logger.warning("Retrying %d unprocessed DynamoDB items", len(requests[self.table_name]))
+            throttle.throttled("dynamodb", "Write")
+            error = RuntimeError(f"{len(requests[self.table_name])} items still unprocessed by DynamoDB")
+            throttle.backoff("dynamodb", "Write", attempt, error)
+            attempt += 1
+
+    def write(self, updates):
+        # updates are (face_id, photos)
+        requests = [self.update_request(face_id, photos) for face_id, photos in updates]
+        try:
+            if len(requests) == 1:
+                throttle.call("dynamodb", "Write", self.client.update_item, timer="DynamoDBWrite",
+                              retryable=retryable, **requests[0])
+            else:
+                # a transaction costs twice the WCU of a plain update
+                throttle.call("dynamodb", "Write", self.client.transact_write_items, timer="DynamoDBWrite",
+                              cost=2 * len(requests), retryable=retryable,
+                              TransactItems=[{"Update": request} for request in requests])
+        except ClientError as e:
+            if not already_written(e):
+                raise
+            if len(updates) == 1 and len(updates[0][1]) == 1:
+                logger.info("Photo %s of %s already recorded", updates[0][1][0]["M"]["objectKey"]["S"], updates[0][0])
+                return
+            # some of the photos are there, each goes on its own so only those are skipped
+            logger.warning("Rewriting %d faces photo by photo, some photos are already recorded", len(updates))
+            for face_id, photos in updates:
+                for photo in photos:
+                    self.write([(face_id, [photo])])
+
+    def query_images(self, face_id, start=None, end=None, limit=10, latest=True, start_key=None):
+        # only for the time series layout, returns a page of photos and the key of the next page
+        condition = f"{self.index} = :f"
+        values = {":f": {"S": face_id}}
+        if start is not None or end is not None:
+            condition += f" AND {SORT_KEY} BETWEEN :start AND :end"
+            values[":start"] = {"N": str(start if start is not None else 0)}
+            values[":end"] = {"N": str(end if end is not None else 2 ** 53)}
+        kwargs = {
+            "TableName": self.table_name,
+            "KeyConditionExpression": condition,
+            "ExpressionAttributeValues": values,
+            "ScanIndexForward": not latest,
+            "Limit": limit,
+        }
+        if start_key is not None:
+            kwargs["ExclusiveStartKey"] = start_key
+        response = self.client.query(**kwargs)
+        photos = [
+            {
+                SORT_KEY: int(item[SORT_KEY]["N"]),
+                "bucket": item["bucket"]["S"],
+                "objectKey": item["objectKey"]["S"],
+            }
+            for item in response["Items"]
+        ]
+        return photos, response.get("LastEvaluatedKey")
+
+    def latest_images(self, face_id, limit=10, start_key=None):
+        return self.query_images(face_id, limit=limit, start_key=start_key)
+
+    def images_between(self, face_id, start, end, limit=100, start_key=None):
+        return self.query_images(face_id, start, end, limit=limit, latest=False, start_key=start_key)
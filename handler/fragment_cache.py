@@ -0,0 +1,66 @@
+import threading
+from collections import OrderedDict
+
+from handler.metrics import metrics
+
+
+class FragmentCache:
+    """LRU of decoded frames, keyed by (stream ARN, fragment number) and then by frame offset.
+
+    Whole fragments are evicted once the frames held go over max_bytes.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.fragments = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, offset):
+        with self.lock:
+            frames = self.fragments.get(key)
+            if frames is None or offset not in frames:
+                self.misses += 1
+                metrics.count("FragmentCacheMisses")
+                return None
+            self.fragments.move_to_end(key)
+            self.hits += 1
+            metrics.count("FragmentCacheHits")
+            return frames[offset]
+
+    def put(self, key, offset, frame):
+        if frame.nbytes > self.max_bytes:
+            return
+        # frames are shared between records, nobody may draw on them
+        frame.flags.writeable = False
+        with self.lock:
+            frames = self.fragments.setdefault(key, {})
+            self.fragments.move_to_end(key)
+            if offset in frames:
+                self.size -= frames[offset].nbytes
+            frames[offset] = frame
+            self.size += frame.nbytes
+            while self.size > self.max_bytes:
+                _, evicted = self.fragments.popitem(last=False)
+                self.size -= sum(f.nbytes for f in evicted.values())
+                self.evictions += 1
+                metrics.count("FragmentCacheEvictions")
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "fragments": len(self.fragments),
+                "bytes": self.size,
+            }
+
+    def clear(self):
+        with self.lock:
+            self.fragments.clear()
+            self.size = 0
+            self.hits = self.misses = self.evictions = 0
@@ -0,0 +1,86 @@
+import os
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+from handler.metrics import metrics
+
+# seconds a visitor's photos are served from memory, far below the lifetime of the URLs
+CACHE_TTL = float(os.environ.get("HISTORY_CACHE_TTL", 60))
+CACHE_SIZE = int(os.environ.get("HISTORY_CACHE_SIZE", 1000))
+URL_EXPIRES = int(os.environ.get("HISTORY_URL_EXPIRES", 3600))
+
+
+class VisitorCache:
+    """LRU of at most max_size visitors, each dropped ttl seconds after it was stored."""
+
+    def __init__(self, ttl=CACHE_TTL, max_size=CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, face_id):
+        with self.lock:
+            entry = self.entries.get(face_id)
+            if entry is None or entry[0] <= monotonic():
+                self.entries.pop(face_id, None)
+                metrics.count("HistoryCacheMisses")
+                return None
+            self.entries.move_to_end(face_id)
+            metrics.count("HistoryCacheHits")
+            return entry[1]
+
+    def put(self, face_id, value):
+        with self.lock:
+            self.entries[face_id] = (monotonic() + self.ttl, value)
+            self.entries.move_to_end(face_id)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, face_ids):
+        with self.lock:
+            for face_id in face_ids:
+                self.entries.pop(face_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class VisitorHistory:
+    """Photos of many visitors at once, with presigned URLs, for the dashboard.
+
+    Reads go through one BatchGetItem per 100 visitors and hot visitors come from the cache.
+    The cache is dropped for the faces the DynamoHandler writes; writes from other processes
+    show up once the entry expires.
+    """
+
+    def __init__(self, dynamo_handler, s3_handler, ttl=CACHE_TTL, max_size=CACHE_SIZE, expires_in=URL_EXPIRES,
+                 limit=None):
+        self.dynamo_handler = dynamo_handler
+        self.s3_handler = s3_handler
+        self.expires_in = expires_in
+        # photos per visitor, the latest ones
+        self.limit = limit
+        self.cache = VisitorCache(ttl, max_size)
+        dynamo_handler.on_write(self.cache.invalidate)
+
+    def photos(self, face_ids):
+        """face id -> [{"bucket", "objectKey", "url"}], an unknown face gets an empty list."""
+        result = {}
+        missing = []
+        for face_id in dict.fromkeys(face_ids):
+            photos = self.cache.get(face_id)
+            if photos is None:
+                missing.append(face_id)
+            else:
+                result[face_id] = photos
+        if missing:
+            images = self.dynamo_handler.get_images(missing, self.limit)
+            for face_id in missing:
+                photos = images.get(face_id, [])
+                urls = self.s3_handler.presign(photos, self.expires_in)
+                result[face_id] = [{**photo, "url": url} for photo, url in zip(photos, urls)]
+                self.cache.put(face_id, result[face_id])
+        return result
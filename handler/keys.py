@@ -0,0 +1,41 @@
+import hashlib
+import os
+
+# hex digits of the hashed prefix every key starts with, 2 spreads the writes over 256 S3 prefixes
+PREFIX_LENGTH = int(os.environ.get("KEY_PREFIX_LENGTH", 2))
+# "time" keys a face crop by stream and capture time, "content" by a hash of its bytes,
+# so a byte-identical crop is stored once
+KEY_MODE = os.environ.get("KEY_MODE", "time")
+
+
+def stream_id(stream_arn):
+    # arn:aws:kinesisvideo:<region>:<account>:stream/<name>/<creation time> -> <name>-<creation time>
+    resource = stream_arn.split(":", 5)[-1]
+    parts = resource.split("/")
+    return "-".join(parts[1:]) if len(parts) > 1 else resource
+
+
+def partition(path, length=PREFIX_LENGTH):
+    return hashlib.md5(path.encode()).hexdigest()[:length]
+
+
+def frame_path(stream_arn, producer_timestamp, offset):
+    # milliseconds of both, rounded: the offsets come as floats like 3.000999927520752
+    return "%s/%d_%d" % (stream_id(stream_arn), round(producer_timestamp * 1000), round(offset * 1000))
+
+
+def frame_key(stream_arn, producer_timestamp, offset, extension):
+    # <partition>/<stream>/<producer ms>_<offset ms>_frame.jpg, the partition is a hash of the frame
+    # so a frame and its faces share a prefix
+    path = frame_path(stream_arn, producer_timestamp, offset)
+    return partition(path) + "/" + path + "_frame" + extension
+
+
+def face_key(stream_arn, producer_timestamp, offset, i, extension):
+    path = frame_path(stream_arn, producer_timestamp, offset)
+    return partition(path) + "/" + path + "_" + str(i) + extension
+
+
+def content_key(data, extension):
+    digest = hashlib.sha256(data).hexdigest()
+    return partition(digest) + "/faces/" + digest + extension
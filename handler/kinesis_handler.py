@@ -1,18 +1,15 @@
-import boto3
+from time import sleep
 
-from util import yaml_handler
+from botocore.exceptions import ClientError
 
-env = yaml_handler('./aws_env.yaml')
+from util import aws_client, not_found
 
 
 # Kinesis Video Handler
 class KVSHandler:
     def __init__(self, name):
         self.name = name
-        self.client = boto3.client(
-            'kinesisvideo',
-            region_name=env['aws_default_region']
-        )
+        self.client = aws_client('kinesisvideo')
         self.arn = None
 
     def create(self, media_type="video/h264", retention_hour=24):
@@ -53,18 +50,24 @@ class KVSHandler:
         self.arn = response["StreamInfo"]["StreamARN"]
         return self.arn
 
+    def query_status(self):
+        try:
+            response = self.client.describe_stream(StreamName=self.name)
+        except ClientError as e:
+            if not_found(e):
+                return None
+            raise
+        return response["StreamInfo"]["Status"]
+
 
 class KDSHandler:
     def __init__(self, name):
         self.name = name
-        self.client = boto3.client(
-            'kinesis',
-            region_name=env['aws_default_region']
-        )
+        self.client = aws_client('kinesis')
         self.arn = None
 
     def create(self, shard=1):
-        print("Deleting Kinesis Data Stream: ", self.name)
+        print("Creating Kinesis Data Stream: ", self.name)
         try:
             self.client.create_stream(
                 StreamName=self.name,
@@ -101,12 +104,29 @@ class KDSHandler:
         return self.arn
 
     def query_status(self):
-        response = self.client.describe_stream(
-            StreamName=self.name,
-            Limit=1
-        )
+        try:
+            response = self.client.describe_stream(
+                StreamName=self.name,
+                Limit=1
+            )
+        except ClientError as e:
+            if not_found(e):
+                return None
+            raise
         return response["StreamDescription"]["StreamStatus"]
 
+    def consumer_status(self, name):
+        try:
+            response = self.client.describe_stream_consumer(
+                StreamARN=self.get_arn(),
+                ConsumerName=name
+            )
+        except ClientError as e:
+            if not_found(e):
+                return None
+            raise
+        return response["ConsumerDescription"]["ConsumerStatus"]
+
     def create_kds_consumer(self, name):
         print("Creating Kinesis Data Stream Consumer: ", name)
         try:
@@ -118,3 +138,74 @@ class KDSHandler:
         except Exception as e:
             print(e)
         print("")
+
+    def describe_shards(self):
+        shards = []
+        request = {"StreamName": self.name}
+        while True:
+            response = self.client.list_shards(**request)
+            shards += response["Shards"]
+            if "NextToken" not in response:
+                return shards
+            request = {"NextToken": response["NextToken"]}
+
+    def list_shards(self):
+        return [shard["ShardId"] for shard in self.describe_shards()]
+
+    def read_records(self, shard_id, iterator_type="TRIM_HORIZON", limit=1000):
+        # yields the records of one shard until it has caught up with the tip
+        iterator = self.client.get_shard_iterator(
+            StreamName=self.name,
+            ShardId=shard_id,
+            ShardIteratorType=iterator_type
+        )["ShardIterator"]
+        while iterator is not None:
+            response = self.client.get_records(ShardIterator=iterator, Limit=limit)
+            for record in response["Records"]:
+                yield record
+            if response.get("MillisBehindLatest", 0) == 0:
+                return
+            iterator = response.get("NextShardIterator")
+
+    def get_consumer_arn(self, name):
+        response = self.client.describe_stream_consumer(
+            StreamARN=self.get_arn(),
+            ConsumerName=name
+        )
+        return response["ConsumerDescription"]["ConsumerARN"]
+
+    def subscribe(self, consumer_arn, shard_id, position):
+        # enhanced fan-out pushes the records for 5 minutes, then a new subscription is needed
+        response = self.client.subscribe_to_shard(
+            ConsumerARN=consumer_arn,
+            ShardId=shard_id,
+            StartingPosition=position
+        )
+        for event in response["EventStream"]:
+            if "SubscribeToShardEvent" in event:
+                event = event["SubscribeToShardEvent"]
+                # a closed shard sends its children instead of a continuation
+                event["ShardEnded"] = event.get("ContinuationSequenceNumber") is None
+                yield event
+
+    def poll(self, shard_id, position, limit=1000, interval=1.0):
+        # the same events as subscribe, from GetRecords, for a stream without a registered consumer
+        request = {"StreamName": self.name, "ShardId": shard_id, "ShardIteratorType": position["Type"]}
+        if "SequenceNumber" in position:
+            request["StartingSequenceNumber"] = position["SequenceNumber"]
+        iterator = self.client.get_shard_iterator(**request)["ShardIterator"]
+        while iterator is not None:
+            response = self.client.get_records(ShardIterator=iterator, Limit=limit)
+            iterator = response.get("NextShardIterator")
+            records = response["Records"]
+            yield {
+                "Records": records,
+                "ContinuationSequenceNumber": records[-1]["SequenceNumber"] if records else position.get("SequenceNumber"),
+                "MillisBehindLatest": response.get("MillisBehindLatest", 0),
+                "ShardEnded": iterator is None,
+            }
+            if records:
+                position = {"Type": "AFTER_SEQUENCE_NUMBER", "SequenceNumber": records[-1]["SequenceNumber"]}
+            elif iterator is not None and response.get("MillisBehindLatest", 0) == 0:
+                # caught up, GetRecords allows 5 calls per second and shard
+                sleep(interval)
@@ -1,65 +1,173 @@
-import boto3
-import cv2
+import logging
+import os
+import threading
+import time
 
-from util import yaml_handler
+from handler import throttle
+from handler.fragment_cache import FragmentCache
+from handler.metrics import metrics
+from handler.mkv import extract_frames
+from util import LazyModule, aws_client
 from datetime import datetime
 
-env = yaml_handler('./aws_env.yaml')
+# OpenCV and NumPy are loaded by the first frame, a batch without faces never needs them
+cv2 = LazyModule("cv2")
+np = LazyModule("numpy")
 
-TMP_DIR = "/tmp"
+logger = logging.getLogger(__name__)
 
+# seconds before a GET_MEDIA endpoint is looked up again
+ENDPOINT_TTL = 300
+# memory the decoded frames may take, shared by all the streams of the container
+FRAGMENT_CACHE_BYTES = int(os.environ.get("FRAGMENT_CACHE_BYTES", 128 * 1024 * 1024))
 
-def get_endpoint(arn):
-    kv_client = boto3.client(
-        'kinesisvideo',
-        region_name=env['aws_default_region']
-    )
-    response = kv_client.get_data_endpoint(
-        StreamARN=arn,
-        APIName='GET_MEDIA'
-    )
-    return response['DataEndpoint']
+fragment_cache = FragmentCache(FRAGMENT_CACHE_BYTES)
+
+# encoding of the images archived to S3, e.g. ".jpg" or ".png"
+IMAGE_FORMAT = os.environ.get("IMAGE_FORMAT", ".jpg")
+JPEG_QUALITY = int(os.environ.get("JPEG_QUALITY", 90))
+CONTENT_TYPES = {".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".png": "image/png", ".webp": "image/webp"}
+
+_kv_client = None
+_endpoints = {}
+_endpoint_lock = threading.Lock()
+
+
+def get_endpoint(arn, ttl=ENDPOINT_TTL):
+    global _kv_client
+    with _endpoint_lock:
+        cached = _endpoints.get(arn)
+        if cached is not None and time.monotonic() - cached[1] < ttl:
+            return cached[0]
+        if _kv_client is None:
+            _kv_client = aws_client('kinesisvideo')
+        response = throttle.call(
+            "kinesisvideo", "GetDataEndpoint", _kv_client.get_data_endpoint,
+            StreamARN=arn,
+            APIName='GET_MEDIA'
+        )
+        endpoint = response['DataEndpoint']
+        _endpoints[arn] = (endpoint, time.monotonic())
+        return endpoint
+
+
+def invalidate_endpoint(arn):
+    with _endpoint_lock:
+        _endpoints.pop(arn, None)
+
+
+def reset_endpoints():
+    global _kv_client
+    with _endpoint_lock:
+        _endpoints.clear()
+        _kv_client = None
 
 
-# TODO: use the offset to extract the correct frame from this payload
 def extract_frame(payload, offset):
-    with open(f'{TMP_DIR}/stream.mkv', 'wb+') as f:
-        streamBody = payload.read(1024 * 128)
-        f.write(streamBody)
-        # use openCV to get a frame
-    cap = cv2.VideoCapture(f'{TMP_DIR}/stream.mkv')
-    succeeded, frame = cap.read()
+    # decode from the keyframe before the offset, straight from the GetMedia stream
+    return extract_frames(payload, [offset])[0]
+
+
+def encode_image(image, image_format=IMAGE_FORMAT, quality=JPEG_QUALITY):
+    params = []
+    if image_format in (".jpg", ".jpeg"):
+        params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+    elif image_format == ".webp":
+        params = [cv2.IMWRITE_WEBP_QUALITY, quality]
+    with metrics.timer("Encode"):
+        succeeded, buffer = cv2.imencode(image_format, image, params)
     if not succeeded:
-        raise RuntimeError("cannot read a frame")
-    return frame
+        raise RuntimeError("cannot encode the image as " + image_format)
+    return buffer.tobytes()
+
+
+def box_array(boxes):
+    # Rekognition BoundingBox dicts to an (N, 4) array of Left, Top, Width, Height ratios
+    return np.array([[b["Left"], b["Top"], b["Width"], b["Height"]] for b in boxes], dtype=np.float64).reshape(-1, 4)
+
+
+def face_regions(boxes, shape, box_ratio=1):
+    """Pixel rows and columns (top, bottom, left, right) of every box grown by box_ratio,
+    clamped to the frame on all four sides."""
+    left, top, width, height = np.asarray(boxes, dtype=np.float64).reshape(-1, 4).T
+    margin = 0.5 * (box_ratio - 1)
+    rows = np.stack([top - margin * height, top + (1 + margin) * height]) * shape[0]
+    columns = np.stack([left - margin * width, left + (1 + margin) * width]) * shape[1]
+    rows = np.clip(rows, 0, shape[0]).astype(np.int64)
+    columns = np.clip(columns, 0, shape[1]).astype(np.int64)
+    return np.stack([rows[0], rows[1], columns[0], columns[1]], axis=1)
+
+
+def extract_faces(image, boxes, box_ratio=1, size=None):
+    """Crops every box of a frame; the crops are views of the frame unless size=(width, height)
+    asks for thumbnails. A box lying outside of the frame gives None."""
+    crops = []
+    for top, bottom, left, right in face_regions(boxes, image.shape, box_ratio).tolist():
+        if bottom <= top or right <= left:
+            crops.append(None)
+            continue
+        crop = image[top:bottom, left:right]
+        if size is not None:
+            crop = cv2.resize(crop, size, interpolation=cv2.INTER_AREA)
+        crops.append(crop)
+    return crops
 
 
 def extract_face(image, box, box_ratio=1):
-    top = int(max(0, box["Top"] - 0.5 * (box_ratio - 1) * box["Height"]) * image.shape[0])
-    left = int(max(0, box["Left"] - 0.5 * (box_ratio - 1) * box["Width"]) * image.shape[1])
-    height = int((box["Height"] * box_ratio) * image.shape[0])
-    width = int((box["Width"] * box_ratio) * image.shape[1])
-    return image[top:top + height, left: left + width]
+    return extract_faces(image, box_array([box]), box_ratio)[0]
 
 
 class KVMediaHandler:
     def __init__(self, arn):
-        self.client = boto3.client(
-            'kinesis-video-media',
-            region_name=env['aws_default_region'],
-            endpoint_url=get_endpoint(arn)
-        )
         self.stream_arn = arn
+        self.endpoint = None
+        self.client = None
+        self.lock = threading.Lock()
 
-    def get_image_from_stream(self, timestamp, offset, selector="PRODUCER_TIMESTAMP"):
+    def get_client(self):
+        endpoint = get_endpoint(self.stream_arn)
+        with self.lock:
+            # the media client is bound to the endpoint, rebuild it when the endpoint moves
+            if self.client is None or endpoint != self.endpoint:
+                self.client = aws_client('kinesis-video-media', endpoint_url=endpoint)
+                self.endpoint = endpoint
+            return self.client
+
+    def get_frames(self, timestamp, offsets, selector="PRODUCER_TIMESTAMP"):
         dt = datetime.fromtimestamp(timestamp)
-        response = self.client.get_media(
-            StreamARN=self.stream_arn,
-            StartSelector={
-                'StartSelectorType': selector,
-                'StartTimestamp': dt
-            }
-        )
-        print('ContentType: ', response["ContentType"])
+        try:
+            response = throttle.call(
+                "kinesis-video-media", "GetMedia", self.get_client().get_media, timer="GetMedia",
+                StreamARN=self.stream_arn,
+                StartSelector={
+                    'StartSelectorType': selector,
+                    'StartTimestamp': dt
+                }
+            )
+        except Exception:
+            # the endpoint may be stale, look it up again on the next call
+            invalidate_endpoint(self.stream_arn)
+            raise
+        logger.debug('ContentType: %s', response["ContentType"])
         payload = response["Payload"]
-        return extract_frame(payload, offset)
+        try:
+            # reading the payload is part of the decode, GetMedia streams it
+            with metrics.timer("FrameDecode"):
+                return extract_frames(payload, offsets)
+        finally:
+            # the rest of the stream is not needed
+            payload.close()
+
+    def get_image_from_stream(self, timestamp, offset, selector="PRODUCER_TIMESTAMP"):
+        return self.get_frames(timestamp, [offset], selector)[0]
+
+    def get_images_from_fragment(self, fragment_number, timestamp, offsets):
+        # all the missing frames of the fragment come from a single GetMedia call
+        key = (self.stream_arn, fragment_number)
+        frames = {offset: fragment_cache.get(key, offset) for offset in offsets}
+        missing = [offset for offset, frame in frames.items() if frame is None]
+        if missing:
+            for offset, frame in zip(missing, self.get_frames(timestamp, missing)):
+                fragment_cache.put(key, offset, frame)
+                frames[offset] = frame
+        return [frames[offset] for offset in offsets]
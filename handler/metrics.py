@@ -0,0 +1,69 @@
+import json
+import threading
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from time import perf_counter, time
+
+# CloudWatch takes at most 100 values per metric in one EMF record
+MAX_VALUES = 100
+
+
+class Metrics:
+    """Timings and counters of one invocation, printed as a single CloudWatch embedded metric line."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.values = defaultdict(list)
+            self.counts = Counter()
+            self.units = {}
+
+    @contextmanager
+    def timer(self, name):
+        # the calls are counted along with the time spent, e.g. S3Put and S3PutCalls
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, (perf_counter() - start) * 1000, "Milliseconds")
+            self.count(name + "Calls")
+
+    def record(self, name, value, unit="None"):
+        with self.lock:
+            values = self.values[name]
+            if len(values) < MAX_VALUES:
+                values.append(round(value, 3))
+            self.units[name] = unit
+
+    def count(self, name, value=1, unit="Count"):
+        with self.lock:
+            self.counts[name] += value
+            self.units[name] = unit
+
+    def snapshot(self):
+        with self.lock:
+            return {**{k: list(v) for k, v in self.values.items()}, **self.counts}
+
+    def emf(self, namespace, dimensions):
+        metrics = self.snapshot()
+        with self.lock:
+            definitions = [{"Name": name, "Unit": self.units[name]} for name in sorted(metrics)]
+        record = {
+            "_aws": {
+                "Timestamp": int(time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": namespace,
+                    "Dimensions": [sorted(dimensions)],
+                    "Metrics": definitions,
+                }],
+            },
+        }
+        record.update(dimensions)
+        record.update(metrics)
+        return json.dumps(record, separators=(",", ":"))
+
+
+metrics = Metrics()
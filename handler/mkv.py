@@ -0,0 +1,282 @@
+import io
+import os
+import tempfile
+from collections import namedtuple
+from functools import lru_cache
+
+from handler.metrics import metrics
+from util import LazyModule
+
+cv2 = LazyModule("cv2")
+
+# Matroska element ids, kept with their length marker as in the spec
+EBML = 0x1A45DFA3
+SEGMENT = 0x18538067
+INFO = 0x1549A966
+TIMECODE_SCALE = 0x2AD7B1
+TRACKS = 0x1654AE6B
+TRACK_ENTRY = 0xAE
+TRACK_NUMBER = 0xD7
+TRACK_TYPE = 0x83
+CLUSTER = 0x1F43B675
+TIMECODE = 0xE7
+SIMPLE_BLOCK = 0xA3
+BLOCK_GROUP = 0xA0
+BLOCK = 0xA1
+REFERENCE_BLOCK = 0xFB
+
+UNKNOWN_SIZE = -1
+VIDEO_TRACK = 1
+DEFAULT_TIMECODE_SCALE = 1000000
+
+# raw is the whole element (id + size + payload) so it can be written back as is
+Block = namedtuple("Block", ["time", "keyframe", "cluster_timecode", "raw"])
+
+
+def encode_id(element_id):
+    return element_id.to_bytes((element_id.bit_length() + 7) // 8, "big")
+
+
+def encode_size(size):
+    length = 1
+    while size >= (1 << (7 * length)) - 1:
+        length += 1
+    return (size | (1 << (7 * length))).to_bytes(length, "big")
+
+
+def element(element_id, payload):
+    return encode_id(element_id) + encode_size(len(payload)) + payload
+
+
+def uint_element(element_id, value):
+    return element(element_id, value.to_bytes(max(1, (value.bit_length() + 7) // 8), "big"))
+
+
+def _vint_length(first):
+    for length in range(8):
+        if first & (0x80 >> length):
+            return length + 1
+    raise ValueError("invalid EBML variable size integer")
+
+
+def parse_vint(data, pos=0):
+    length = _vint_length(data[pos])
+    value = int.from_bytes(data[pos:pos + length], "big") & ((1 << (7 * length)) - 1)
+    return value, pos + length
+
+
+def iter_elements(data):
+    pos = 0
+    while pos < len(data):
+        element_id_length = _vint_length(data[pos])
+        element_id = int.from_bytes(data[pos:pos + element_id_length], "big")
+        size, start = parse_vint(data, pos + element_id_length)
+        yield element_id, data[start:start + size]
+        pos = start + size
+
+
+class MkvReader:
+    """Reads a Matroska stream element by element, never more than the frames asked for."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.bytes_read = 0
+        self.header = b""
+        self.info = b""
+        self.tracks = b""
+        self.timecode_scale = DEFAULT_TIMECODE_SCALE
+        self.video_track = None
+        self.cluster_timecode = 0
+
+    def read(self, size):
+        chunks = []
+        remaining = size
+        while remaining > 0:
+            chunk = self.stream.read(remaining)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        data = b"".join(chunks)
+        self.bytes_read += len(data)
+        return data
+
+    def read_vint(self, keep_marker):
+        first = self.read(1)
+        if not first:
+            return None, b""
+        length = _vint_length(first[0])
+        raw = first + self.read(length - 1)
+        if len(raw) < length:
+            raise EOFError("truncated EBML element")
+        value = int.from_bytes(raw, "big")
+        if not keep_marker:
+            value &= (1 << (7 * length)) - 1
+            if value == (1 << (7 * length)) - 1:
+                value = UNKNOWN_SIZE
+        return value, raw
+
+    def read_payload(self, size):
+        if size == UNKNOWN_SIZE:
+            raise ValueError("unknown size is only supported for Segment and Cluster")
+        payload = self.read(size)
+        if len(payload) < size:
+            raise EOFError("truncated EBML element")
+        return payload
+
+    def parse_tracks(self, payload):
+        for element_id, entry in iter_elements(payload):
+            if element_id != TRACK_ENTRY:
+                continue
+            fields = dict(iter_elements(entry))
+            if int.from_bytes(fields.get(TRACK_TYPE, b""), "big") == VIDEO_TRACK:
+                self.video_track = int.from_bytes(fields[TRACK_NUMBER], "big")
+                return
+
+    def parse_block(self, raw, payload, keyframe=None):
+        track, pos = parse_vint(payload)
+        relative = int.from_bytes(payload[pos:pos + 2], "big", signed=True)
+        if keyframe is None:
+            keyframe = bool(payload[pos + 2] & 0x80)
+        if self.video_track is not None and track != self.video_track:
+            return None
+        ticks = self.cluster_timecode + relative
+        return Block(ticks * self.timecode_scale / 1e9, keyframe, self.cluster_timecode, raw)
+
+    def blocks(self):
+        # Segment and Cluster are entered rather than skipped, so the stream is
+        # walked as a flat list of elements and unknown sizes need no special care.
+        # GetMedia sends one EBML document per fragment, only the first header is kept.
+        while True:
+            element_id, id_raw = self.read_vint(keep_marker=True)
+            if element_id is None:
+                return
+            size, size_raw = self.read_vint(keep_marker=False)
+            if element_id in (SEGMENT, CLUSTER):
+                continue
+            payload = self.read_payload(size)
+            raw = id_raw + size_raw + payload
+            if element_id == EBML:
+                if not self.header:
+                    self.header = raw
+            elif element_id == INFO:
+                if not self.info:
+                    self.info = raw
+                    scale = dict(iter_elements(payload)).get(TIMECODE_SCALE)
+                    if scale:
+                        self.timecode_scale = int.from_bytes(scale, "big")
+            elif element_id == TRACKS:
+                if not self.tracks:
+                    self.tracks = raw
+                    self.parse_tracks(payload)
+            elif element_id == TIMECODE:
+                self.cluster_timecode = int.from_bytes(payload, "big")
+            elif element_id == SIMPLE_BLOCK:
+                block = self.parse_block(raw, payload)
+                if block is not None:
+                    yield block
+            elif element_id == BLOCK_GROUP:
+                children = dict(iter_elements(payload))
+                if BLOCK in children:
+                    block = self.parse_block(raw, children[BLOCK], keyframe=REFERENCE_BLOCK not in children)
+                    if block is not None:
+                        yield block
+
+
+def select_blocks(reader, offsets):
+    """Returns the blocks from the keyframe before the first offset up to the last one,
+    and for every offset the index of the nearest block."""
+    targets = sorted(set(offsets))
+    chosen = {}
+    kept = []
+    start = None
+    for block in reader.blocks():
+        if start is None:
+            # offsets are relative to the start of the fragment
+            start = block.time
+        while len(chosen) < len(targets):
+            target = start + targets[len(chosen)]
+            if block.time < target:
+                break
+            if kept and target - kept[-1].time <= block.time - target:
+                chosen[targets[len(chosen)]] = len(kept) - 1
+            else:
+                chosen[targets[len(chosen)]] = None
+        if len(chosen) == len(targets) and None not in chosen.values():
+            break
+        # restart at every keyframe until a frame before it is needed
+        if block.keyframe and all(v is None for v in chosen.values()):
+            kept = []
+        kept.append(block)
+        for target, index in chosen.items():
+            if index is None:
+                chosen[target] = len(kept) - 1
+        if len(chosen) == len(targets):
+            break
+
+    if not kept:
+        raise RuntimeError("cannot read a frame")
+    # the payload ended before the offset, fall back to the last frame we have
+    for target in targets:
+        if target not in chosen:
+            chosen[target] = len(kept) - 1
+    return kept, [chosen[offset] for offset in offsets]
+
+
+def build_mkv(reader, blocks):
+    clusters = []
+    cluster_timecode = None
+    for block in blocks:
+        if block.cluster_timecode != cluster_timecode:
+            cluster_timecode = block.cluster_timecode
+            clusters.append([uint_element(TIMECODE, cluster_timecode)])
+        clusters[-1].append(block.raw)
+    segment = reader.info + reader.tracks + b"".join(element(CLUSTER, b"".join(c)) for c in clusters)
+    return reader.header + element(SEGMENT, segment)
+
+
+@lru_cache(maxsize=None)
+def reads_streams():
+    # VideoCapture reads from a Python stream from OpenCV 4.11 on; checked on the first decode, not at import,
+    # so a batch without faces still never loads cv2
+    major, minor = (int(v) for v in cv2.__version__.split(".")[:2])
+    return (major, minor) >= (4, 11)
+
+
+def decode_frames(data, count):
+    if reads_streams():
+        # keep a reference to the stream, the capture does not hold one
+        stream = io.BytesIO(data)
+        return read_frames(cv2.VideoCapture(stream, cv2.CAP_FFMPEG, []), count)
+    # older builds only open files, each call gets its own since fragments are decoded concurrently
+    fd, path = tempfile.mkstemp(suffix=".mkv")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+        return read_frames(cv2.VideoCapture(path, cv2.CAP_FFMPEG), count)
+    finally:
+        os.remove(path)
+
+
+def read_frames(cap, count):
+    frames = []
+    try:
+        # no B-frames in the camera stream, so frames come out in block order
+        while len(frames) < count:
+            succeeded, frame = cap.read()
+            if not succeeded:
+                break
+            frames.append(frame)
+    finally:
+        cap.release()
+    return frames
+
+
+def extract_frames(payload, offsets):
+    reader = MkvReader(payload)
+    blocks, indexes = select_blocks(reader, offsets)
+    metrics.count("MediaBytes", reader.bytes_read, "Bytes")
+    frames = decode_frames(build_mkv(reader, blocks), max(indexes) + 1)
+    if len(frames) <= max(indexes):
+        raise RuntimeError("cannot read a frame")
+    return [frames[i] for i in indexes]
@@ -0,0 +1,49 @@
+import threading
+from collections import Counter
+
+from handler.metrics import metrics
+from util import LazyModule
+
+cv2 = LazyModule("cv2")
+
+
+class QualityGate:
+    """Rejects faces that Rekognition's QualityFilter would drop anyway, before paying for the call.
+
+    A threshold of 0 or None turns its check off.
+    """
+
+    def __init__(self, min_size=40, min_brightness=40, max_brightness=220, min_sharpness=20):
+        self.min_size = min_size
+        self.min_brightness = min_brightness
+        self.max_brightness = max_brightness
+        self.min_sharpness = min_sharpness
+        self.counts = Counter()
+        self.lock = threading.Lock()
+
+    def reason(self, face_image, face_size):
+        # cheapest checks first, face_size is the shorter side of the detected box in pixels
+        if self.min_size and face_size < self.min_size:
+            return "too_small"
+        gray = cv2.cvtColor(face_image, cv2.COLOR_BGR2GRAY) if face_image.ndim == 3 else face_image
+        brightness = gray.mean()
+        if self.min_brightness and brightness < self.min_brightness:
+            return "too_dark"
+        if self.max_brightness and brightness > self.max_brightness:
+            return "too_bright"
+        # variance of the Laplacian drops on a blurry image
+        if self.min_sharpness and cv2.Laplacian(gray, cv2.CV_64F).var() < self.min_sharpness:
+            return "too_blurry"
+        return None
+
+    def accept(self, face_image, face_size):
+        reason = self.reason(face_image, face_size)
+        with self.lock:
+            self.counts[reason or "accepted"] += 1
+        if reason is not None:
+            metrics.count("QualityRejected_" + reason)
+        return reason is None
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts)
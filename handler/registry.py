@@ -0,0 +1,21 @@
+import threading
+
+# handlers (and their boto3 clients) live as long as the Lambda container,
+# so warm invocations skip the client construction
+_handlers = {}
+_lock = threading.Lock()
+
+
+def get_handler(cls, *args):
+    key = (cls, args)
+    with _lock:
+        handler = _handlers.get(key)
+        if handler is None:
+            handler = cls(*args)
+            _handlers[key] = handler
+        return handler
+
+
+def reset():
+    with _lock:
+        _handlers.clear()
@@ -1,18 +1,23 @@
-import boto3
+from botocore.exceptions import ClientError
 
-from util import yaml_handler
+from handler import throttle
+from handler.metrics import metrics
+from util import aws_client, load_env, not_found
 
-env = yaml_handler('./aws_env.yaml')
+
+def build_image(bucket=None, image=None, image_bytes=None):
+    # encoded bytes skip the S3 round trip, they are limited to 5 MB by Rekognition
+    if image_bytes is not None:
+        metrics.count("RekognitionBytes", len(image_bytes), "Bytes")
+        return {'Bytes': image_bytes}
+    return {'S3Object': {'Bucket': bucket, 'Name': image}}
 
 
 class RekoHanlder:
     def __init__(self, collection_id, stream_processor_name):
         self.collection_id = collection_id
         self.stream_processor_name = stream_processor_name
-        self.client = boto3.client(
-            'rekognition',
-            region_name=env['aws_default_region']
-        )
+        self.client = aws_client('rekognition')
 
     def create_collection(self):
         try:
@@ -45,7 +50,7 @@ class RekoHanlder:
                         'FaceMatchThreshold': match_threshold
                     }
                 },
-                RoleArn=env["arn_recognition"]
+                RoleArn=load_env()["arn_recognition"]
             )
             print('Done...')
         except Exception as e:
@@ -95,11 +100,32 @@ class RekoHanlder:
             print(e)
         print("")
 
-    def index_faces(self, bucket, image):
-        response = self.client.index_faces(CollectionId=self.collection_id,
-                                           Image={'S3Object': {'Bucket': bucket, 'Name': image}},
-                                           MaxFaces=10,
-                                           QualityFilter="AUTO",
-                                           DetectionAttributes=['ALL'])
+    def query_status(self):
+        try:
+            response = self.client.describe_stream_processor(Name=self.stream_processor_name)
+        except ClientError as e:
+            if not_found(e):
+                return None
+            raise
+        return response["Status"]
+
+    def index_faces(self, bucket=None, image=None, image_bytes=None, max_faces=10):
+        response = throttle.call("rekognition", "IndexFaces", self.client.index_faces, timer="IndexFaces",
+                                 CollectionId=self.collection_id,
+                                 Image=build_image(bucket, image, image_bytes),
+                                 MaxFaces=max_faces,
+                                 QualityFilter="AUTO",
+                                 DetectionAttributes=['ALL'])
 
         return [record["Face"] for record in response["FaceRecords"]]
+
+    def search_faces_by_image(self, bucket=None, image=None, image_bytes=None, match_threshold=80, max_faces=1):
+        response = throttle.call("rekognition", "SearchFacesByImage", self.client.search_faces_by_image,
+                                 timer="SearchFacesByImage",
+                                 CollectionId=self.collection_id,
+                                 Image=build_image(bucket, image, image_bytes),
+                                 MaxFaces=max_faces,
+                                 FaceMatchThreshold=match_threshold,
+                                 QualityFilter="AUTO")
+
+        return response["FaceMatches"]
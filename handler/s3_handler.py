@@ -1,17 +1,29 @@
-import boto3
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from time import perf_counter
 
-from util import yaml_handler
+from botocore.exceptions import ClientError
 
-env = yaml_handler('./aws_env.yaml')
+from handler import throttle
+from handler.metrics import metrics
+from pipeline import Stage
+from util import aws_client, not_found
+
+# keys per DeleteObjects request, the most S3 takes
+DELETE_BATCH = 1000
+# DeleteObjects requests in flight while emptying a bucket
+DELETE_WORKERS = 8
+# keys remembered as stored by upload_bytes(skip_existing=True), saving the HEAD request
+STORED_KEYS = 10000
 
 
 class S3Handler:
     def __init__(self, bucket):
-        self.client = boto3.client(
-            's3',
-            region_name=env['aws_default_region']
-        )
+        self.client = aws_client('s3')
         self.bucket_name = bucket
+        self.stored = OrderedDict()
+        self.lock = threading.Lock()
 
     def create(self):
         print("Creating S3: ", self.bucket_name)
@@ -40,20 +52,145 @@ class S3Handler:
             print(e)
         print("")
 
-    def empty(self):
+    def exists(self):
+        try:
+            self.client.head_bucket(Bucket=self.bucket_name)
+        except ClientError as e:
+            if not_found(e):
+                return False
+            raise
+        return True
+
+    def versioned(self):
+        # a suspended bucket still holds the versions written before
+        status = self.client.get_bucket_versioning(Bucket=self.bucket_name).get("Status")
+        return status in ("Enabled", "Suspended")
+
+    def scan(self, prefix="", versions=False):
+        """Yields every object under prefix page by page, with its versions and delete markers if asked."""
+        request = {"Bucket": self.bucket_name, "Prefix": prefix}
+        while True:
+            if versions:
+                response = self.client.list_object_versions(**request)
+                for entry in response.get("Versions", []) + response.get("DeleteMarkers", []):
+                    yield {"Key": entry["Key"], "VersionId": entry["VersionId"], "LastModified": entry["LastModified"]}
+                if not response.get("IsTruncated"):
+                    return
+                request.update(KeyMarker=response["NextKeyMarker"], VersionIdMarker=response["NextVersionIdMarker"])
+            else:
+                response = self.client.list_objects_v2(**request)
+                for entry in response.get("Contents", []):
+                    yield {"Key": entry["Key"], "LastModified": entry["LastModified"]}
+                if not response.get("IsTruncated"):
+                    return
+                request["ContinuationToken"] = response["NextContinuationToken"]
+
+    def delete_objects(self, objects):
+        # returns the objects S3 could not delete
+        response = throttle.call("s3", "DeleteObjects", self.client.delete_objects,
+                                 Bucket=self.bucket_name, Delete={"Objects": objects, "Quiet": True})
+        return response.get("Errors", [])
+
+    def empty(self, prefix="", older_than=None, workers=DELETE_WORKERS, report_every=10.0):
+        """Deletes the objects under prefix, every version and delete marker included; with older_than
+        (seconds), only those last modified before. Returns the number of deleted objects."""
         print("Emptying S3: ", self.bucket_name)
         try:
-            s3 = boto3.resource(
-                's3',
-                region_name=env['aws_default_region']
-            )
-            bucket = s3.Bucket(self.bucket_name)
-            # suggested by Jordon Philips
-            bucket.objects.all().delete()
-            print('Done...')
-        except Exception as e:
-            print(e)
+            versions = self.versioned()
+        except ClientError as e:
+            if not_found(e):
+                print(e)
+                return 0
+            raise
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=older_than) if older_than is not None else None
+        progress = {"deleted": 0, "errors": []}
+        lock = threading.Lock()
+
+        def done(count, future):
+            # a request that failed as a whole is raised below
+            if future.exception() is None:
+                with lock:
+                    progress["deleted"] += count - len(future.result())
+                    progress["errors"] += future.result()
+
+        def submit(batch):
+            futures.append(stage.submit(self.delete_objects, batch))
+            futures[-1].add_done_callback(lambda future: done(len(batch), future))
+
+        # the scan runs ahead of the deletes by at most one batch per worker
+        stage = Stage("delete", workers)
+        futures = []
+        start = reported = perf_counter()
+        try:
+            batch = []
+            for entry in self.scan(prefix, versions):
+                if cutoff is not None and entry["LastModified"] >= cutoff:
+                    continue
+                batch.append({k: entry[k] for k in ("Key", "VersionId") if k in entry})
+                if len(batch) == DELETE_BATCH:
+                    submit(batch)
+                    batch = []
+                if perf_counter() - reported > report_every:
+                    reported = perf_counter()
+                    print(f"Deleted {progress['deleted']} objects, {progress['deleted'] / (reported - start):.0f}/s")
+            if batch:
+                submit(batch)
+        finally:
+            stage.shutdown()
+        for future in futures:
+            future.result()
+        elapsed = perf_counter() - start
+        print(f"Deleted {progress['deleted']} objects in {elapsed:.1f}s, {progress['deleted'] / max(elapsed, 1e-6):.0f}/s")
+        if progress["errors"]:
+            error = progress["errors"][0]
+            raise RuntimeError(f"{len(progress['errors'])} objects not deleted from {self.bucket_name}, "
+                               f"first {error['Key']}: {error['Code']}")
         print("")
+        return progress["deleted"]
+
+    def presign(self, photos, expires_in=3600):
+        # signed locally with the credentials of the client, no request goes to S3
+        return [self.client.generate_presigned_url("get_object", Params={"Bucket": p["bucket"], "Key": p["objectKey"]},
+                                                   ExpiresIn=expires_in)
+                for p in photos]
 
     def upload(self, filename, key):
-        self.client.upload_file(filename, self.bucket_name, key)
+        throttle.call("s3", "PutObject", self.client.upload_file, filename, self.bucket_name, key)
+
+    def stored_before(self, key):
+        with self.lock:
+            if key in self.stored:
+                self.stored.move_to_end(key)
+                return True
+        try:
+            throttle.call("s3", "HeadObject", self.client.head_object, Bucket=self.bucket_name, Key=key)
+        except ClientError as e:
+            if not_found(e):
+                return False
+            raise
+        self.remember(key)
+        return True
+
+    def remember(self, key):
+        with self.lock:
+            self.stored[key] = True
+            self.stored.move_to_end(key)
+            if len(self.stored) > STORED_KEYS:
+                self.stored.popitem(last=False)
+
+    def upload_bytes(self, data, key, content_type="image/jpeg", skip_existing=False):
+        """Uploads data under key; with skip_existing, a key already stored is left as it is and False returned."""
+        if skip_existing and self.stored_before(key):
+            metrics.count("S3Deduplicated")
+            return False
+        throttle.call(
+            "s3", "PutObject", self.client.put_object, timer="S3Put",
+            Bucket=self.bucket_name,
+            Key=key,
+            Body=data,
+            ContentType=content_type
+        )
+        metrics.count("S3Bytes", len(data), "Bytes")
+        if skip_existing:
+            self.remember(key)
+        return True
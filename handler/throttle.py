@@ -0,0 +1,200 @@
+import os
+import random
+import threading
+from time import monotonic, sleep
+
+from botocore.exceptions import ClientError
+
+from handler.metrics import metrics
+
+# error codes AWS answers with when a caller goes over its rate
+THROTTLING_ERRORS = {
+    "ThrottlingException",
+    "Throttling",
+    "ProvisionedThroughputExceededException",
+    "RequestLimitExceeded",
+    "TooManyRequestsException",
+    "ClientLimitExceededException",
+    "ConnectionLimitExceededException",
+    "SlowDown",
+}
+
+# calls (or DynamoDB write units) per second an operation starts at and never goes above,
+# RATE_<SERVICE>_<OPERATION> overrides one, e.g. RATE_REKOGNITION_INDEXFACES=50
+DEFAULT_RATES = {
+    ("rekognition", "IndexFaces"): 5,
+    ("rekognition", "SearchFacesByImage"): 5,
+    ("kinesisvideo", "GetDataEndpoint"): 5,
+    ("kinesis-video-media", "GetMedia"): 5,
+    ("s3", "PutObject"): 3500,
+    # the 25 WCU and RCU DynamoHandler.create provisions
+    ("dynamodb", "Write"): 25,
+    ("dynamodb", "Read"): 25,
+}
+# an operation missing from DEFAULT_RATES
+DEFAULT_RATE = 50
+# THROTTLE=off only keeps the retries, for benchmarks against fakes
+ENABLED = os.environ.get("THROTTLE", "on") != "off"
+# share of the rate kept after a throttling error, and added back by every success
+DECREASE = 0.5
+INCREASE = 0.02
+MIN_RATE = 0.5
+# attempts of one call, and retries of a whole invocation
+MAX_ATTEMPTS = 8
+RETRY_BUDGET = int(os.environ.get("RETRY_BUDGET", 100))
+BASE_DELAY = 0.05
+MAX_DELAY = 2.0
+
+
+class DeadlineExceeded(Exception):
+    """A call would have to wait for the rate limit past the deadline of the invocation.
+
+    Raised rather than waiting into the Lambda timeout: the record fails like any other error
+    and is read again, where a timeout would also lose the metrics and the writes already buffered.
+    """
+
+
+class TokenBucket:
+    """Rate of one operation, shared by every thread; halved on throttling, grown back on success."""
+
+    def __init__(self, rate, burst=None):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self.tokens = self.burst
+        self.updated = monotonic()
+        self.decreased = 0.0
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, cost=1, deadline=None):
+        """Takes cost tokens, waiting for them if needed; returns the seconds waited."""
+        with self.lock:
+            now = monotonic()
+            self.refill(now)
+            # a cost above the burst would never fit, it is let through on a full bucket
+            needed = min(cost, self.burst)
+            if self.tokens >= needed:
+                self.tokens -= cost
+                return 0.0
+            delay = (needed - self.tokens) / self.rate
+            if deadline is not None and now + delay > deadline:
+                raise DeadlineExceeded("no time left to wait for the rate limit")
+            # taken now, so the threads waiting behind get in line after this one
+            self.tokens -= cost
+        sleep(delay)
+        return delay
+
+    def on_throttle(self):
+        with self.lock:
+            now = monotonic()
+            # concurrent calls throttled by the same burst only count once
+            if now - self.decreased < 1.0 / self.rate:
+                return
+            self.decreased = now
+            self.rate = max(MIN_RATE, self.rate * DECREASE)
+            self.tokens = min(self.tokens, 0)
+
+    def on_success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * INCREASE)
+
+
+class Budget:
+    """What one invocation may still spend on retries: a deadline and a number of retries."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self, seconds=None, retries=None):
+        with self.lock:
+            self.deadline = monotonic() + seconds if seconds is not None else None
+            self.retries = RETRY_BUDGET if retries is None else retries
+
+    def expired(self):
+        return self.deadline is not None and monotonic() >= self.deadline
+
+    def take_retry(self, delay):
+        with self.lock:
+            if self.retries <= 0:
+                return False
+            if self.deadline is not None and monotonic() + delay > self.deadline:
+                return False
+            self.retries -= 1
+            return True
+
+
+budget = Budget()
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def limiter(service, operation):
+    with _buckets_lock:
+        bucket = _buckets.get((service, operation))
+        if bucket is None:
+            variable = "RATE_" + (service + "_" + operation).upper().replace("-", "_")
+            rate = float(os.environ.get(variable, DEFAULT_RATES.get((service, operation), DEFAULT_RATE)))
+            bucket = _buckets[(service, operation)] = TokenBucket(rate)
+        return bucket
+
+
+def reset():
+    with _buckets_lock:
+        _buckets.clear()
+    budget.reset()
+
+
+def error_code(error):
+    return error.response.get("Error", {}).get("Code")
+
+
+def backoff(service, operation, attempt, error):
+    """Waits before the next attempt, or raises error when the attempts, the budget or the deadline are spent."""
+    delay = random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** attempt))
+    if attempt + 1 >= MAX_ATTEMPTS or not budget.take_retry(delay):
+        raise error
+    metrics.count("Retries")
+    metrics.count("RetryWait", delay * 1000, "Milliseconds")
+    sleep(delay)
+
+
+def throttled(service, operation):
+    metrics.count("Throttles")
+    metrics.count(operation + "Throttles")
+    limiter(service, operation).on_throttle()
+
+
+def call(service, operation, function, *args, cost=1, retryable=(), timer=None, **kwargs):
+    """Calls function under the rate of service/operation, retrying throttling errors (and `retryable` codes,
+    or the errors for which `retryable(error)` is true) with jittered backoff while the invocation has budget left.
+
+    `timer` names the metric every attempt is timed under; the waits are counted apart, as ThrottleWait and RetryWait.
+    """
+    bucket = limiter(service, operation)
+    attempt = 0
+    while True:
+        waited = bucket.acquire(cost, budget.deadline) if ENABLED else 0
+        if waited:
+            metrics.count("ThrottleWait", waited * 1000, "Milliseconds")
+        try:
+            if timer is None:
+                result = function(*args, **kwargs)
+            else:
+                with metrics.timer(timer):
+                    result = function(*args, **kwargs)
+        except ClientError as e:
+            code = error_code(e)
+            if code in THROTTLING_ERRORS:
+                throttled(service, operation)
+            elif not (retryable(e) if callable(retryable) else code in retryable):
+                raise
+            backoff(service, operation, attempt, e)
+            attempt += 1
+            continue
+        bucket.on_success()
+        return result
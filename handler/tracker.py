@@ -0,0 +1,134 @@
+import os
+import threading
+
+from handler.kv_media_handler import box_array
+from handler.metrics import metrics
+from util import LazyModule
+
+np = LazyModule("numpy")
+
+# seconds of video a track lives on without a detection, 0 turns tracking off
+TRACK_TTL = float(os.environ.get("TRACK_TTL", 2))
+# overlap a detection needs with the last box of a track to continue it
+MIN_IOU = float(os.environ.get("TRACK_MIN_IOU", 0.3))
+# mean landmark distance, in widths of the detected face, above which an overlapping face is someone else
+MAX_LANDMARK_DISTANCE = float(os.environ.get("TRACK_MAX_LANDMARK_DISTANCE", 0.25))
+# tracks kept per stream, the oldest are dropped first
+MAX_TRACKS = 100
+LANDMARKS = ("eyeLeft", "eyeRight", "nose", "mouthLeft", "mouthRight")
+
+
+def iou(boxes, others):
+    """(M, N) intersection over union of (M, 4) and (N, 4) arrays of Left, Top, Width, Height."""
+    a, b = boxes[:, None, :], others[None, :, :]
+    width = np.minimum(a[..., 0] + a[..., 2], b[..., 0] + b[..., 2]) - np.maximum(a[..., 0], b[..., 0])
+    height = np.minimum(a[..., 1] + a[..., 3], b[..., 1] + b[..., 3]) - np.maximum(a[..., 1], b[..., 1])
+    intersection = np.clip(width, 0, None) * np.clip(height, 0, None)
+    union = a[..., 2] * a[..., 3] + b[..., 2] * b[..., 3] - intersection
+    return np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+
+
+def landmark_array(detected_faces):
+    # (N, len(LANDMARKS), 2) X, Y ratios, NaN for a landmark Rekognition left out
+    landmarks = np.full((len(detected_faces), len(LANDMARKS), 2), np.nan)
+    for n, detected_face in enumerate(detected_faces):
+        for landmark in detected_face.get("Landmarks", []):
+            if landmark["Type"] in LANDMARKS:
+                landmarks[n, LANDMARKS.index(landmark["Type"])] = landmark["X"], landmark["Y"]
+    return landmarks
+
+
+def landmark_distance(landmarks, others, widths):
+    """(M, N) mean distance of the landmarks both faces have, in `widths` of the N others; 0 when none is shared."""
+    distances = np.linalg.norm(landmarks[:, None] - others[None, :], axis=-1)
+    shared = ~np.isnan(distances)
+    total = np.where(shared, distances, 0).sum(axis=-1)
+    count = shared.sum(axis=-1)
+    mean = np.divide(total, count, out=np.zeros_like(total), where=count > 0)
+    return np.divide(mean, widths[None, :], out=np.zeros_like(mean), where=widths[None, :] > 0)
+
+
+class Track:
+    """One face followed from frame to frame, and the FaceId all its detections share."""
+
+    def __init__(self, box, landmarks, seen):
+        self.box = box
+        self.landmarks = landmarks
+        self.seen = seen
+        self.face_id = None
+        self.lock = threading.Lock()
+
+    def move(self, box, landmarks, seen):
+        self.box = box
+        self.landmarks = landmarks
+        self.seen = max(self.seen, seen)
+
+    def found(self, face_id):
+        # a face the stream processor matched names its track
+        with self.lock:
+            if self.face_id is None:
+                self.face_id = face_id
+
+    def identify(self, index):
+        """The FaceId of the track; index() is only called while the track has none, so the first
+        detection to get here is the one indexed and the others wait for its FaceId."""
+        with self.lock:
+            if self.face_id is not None:
+                metrics.count("TrackedFaces")
+                return self.face_id
+            self.face_id = index()
+            return self.face_id
+
+
+class FaceTracker:
+    """Associates the faces of the records of each stream with the faces of the records before them.
+
+    A detection continues the track whose last box it overlaps most, if the overlap reaches min_iou and
+    the landmarks are close enough; a track without a detection for ttl seconds of video is over.
+    """
+
+    def __init__(self, ttl=TRACK_TTL, min_iou=MIN_IOU, max_landmark_distance=MAX_LANDMARK_DISTANCE):
+        self.ttl = ttl
+        self.min_iou = min_iou
+        self.max_landmark_distance = max_landmark_distance
+        # stream ARN -> tracks, oldest first
+        self.streams = {}
+        self.lock = threading.Lock()
+
+    def update(self, face_recognition_record):
+        """The Track of every face of the record, in the order of its FaceSearchResponse."""
+        kinesis_video = face_recognition_record["InputInformation"]["KinesisVideo"]
+        now = kinesis_video["ProducerTimestamp"] + kinesis_video["FrameOffsetInSeconds"]
+        detected_faces = [f["DetectedFace"] for f in face_recognition_record["FaceSearchResponse"]]
+        boxes = box_array(d["BoundingBox"] for d in detected_faces)
+        landmarks = landmark_array(detected_faces)
+
+        with self.lock:
+            # records come in capture order, a record read again may be a little older than its track
+            tracks = [t for t in self.streams.get(kinesis_video["StreamArn"], []) if abs(now - t.seen) <= self.ttl]
+            assigned = [None] * len(detected_faces)
+            if tracks and detected_faces:
+                scores = iou(np.array([t.box for t in tracks]), boxes)
+                distances = landmark_distance(np.array([t.landmarks for t in tracks]), landmarks, boxes[:, 2])
+                scores[(scores < self.min_iou) | (distances > self.max_landmark_distance)] = 0
+                # the best overlap first, each track and each detection is used once
+                while True:
+                    t, d = np.unravel_index(np.argmax(scores), scores.shape)
+                    if scores[t, d] <= 0:
+                        break
+                    assigned[d] = tracks[t]
+                    scores[t, :] = 0
+                    scores[:, d] = 0
+            for d, track in enumerate(assigned):
+                if track is None:
+                    assigned[d] = Track(boxes[d], landmarks[d], now)
+                    tracks.append(assigned[d])
+                    metrics.count("Tracks")
+                else:
+                    track.move(boxes[d], landmarks[d], now)
+            self.streams[kinesis_video["StreamArn"]] = tracks[-MAX_TRACKS:]
+        return assigned
+
+    def clear(self):
+        with self.lock:
+            self.streams.clear()
@@ -1,21 +1,77 @@
 import json
+import logging
+import os
+
 from base64 import b64decode
+from collections import OrderedDict
+from time import perf_counter
 
 import sys
 
 sys.path.insert(0, '/opt/python')
-import cv2
 
+from handler import keys, throttle
+from handler.dead_letter import DeadLetters
+from handler.dedup import FaceSampler, face_score
 from handler.dynamo_handler import DynamoHandler
-from handler.kv_media_handler import KVMediaHandler, extract_face, TMP_DIR
+from handler.kv_media_handler import KVMediaHandler, box_array, extract_faces, encode_image, IMAGE_FORMAT, CONTENT_TYPES
+from handler.metrics import metrics
+from handler.quality import QualityGate
 from handler.reko_handler import RekoHanlder
+from handler.registry import get_handler
 from handler.s3_handler import S3Handler
+from handler.tracker import TRACK_TTL, FaceTracker
+from pipeline import Pipeline
+from util import LazyModule
+
+cv2 = LazyModule("cv2")
 
 collection_id = 'Faces'
 stream_processor_name = 'FaceDetect'
 bucket = "visitor-images"
 db_name = "visitors"
 
+# face records going through the pipeline at once, a larger batch takes several passes; the BatchSize
+# of the event source mapping is what bounds the work of one invocation
+MAX_RECORDS = int(os.environ.get("MAX_RECORDS", 100))
+# number of fragments fetched and decoded at the same time
+MAX_WORKERS = int(os.environ.get("MAX_WORKERS", 4))
+# faces cropped, encoded and sent to Rekognition at the same time
+FACE_WORKERS = int(os.environ.get("FACE_WORKERS", 8))
+# S3 uploads in flight
+UPLOAD_WORKERS = int(os.environ.get("UPLOAD_WORKERS", 16))
+# optional "WIDTHxHEIGHT" every face crop is resized to, e.g. "160x160"
+FACE_SIZE = tuple(int(v) for v in os.environ["FACE_SIZE"].split("x")) if os.environ.get("FACE_SIZE") else None
+# faces under these thresholds are dropped before any AWS call, 0 turns a check off
+QUALITY = (
+    int(os.environ.get("MIN_FACE_PIXELS", 40)),
+    float(os.environ.get("MIN_BRIGHTNESS", 40)),
+    float(os.environ.get("MAX_BRIGHTNESS", 220)),
+    float(os.environ.get("MIN_SHARPNESS", 20)),
+)
+# how the full frame is archived: "sync", "background" or "off" to keep only the face crops
+ARCHIVE_FRAME = os.environ.get("ARCHIVE_FRAME", "background")
+# similarity above which a face matched by the stream processor is not indexed again
+MATCH_THRESHOLD = float(os.environ.get("MATCH_THRESHOLD", 80))
+# seconds of video between two archived photos of the same face, 0 keeps every photo
+MIN_INTERVAL = float(os.environ.get("MIN_INTERVAL", 5))
+# optional DynamoDB table sharing the sampling windows between containers
+SAMPLER_TABLE = os.environ.get("SAMPLER_TABLE")
+# where the records given up on are appended, one JSON line each
+DEAD_LETTER_DIR = os.environ.get("DEAD_LETTER_DIR", "/tmp/dead-letters")
+# CloudWatch namespace of the metrics printed at the end of every invocation
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "FaceDetection")
+# seconds kept at the end of an invocation to flush and print the metrics, retries stop before
+DEADLINE_MARGIN = float(os.environ.get("DEADLINE_MARGIN", 3))
+
+# the Lambda runtime installs its own handler, only the level is ours to set
+logging.getLogger().setLevel(os.environ.get("LOG_LEVEL", "INFO"))
+logger = logging.getLogger(__name__)
+
+# position of a face in the FaceSearchResponse of its record as the stream processor sent it, kept on
+# the face once sampling rewrites the list so a face keeps its key
+FACE_INDEX = "FaceIndex"
+
 
 def decode_base64_and_load_json(data):
     data_bytes = b64decode(data)
@@ -23,55 +79,397 @@ def decode_base64_and_load_json(data):
     return json.loads(data_str)
 
 
-def lambda_handler(event, context):
-    print(event)
+def decode_records(event, dead_letters=None):
+    # (sequence number, record) of the records with faces; a record that cannot be decoded never will be,
+    # it goes straight to the dead letters when there are some
+    face_records = []
     for record in event["Records"]:
-        face_recognition_record = decode_base64_and_load_json(record["kinesis"]["data"])
-        print(face_recognition_record)
+        try:
+            face_recognition_record = decode_base64_and_load_json(record["kinesis"]["data"])
+            has_faces = len(face_recognition_record["FaceSearchResponse"]) > 0
+        except (ValueError, KeyError, TypeError) as e:
+            if dead_letters is None:
+                raise
+            dead_letters.put(record, e, record["kinesis"].get("sequenceNumber"))
+            continue
         # only process the record with faces
-        if len(face_recognition_record["FaceSearchResponse"]) == 0:
+        if not has_faces:
+            continue
+        face_records.append((record["kinesis"].get("sequenceNumber"), face_recognition_record))
+    return face_records
+
+
+def group_by_fragment(face_records):
+    # records of the same fragment are handled by one worker, in arrival order
+    groups = OrderedDict()
+    for face_recognition_record in face_records:
+        kinesis_video = face_recognition_record["InputInformation"]["KinesisVideo"]
+        key = (kinesis_video["StreamArn"], kinesis_video["FragmentNumber"])
+        groups.setdefault(key, []).append(face_recognition_record)
+    return groups
+
+
+def best_match(matched_faces, threshold=MATCH_THRESHOLD):
+    candidates = [m for m in matched_faces if m["Similarity"] >= threshold and m["Face"].get("FaceId")]
+    if len(candidates) == 0:
+        return None
+    return max(candidates, key=lambda m: m["Similarity"])
+
+
+def sample_candidate(face_recognition_record, i):
+    # (face_id, captured_at, score) of a matched face, faces without a match have no FaceId yet and are always kept
+    face_search_response = face_recognition_record["FaceSearchResponse"][i]
+    match = best_match(face_search_response["MatchedFaces"])
+    if match is None:
+        return None
+    kinesis_video = face_recognition_record["InputInformation"]["KinesisVideo"]
+    captured_at = kinesis_video["ProducerTimestamp"] + kinesis_video["FrameOffsetInSeconds"]
+    return match["Face"]["FaceId"], captured_at, face_score(face_search_response["DetectedFace"])
+
+
+def sample_faces(face_records, sampler):
+    # the faces of a window archived by an earlier batch are dropped from the stream records alone, so a record
+    # left without faces never fetches media; the photo of a new window is chosen after the quality gate
+    candidates = []
+    for face_recognition_record in face_records:
+        for i, face_search_response in enumerate(face_recognition_record["FaceSearchResponse"]):
+            face_search_response.setdefault(FACE_INDEX, i)
+            candidate = sample_candidate(face_recognition_record, i)
+            if candidate is not None:
+                candidates.append((candidate, face_search_response))
+    dropped = {id(candidates[i][1]) for i in sampler.archived([c for c, _ in candidates])}
+    metrics.count("SampledOut", len(dropped))
+
+    sampled = []
+    for face_recognition_record in face_records:
+        faces = [f for f in face_recognition_record["FaceSearchResponse"] if id(f) not in dropped]
+        if len(faces) > 0:
+            face_recognition_record["FaceSearchResponse"] = faces
+            sampled.append(face_recognition_record)
+    return sampled
+
+
+def track_faces(face_records, tracker):
+    """id(face search response) -> Track for every face of the records.
+
+    Tracking needs only the boxes, so it runs over the whole batch, sampled out faces included, and every track
+    knows the matches of the batch before a face is identified: an unmatched face of a track takes the FaceId
+    of a match of the same track, or of the first of its faces to be indexed.
+    """
+    face_tracks = {}
+    for face_recognition_record in face_records:
+        tracks = tracker.update(face_recognition_record)
+        for track, face_search_response in zip(tracks, face_recognition_record["FaceSearchResponse"]):
+            face_tracks[id(face_search_response)] = track
+            match = best_match(face_search_response["MatchedFaces"])
+            if match is not None:
+                track.found(match["Face"]["FaceId"])
+    return face_tracks
+
+
+def frame_key(face_recognition_record):
+    kinesis_video = face_recognition_record["InputInformation"]["KinesisVideo"]
+    return keys.frame_key(kinesis_video["StreamArn"], kinesis_video["ProducerTimestamp"],
+                          kinesis_video["FrameOffsetInSeconds"], IMAGE_FORMAT)
+
+
+def face_key(face_recognition_record, i, face_bytes):
+    if keys.KEY_MODE == "content":
+        return keys.content_key(face_bytes, IMAGE_FORMAT)
+    kinesis_video = face_recognition_record["InputInformation"]["KinesisVideo"]
+    index = face_recognition_record["FaceSearchResponse"][i].get(FACE_INDEX, i)
+    return keys.face_key(kinesis_video["StreamArn"], kinesis_video["ProducerTimestamp"],
+                         kinesis_video["FrameOffsetInSeconds"], index, IMAGE_FORMAT)
+
+
+def captured_at(face_recognition_record):
+    kinesis_video = face_recognition_record["InputInformation"]["KinesisVideo"]
+    return int((kinesis_video["ProducerTimestamp"] + kinesis_video["FrameOffsetInSeconds"]) * 1000)
+
+
+def archive_frame(face_recognition_record, image, s3_handler):
+    # the frame is only archived, Rekognition works on the face crops
+    upload_frame(face_recognition_record, encode_image(image), s3_handler)
+
+
+def upload_frame(face_recognition_record, frame_bytes, s3_handler):
+    s3_handler.upload_bytes(frame_bytes, frame_key(face_recognition_record),
+                            CONTENT_TYPES.get(IMAGE_FORMAT, "application/octet-stream"))
+
+
+def crop_faces(face_recognition_record, image, quality_gate=None):
+    # all the faces of a frame at once, None for a face outside of the frame or below the quality gate
+    boxes = box_array(f["DetectedFace"]["BoundingBox"] for f in face_recognition_record["FaceSearchResponse"])
+    face_sizes = (boxes[:, 2:] * [image.shape[1], image.shape[0]]).min(axis=1)
+    crops = extract_faces(image, boxes, box_ratio=2)
+    for i, crop in enumerate(crops):
+        if crop is None:
             continue
+        if quality_gate is not None and not quality_gate.accept(crop, face_sizes[i]):
+            crops[i] = None
+        elif FACE_SIZE is not None:
+            crops[i] = cv2.resize(crop, FACE_SIZE, interpolation=cv2.INTER_AREA)
+    return crops
+
+
+def identify_face(face_recognition_record, i, face_image, reko_handler, track=None):
+    face_search_response = face_recognition_record["FaceSearchResponse"][i]
+    if face_image is None:
+        return None
+    face_bytes = encode_image(face_image)
+
+    def index():
+        faces = reko_handler.index_faces(image_bytes=face_bytes, max_faces=1)
+        return faces[0]["FaceId"] if len(faces) > 0 else None
+
+    # a face the stream processor already matched keeps its FaceId, only new faces are indexed,
+    # once per track when they are tracked
+    match = best_match(face_search_response["MatchedFaces"])
+    if match is not None:
+        face_id = match["Face"]["FaceId"]
+    else:
+        face_id = track.identify(index) if track is not None else index()
+        if face_id is None:
+            return None
+    logger.debug("face id: %s", face_id)
+
+    return face_id, face_key(face_recognition_record, i, face_bytes), face_bytes
+
+
+def upload_face(face_bytes, key, s3_handler):
+    # a content key already in the bucket holds the same bytes
+    s3_handler.upload_bytes(face_bytes, key, CONTENT_TYPES.get(IMAGE_FORMAT, "application/octet-stream"),
+                            skip_existing=keys.KEY_MODE == "content")
+
+
+def fetch_fragment(arn_kvs, face_records):
+    # get the frame images of every record in one pass over the fragment
+    kvs_handler = get_handler(KVMediaHandler, arn_kvs)
+    kinesis_video = face_records[0]["InputInformation"]["KinesisVideo"]
+    offsets = [r["InputInformation"]["KinesisVideo"]["FrameOffsetInSeconds"] for r in face_records]
+    return kvs_handler.get_images_from_fragment(kinesis_video["FragmentNumber"],
+                                                kinesis_video["ProducerTimestamp"], offsets)
+
+
+def run_pipeline(pipeline, groups, s3_handler, reko_handler, quality_gate=None, sampler=None, face_tracks=None):
+    """Fetches, identifies and uploads on separate stages; returns the photos to record in input order
+    and the records that failed, id(record) -> error.
+
+    A failure only fails its record, or the records of its fragment for a fetch, and none of their photos
+    is returned. With a sampler, the matched faces that passed the quality gate wait until every fragment
+    is read, then the best of each window is archived. The unmatched faces found in face_tracks share the
+    FaceId of their track.
+    """
+    face_tracks = face_tracks or {}
+    failed = {}
+
+    def fail(face_recognition_record, error):
+        logger.warning("Record of fragment %s failed: %r",
+                       face_recognition_record["InputInformation"]["KinesisVideo"]["FragmentNumber"], error)
+        failed.setdefault(id(face_recognition_record), error)
+
+    def face_task(face_recognition_record, i, face_image, track=None):
+        face = identify_face(face_recognition_record, i, face_image, reko_handler, track)
+        if face is None:
+            return None
+        face_id, key, face_bytes = face
+        upload = pipeline["upload"].submit(upload_face, face_bytes, key, s3_handler)
+        return face_id, key, captured_at(face_recognition_record), upload
+
+    def archive(face_recognition_record, upload):
+        if ARCHIVE_FRAME == "sync":
+            # the frame is in S3 before any of its faces
+            try:
+                upload.result()
+            except Exception as e:
+                fail(face_recognition_record, e)
+        frame_uploads.append((face_recognition_record, upload))
 
-        # initialize the handler
-        arn_kvs = face_recognition_record["InputInformation"]["KinesisVideo"]["StreamArn"]
-        kvs_handler = KVMediaHandler(arn_kvs)
-        s3_handler = S3Handler(bucket)
-        reko_handler = RekoHanlder(collection_id, stream_processor_name)
-        dynamo_handler = DynamoHandler(db_name)
-
-        # get the frame image
-        timestamp = face_recognition_record["InputInformation"]["KinesisVideo"]["ProducerTimestamp"]
-        offset = face_recognition_record["InputInformation"]["KinesisVideo"]["FrameOffsetInSeconds"]
-        image = kvs_handler.get_image_from_stream(timestamp, offset)
-
-        # upload the frame image to S3 for indexing faces
-        # key = producer_timestamp + _ + frame
-        image_key = str(int(timestamp)) + "_frame.jpg"
-        cv2.imwrite(TMP_DIR + f"/{image_key}", image)
-        s3_handler.upload(TMP_DIR + f"/{image_key}", image_key)
-        faces = reko_handler.index_faces(bucket, image_key)
-
-        for i, face in enumerate(faces):
-            face_id = face["FaceId"]
-
-            if face_id is None:
+    fetches = [(records, pipeline["media"].submit(fetch_fragment, arn_kvs, records))
+               for (arn_kvs, _), records in groups.items()]
+    frame_uploads = []
+    faces = []
+    # (candidate, frame, record, face index, crop) of the faces left to the sampler
+    deferred = []
+    # encoded frames of which only deferred faces are left, archived if one of them is chosen
+    encoded = {}
+    frame = 0
+    # fragments are consumed in order while the later ones are still being fetched
+    for records, fetch in fetches:
+        try:
+            images = fetch.result()
+        except Exception as e:
+            for face_recognition_record in records:
+                fail(face_recognition_record, e)
+            continue
+        for face_recognition_record, image in zip(records, images):
+            frame += 1
+            logger.debug("%s", face_recognition_record)
+            try:
+                crops = crop_faces(face_recognition_record, image, quality_gate)
+            except Exception as e:
+                fail(face_recognition_record, e)
+                continue
+            metrics.count("Frames")
+            metrics.record("FacesPerFrame", sum(crop is not None for crop in crops), "Count")
+            tracks = [face_tracks.get(id(f)) for f in face_recognition_record["FaceSearchResponse"]]
+            now, later = [], 0
+            for i, face_image in enumerate(crops):
+                if face_image is None:
+                    continue
+                candidate = sample_candidate(face_recognition_record, i) if sampler is not None else None
+                if candidate is None:
+                    now.append(i)
+                else:
+                    deferred.append((candidate, frame, face_recognition_record, i, face_image))
+                    later += 1
+            if ARCHIVE_FRAME != "off" and now:
+                archive(face_recognition_record,
+                        pipeline["upload"].submit(archive_frame, face_recognition_record, image, s3_handler))
+            elif ARCHIVE_FRAME != "off" and later:
+                encoded[frame] = pipeline["faces"].submit(encode_image, image)
+            for i in now:
+                faces.append(((frame, i), face_recognition_record,
+                              pipeline["faces"].submit(face_task, face_recognition_record, i, crops[i], tracks[i])))
+                metrics.count("Faces")
+
+    selected = []
+    if deferred:
+        selected = [deferred[index] for index in sampler.select([d[0] for d in deferred])]
+        for _, frame, face_recognition_record, i, face_image in selected:
+            frame_bytes = encoded.pop(frame, None)
+            if frame_bytes is not None:
+                try:
+                    archive(face_recognition_record, pipeline["upload"].submit(
+                        upload_frame, face_recognition_record, frame_bytes.result(), s3_handler))
+                except Exception as e:
+                    fail(face_recognition_record, e)
+            faces.append(((frame, i), face_recognition_record,
+                          pipeline["faces"].submit(face_task, face_recognition_record, i, face_image)))
+            metrics.count("Faces")
+        faces.sort(key=lambda face: face[0])
+
+    photos = []
+    for _, face_recognition_record, future in faces:
+        try:
+            face = future.result()
+            if face is None:
                 continue
-            print("face id: ", face_id)
+            face_id, key, capture_time, upload = face
+            # a photo is only recorded once its object is in S3
+            upload.result()
+        except Exception as e:
+            fail(face_recognition_record, e)
+            continue
+        photos.append((face_recognition_record, (face_id, key, capture_time)))
+    for face_recognition_record, upload in frame_uploads:
+        try:
+            upload.result()
+        except Exception as e:
+            fail(face_recognition_record, e)
+
+    # a window whose photo failed opens again for the record read again
+    for (face_id, captured, _), _, face_recognition_record, _, _ in selected:
+        if id(face_recognition_record) in failed:
+            sampler.forget(face_id, captured)
+    return [photo for face_recognition_record, photo in photos if id(face_recognition_record) not in failed], failed
 
-            # key = producer_timestamp + _ + i
-            face_image = extract_face(image, face["BoundingBox"], box_ratio=2)
-            key = str(int(timestamp)) + '_' + str(i) + ".jpg"
-            cv2.imwrite(TMP_DIR + f"/{key}", face_image)
-            s3_handler.upload(TMP_DIR + f"/{key}", key)
 
-            if dynamo_handler.exist(face_id):
-                dynamo_handler.append_image(face_id, s3_handler.bucket_name, key)
-            else:
-                dynamo_handler.create_image_record(face_id, s3_handler.bucket_name, key)
+def lambda_handler(event, context):
+    metrics.reset()
+    # retries share one budget per invocation and give up before the Lambda timeout; with a timeout
+    # shorter than the margin, calls that find a token still go out and the others raise DeadlineExceeded
+    if context is not None:
+        throttle.budget.reset(max(0.0, context.get_remaining_time_in_millis() / 1000 - DEADLINE_MARGIN))
+    else:
+        throttle.budget.reset()
+    start = perf_counter()
+    try:
+        return handle_event(event)
+    finally:
+        metrics.record("Invocation", (perf_counter() - start) * 1000, "Milliseconds")
+        # one embedded metric line per invocation, CloudWatch turns it into metrics
+        function_name = context.function_name if context is not None else "local"
+        print(metrics.emf(METRICS_NAMESPACE, {"Function": function_name}))
 
-        # only process one frame
-        break
 
+def handle_event(event):
+    logger.debug("%s", event)
+    dead_letters = get_handler(DeadLetters, DEAD_LETTER_DIR)
+    with metrics.timer("DecodeRecords"):
+        face_records = decode_records(event, dead_letters)
+    metrics.count("Records", len(event["Records"]))
+    failures = process_face_records(face_records, dead_letters)
+    # with ReportBatchItemFailures, Kinesis checkpoints before the first failed record and reads from there again
     return {
-        'statusCode': 200
+        'statusCode': 200,
+        'batchItemFailures': [{'itemIdentifier': failures[0]}] if failures else []
     }
+
+
+def process_face_records(face_records, dead_letters):
+    """face_records are (sequence number, record) pairs; returns the sequence numbers of the failed records.
+
+    A record that failed MAX_RECORD_ATTEMPTS times goes to the dead letters and no longer fails. Processing stops
+    at the first pass with a failure, or once the deadline is over, as everything after is read again anyway.
+    """
+    failures = []
+    for start in range(0, len(face_records), MAX_RECORDS):
+        chunk = face_records[start:start + MAX_RECORDS]
+        if throttle.budget.expired():
+            logger.warning("Out of time, %d records left for the next invocation", len(face_records) - start)
+            failures.append(chunk[0][0])
+            break
+        sequence_numbers = {id(record): sequence_number for sequence_number, record in chunk}
+        for face_recognition_record, error in process_records([record for _, record in chunk]):
+            sequence_number = sequence_numbers[id(face_recognition_record)]
+            if not dead_letters.give_up(sequence_number, face_recognition_record, error):
+                failures.append(sequence_number)
+        if failures:
+            break
+    metrics.count("FailedRecords", len(failures))
+    return failures
+
+
+def process_records(face_records):
+    """Everything after decoding, shared by the Lambda and the stream consumer; returns the (record, error)
+    of the records that failed, in input order."""
+    sampler = get_handler(FaceSampler, MIN_INTERVAL, SAMPLER_TABLE) if MIN_INTERVAL > 0 else None
+    tracker = get_handler(FaceTracker, TRACK_TTL) if TRACK_TTL > 0 else None
+    face_tracks = track_faces(face_records, tracker) if tracker is not None else None
+    # sampling drops faces in place, the records and their faces keep their identity
+    records = face_records
+    if sampler is not None:
+        face_records = sample_faces(face_records, sampler)
+    groups = group_by_fragment(face_records)
+    if len(groups) == 0:
+        return []
+
+    # handlers are shared by the invocations of a warm container
+    s3_handler = get_handler(S3Handler, bucket)
+    reko_handler = get_handler(RekoHanlder, collection_id, stream_processor_name)
+    dynamo_handler = get_handler(DynamoHandler, db_name)
+    quality_gate = get_handler(QualityGate, *QUALITY)
+
+    with Pipeline(media=MAX_WORKERS, faces=FACE_WORKERS, upload=UPLOAD_WORKERS) as pipeline:
+        photos, failed = run_pipeline(pipeline, groups, s3_handler, reko_handler, quality_gate, sampler,
+                                      face_tracks)
+    metrics.count("Photos", len(photos))
+
+    # written in one go, in the order of the records
+    for face_id, key, capture_time in photos:
+        dynamo_handler.buffer_image(face_id, s3_handler.bucket_name, key, capture_time)
+    try:
+        dynamo_handler.flush()
+    except Exception as e:
+        # part of the photos may be recorded, the writes are idempotent so the whole pass is read again
+        logger.warning("Recording the photos failed: %r", e)
+        if sampler is not None:
+            # the windows opened by this pass have no photo recorded, the records read again must not be sampled out
+            for face_recognition_record in face_records:
+                for i in range(len(face_recognition_record["FaceSearchResponse"])):
+                    candidate = sample_candidate(face_recognition_record, i)
+                    if candidate is not None:
+                        sampler.forget(candidate[0], candidate[1])
+        return [(record, e) for record in face_records]
+    return [(record, failed[id(record)]) for record in records if id(record) in failed]
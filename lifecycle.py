@@ -1,17 +1,16 @@
-from time import sleep
-
-import boto3
+from time import perf_counter
 
 from handler.dynamo_handler import DynamoHandler
 from handler.kinesis_handler import KVSHandler, KDSHandler
 from handler.reko_handler import RekoHanlder
 from handler.s3_handler import S3Handler
-from util import yaml_handler
+from steps import StepError, StepGraph, format_report, wait_until
 
-env = yaml_handler('./aws_env.yaml')
 
 class LifeCycleController:
-    def __init__(self):
+    def __init__(self, timeout=600):
+        # seconds any resource may take to become ready or to go away
+        self.timeout = timeout
         # name of Kinesis video stream
         kv_name = "macbook-camera"
         kds_name = "face-stream"
@@ -27,37 +26,81 @@ class LifeCycleController:
         self.s3_handler = S3Handler(bucket)
         self.dynamo_handler = DynamoHandler(db_table)
 
+    def wait_status(self, query, wanted, description):
+        # None is what the query returns once the resource is gone
+        wait_until(lambda: query() in wanted, description, timeout=self.timeout)
+
     def create(self):
-        self.kvs_handler.create()
-        self.kds_handler.create()
-        self.reko_handler.create_collection()
-        self.reko_handler.create_rekognition_stream_processor(self.kvs_handler.get_arn(), self.kds_handler.get_arn())
+        graph = StepGraph()
+        kvs = graph.add("create video stream", self.kvs_handler.create)
+        kvs = graph.add("video stream active", lambda: self.wait_status(
+            self.kvs_handler.query_status, ("ACTIVE",), "video stream not active"), after=[kvs])
+        kds = graph.add("create data stream", self.kds_handler.create)
+        kds = graph.add("data stream active", lambda: self.wait_status(
+            self.kds_handler.query_status, ("ACTIVE", "UPDATING"), "data stream not active"), after=[kds])
+        collection = graph.add("create collection", self.reko_handler.create_collection)
+        processor = graph.add("create stream processor", lambda: self.reko_handler.create_rekognition_stream_processor(
+            self.kvs_handler.get_arn(), self.kds_handler.get_arn()), after=[kvs, kds, collection])
+        processor = graph.add("stream processor ready", lambda: self.wait_status(
+            self.reko_handler.query_status, ("STOPPED", "RUNNING"), "stream processor not created"), after=[processor])
         # start the stream processor
-        self.reko_handler.start_stream_processor()
-
-        # waiting for KDS to start
-        while True:
-            status = self.kds_handler.query_status()
-            if status == "ACTIVE" or status == "UPDATING":
-                break
-            sleep(1)
+        processor = graph.add("start stream processor", self.reko_handler.start_stream_processor, after=[processor])
+        graph.add("stream processor running", lambda: self.wait_status(
+            self.reko_handler.query_status, ("RUNNING",), "stream processor not running"), after=[processor])
+        consumer = graph.add("register consumer", lambda: self.kds_handler.create_kds_consumer(self.consumer_name),
+                             after=[kds])
+        graph.add("consumer active", lambda: self.wait_status(
+            lambda: self.kds_handler.consumer_status(self.consumer_name), ("ACTIVE",), "consumer not active"),
+            after=[consumer])
+        s3 = graph.add("create bucket", self.s3_handler.create)
+        graph.add("bucket exists", lambda: wait_until(self.s3_handler.exists, "bucket not created",
+                                                      timeout=self.timeout), after=[s3])
+        table = graph.add("create table", self.dynamo_handler.create)
+        graph.add("table active", lambda: self.wait_status(
+            self.dynamo_handler.query_status, ("ACTIVE",), "table not active"), after=[table])
+        return self.run(graph)
 
-        self.kds_handler.create_kds_consumer(self.consumer_name)
-        self.s3_handler.create()
-        self.dynamo_handler.create()
-
-    def delete(self, empty_s3=True):
-        self.reko_handler.stop_rekognition_stream_processor()
-        self.reko_handler.delete_rekognition_stream_processor()
-        self.reko_handler.delete_collection()
+    def delete(self, empty_s3=True, prefix="", older_than=None):
+        # prefix and older_than (seconds) narrow what empty_s3 deletes, the other photos are kept
+        graph = StepGraph()
+        processor = graph.add("stop stream processor", self.reko_handler.stop_rekognition_stream_processor)
+        processor = graph.add("stream processor stopped", lambda: self.wait_status(
+            self.reko_handler.query_status, ("STOPPED", "FAILED", None), "stream processor not stopped"),
+            after=[processor])
+        processor = graph.add("delete stream processor", self.reko_handler.delete_rekognition_stream_processor,
+                              after=[processor])
+        processor = graph.add("stream processor deleted", lambda: self.wait_status(
+            self.reko_handler.query_status, (None,), "stream processor not deleted"), after=[processor])
+        # the inputs and the output of the stream processor go once it is gone
+        graph.add("delete collection", self.reko_handler.delete_collection, after=[processor])
+        kvs = graph.add("delete video stream", self.kvs_handler.delete, after=[processor])
+        graph.add("video stream deleted", lambda: self.wait_status(
+            self.kvs_handler.query_status, (None,), "video stream not deleted"), after=[kvs])
         # Consumer will be deleted accordingly
-        self.kvs_handler.delete()
-        self.kds_handler.delete()
-        self.dynamo_handler.delete()
+        kds = graph.add("delete data stream", self.kds_handler.delete, after=[processor])
+        graph.add("data stream deleted", lambda: self.wait_status(
+            self.kds_handler.query_status, (None,), "data stream not deleted"), after=[kds])
+        table = graph.add("delete table", self.dynamo_handler.delete)
+        graph.add("table deleted", lambda: self.wait_status(
+            self.dynamo_handler.query_status, (None,), "table not deleted"), after=[table])
         if empty_s3:
-            self.s3_handler.empty()
+            graph.add("empty bucket", lambda: self.s3_handler.empty(prefix, older_than))
         else:
-            self.s3_handler.delete()
+            s3 = graph.add("delete bucket", self.s3_handler.delete)
+            graph.add("bucket deleted", lambda: wait_until(lambda: not self.s3_handler.exists(),
+                                                           "bucket not deleted", timeout=self.timeout), after=[s3])
+        return self.run(graph)
+
+    def run(self, graph):
+        start = perf_counter()
+        try:
+            results = graph.run()
+        except StepError as e:
+            print(format_report(e.results))
+            raise
+        print(format_report(results))
+        print(f"Total: {perf_counter() - start:.1f}s")
+        return results
 
 
 if __name__ == "__main__":
@@ -0,0 +1,50 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Stage:
+    """A pool of workers for one step of the record processing.
+
+    submit blocks once workers + backlog tasks are pending, so a fast stage
+    cannot pile up frames in memory ahead of a slow one.
+    """
+
+    def __init__(self, name, workers, backlog=None):
+        self.name = name
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self.slots = threading.BoundedSemaphore(workers + (backlog if backlog is not None else workers))
+
+    def submit(self, fn, *args, **kwargs):
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(fn, *args, **kwargs)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+class Pipeline:
+    """Named stages, e.g. Pipeline(media=4, faces=8, upload=16).
+
+    A stage may only submit to the stages after it, which keeps the
+    blocking submits free of deadlocks. Leaving the context waits for
+    every task, also when an error is raised.
+    """
+
+    def __init__(self, **workers):
+        self.stages = {name: Stage(name, count) for name, count in workers.items()}
+
+    def __getitem__(self, name):
+        return self.stages[name]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for stage in self.stages.values():
+            stage.shutdown()
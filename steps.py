@@ -0,0 +1,89 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+class StepError(Exception):
+    def __init__(self, failed, results):
+        self.failed = failed
+        self.results = results
+        super().__init__("failed steps: " + ", ".join(f"{name} ({error})" for name, error in failed.items()))
+
+
+class StepGraph:
+    """Runs steps as soon as the steps they depend on are done, independent ones at the same time.
+
+    A failed step skips everything that depends on it; the others still run, then StepError is raised.
+    """
+
+    def __init__(self):
+        self.steps = {}
+
+    def add(self, name, function, after=()):
+        # dependencies are added first, so the graph cannot have a cycle
+        for dependency in after:
+            if dependency not in self.steps:
+                raise ValueError(f"{name} depends on the unknown step {dependency}")
+        self.steps[name] = (function, tuple(after))
+        return name
+
+    def run(self, max_workers=8):
+        """Returns name -> (status, seconds) in the order the steps ended, status being done, failed or skipped."""
+        results = {}
+        errors = {}
+        pending = dict(self.steps)
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while pending or running:
+                for name, (function, after) in list(pending.items()):
+                    statuses = [results.get(d, (None,))[0] for d in after]
+                    if "failed" in statuses or "skipped" in statuses:
+                        results[name] = ("skipped", None)
+                        del pending[name]
+                    elif all(status == "done" for status in statuses):
+                        running[executor.submit(timed_call, function)] = name
+                        del pending[name]
+                if not running:
+                    continue
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    seconds, error = future.result()
+                    if error is not None:
+                        errors[name] = error
+                    results[name] = ("failed" if error is not None else "done", seconds)
+        if errors:
+            raise StepError(errors, results) from next(iter(errors.values()))
+        return results
+
+
+def timed_call(function):
+    start = time.perf_counter()
+    try:
+        function()
+    except Exception as e:
+        return time.perf_counter() - start, e
+    return time.perf_counter() - start, None
+
+
+def format_report(results):
+    lines = []
+    for name, (status, seconds) in results.items():
+        lines.append(f"{name:<40} {status:<8} {'' if seconds is None else f'{seconds:8.1f}s'}")
+    return "\n".join(lines)
+
+
+def wait_until(check, description, timeout=300, delay=1.0, max_delay=20.0, sleep=None, clock=None):
+    """Calls check until it returns something true, backing off exponentially; TimeoutError after timeout seconds."""
+    sleep = sleep or time.sleep
+    clock = clock or time.monotonic
+    deadline = clock() + timeout
+    while True:
+        result = check()
+        if result:
+            return result
+        remaining = deadline - clock()
+        if remaining <= 0:
+            raise TimeoutError(f"{description} after {timeout}s")
+        sleep(min(delay, remaining))
+        delay = min(delay * 2, max_delay)
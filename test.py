@@ -1,20 +1,69 @@
+import base64
+import io
 import json
+import os
+import random
+import tempfile
+import threading
+import time
 import unittest
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
 import cv2
+import numpy as np
+from botocore.exceptions import ClientError
+
+import util
+
+# aws_env.yaml is per deployment and not part of the repository, the fakes only need some region and ARNs
+if not os.path.exists(os.environ.get("AWS_ENV_FILE", util.ENV_FILE)):
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    os.environ.setdefault("ARN_RECOGNITION", "arn:aws:iam::000000000000:role/RekoStreamProcessor")
+    os.environ.setdefault("ARN_KVS", "arn:aws:kinesisvideo:us-east-1:000000000000:stream/camera/0")
 
+from handler import keys, kv_media_handler, mkv, registry, throttle
+from handler.dead_letter import DeadLetters
+from handler.dedup import FaceSampler, WindowStore
+from handler.checkpoint import SHARD_END, FileCheckpoints
+from handler.kinesis_handler import KDSHandler
+from handler.quality import QualityGate
+from handler.tracker import FaceTracker, iou
+from handler.fragment_cache import FragmentCache
+from handler.history import VisitorHistory
 from handler.dynamo_handler import DynamoHandler
 from handler.kv_media_handler import KVMediaHandler, extract_face
-from lambda_function import decode_base64_and_load_json, lambda_handler
+from handler.metrics import Metrics, metrics
+from benchmark.fakes import FakeAWS, kinesis_event
+from benchmark.replay import Replayer, capture_event, read_capture, write_capture
+import consumer
+import lifecycle
+import lambda_function
+from lambda_function import decode_base64_and_load_json, lambda_handler, sample_faces
+from pipeline import Pipeline, Stage
+from steps import StepError, StepGraph, wait_until
 from handler.reko_handler import RekoHanlder
 from handler.s3_handler import S3Handler
-from util import yaml_handler
+from util import LazyModule, load_env
 
-env = yaml_handler('./aws_env.yaml')
+env = load_env()
 
 response_json = """
 {"Records": [{"kinesis": {"kinesisSchemaVersion": "1.0", "partitionKey": "aad81646-ccda-45c4-9ed0-c4130c4a4a10", "sequenceNumber": "49605974038509424079760656864102544007978456824330321922", "data": "eyJJbnB1dEluZm9ybWF0aW9uIjp7IktpbmVzaXNWaWRlbyI6eyJTdHJlYW1Bcm4iOiJhcm46YXdzOmtpbmVzaXN2aWRlbzp1cy1lYXN0LTE6MDkwOTE4NTU2MjY1OnN0cmVhbS9tYWNib29rLWNhbWVyYS8xNTg2NTU1MDU0OTg5IiwiRnJhZ21lbnROdW1iZXIiOiI5MTM0Mzg1MjMzMzE4MTY3MDA4MjEyMTM2NTU3ODA1MTk3Njg5ODQ0MDI4NTU4MCIsIlNlcnZlclRpbWVzdGFtcCI6MS41ODY5MzA2OTcxODNFOSwiUHJvZHVjZXJUaW1lc3RhbXAiOjEuNTg2OTMwNjk2MzM2RTksIkZyYW1lT2Zmc2V0SW5TZWNvbmRzIjozLjAwMDk5OTkyNzUyMDc1Mn19LCJTdHJlYW1Qcm9jZXNzb3JJbmZvcm1hdGlvbiI6eyJTdGF0dXMiOiJSVU5OSU5HIn0sIkZhY2VTZWFyY2hSZXNwb25zZSI6W3siRGV0ZWN0ZWRGYWNlIjp7IkJvdW5kaW5nQm94Ijp7IkhlaWdodCI6MC41MDUwNzEzNCwiV2lkdGgiOjAuMjk0MjMzMDIsIkxlZnQiOjAuMzc1MzYxNDQsIlRvcCI6MC40NjAwNjc3fSwiQ29uZmlkZW5jZSI6OTkuOTk5OTYsIkxhbmRtYXJrcyI6W3siWCI6MC40Mzg3MjU3LCJZIjowLjYxOTU0MTc2LCJUeXBlIjoiZXllTGVmdCJ9LHsiWCI6MC41NzYyNjU4LCJZIjowLjYxMzk0OTY2LCJUeXBlIjoiZXllUmlnaHQifSx7IlgiOjAuNDU4MjU2MjQsIlkiOjAuODMwMzUxNzcsIlR5cGUiOiJtb3V0aExlZnQifSx7IlgiOjAuNTcxOTE2OCwiWSI6MC44MjU1MzI1NiwiVHlwZSI6Im1vdXRoUmlnaHQifSx7IlgiOjAuNTE3ODE4OCwiWSI6MC43MzEzNjIxNiwiVHlwZSI6Im5vc2UifV0sIlBvc2UiOnsiUGl0Y2giOjQuNzA3MzQwNywiUm9sbCI6LTMuNDQ4Mjg5NiwiWWF3IjotMC42MTc1MjQ3fSwiUXVhbGl0eSI6eyJCcmlnaHRuZXNzIjo3OC4zNjgxNCwiU2hhcnBuZXNzIjo3OC42NDM1fX0sIk1hdGNoZWRGYWNlcyI6W3siU2ltaWxhcml0eSI6OTkuOTkyOTksIkZhY2UiOnsiQm91bmRpbmdCb3giOnsiSGVpZ2h0IjowLjUxMjA3OCwiV2lkdGgiOjAuMjc3NDYsIkxlZnQiOjAuMzcwMiwiVG9wIjowLjQzMzg3Mn0sIkZhY2VJZCI6Ijg5ZWNkZGJhLWZiZTctNDdjYy1hMjFhLTNlNzVmMDZmNGEyOCIsIkNvbmZpZGVuY2UiOjk5Ljk5OTksIkltYWdlSWQiOiIzM2MyNzMwOC1mNTc3LTNiZmEtYTg5My1hMjllMTRlMjJiNTUifX0seyJTaW1pbGFyaXR5Ijo5OS45ODk5MSwiRmFjZSI6eyJCb3VuZGluZ0JveCI6eyJIZWlnaHQiOjAuNDYzMzUyLCJXaWR0aCI6MC4yNTI5MTMsIkxlZnQiOjAuMzk4OTI4LCJUb3AiOjAuNTE0MTcyfSwiRmFjZUlkIjoiM2FmNGMxZjAtMWM1Ny00NTZmLTkyNjYtYzMwOGI5MzZjMWVmIiwiQ29uZmlkZW5jZSI6MTAwLjAsIkltYWdlSWQiOiJhODc5MjBhMC0wNWRhLTM4OWEtOGY4MC1mNzc5MmRjMDFkMDcifX0seyJTaW1pbGFyaXR5Ijo5OS45ODgxNiwiRmFjZSI6eyJCb3VuZGluZ0JveCI6eyJIZWlnaHQiOjAuNTE0MzYzLCJXaWR0aCI6MC4yODI3MzksIkxlZnQiOjAuNDQ0MjAzLCJUb3AiOjAuNDc4NDQxfSwiRmFjZUlkIjoiMjQzMDFlMmYtZTJlOC00N2VmLWE2MjktNDU2OWI2ZmUzM2MwIiwiQ29uZmlkZW5jZSI6MTAwLjAsIkltYWdlSWQiOiIzYTBiYjVkZC01OTFlLTNmYzEtYTM3MS1jNTljMTI2ZmIyODIifX0seyJTaW1pbGFyaXR5Ijo5OS45ODc5NywiRmFjZSI6eyJCb3VuZGluZ0JveCI6eyJIZWlnaHQiOjAuNDc4MzM3LCJXaWR0aCI6MC4yOTgxNzMsIkxlZnQiOjAuNDIxOTI3LCJUb3AiOjAuNDc1ODYzfSwiRmFjZUlkIjoiNjkzYmU1MDEtOTQzOC00ZmZjLThhNDItZjMyN2IwMjliYjljIiwiQ29uZmlkZW5jZSI6OTkuOTk5OSwiSW1hZ2VJZCI6IjYzMGI0NWQxLTNmYjEtMzAwNy1hM2Q3LWZhZmFmNjBkOWMzOCJ9fSx7IlNpbWlsYXJpdHkiOjk5Ljk4NzAyLCJGYWNlIjp7IkJvdW5kaW5nQm94Ijp7IkhlaWdodCI6MC40ODI0MDYsIldpZHRoIjowLjI5NjA4NCwiTGVmdCI6MC40MjUzMywiVG9wIjowLjQ3MzI3NH0sIkZhY2VJZCI6IjU0N2M3NDJmLWUzY2MtNDNkZS05Yjk2LWVlOWQ3N2YzOGUxZiIsIkNvbmZpZGVuY2UiOjk5Ljk5OTksIkltYWdlSWQiOiJjYzUyNjBjYy04NjNjLTM0NWItOWE2NS0yMzU5YmFjZjYwZGQifX0seyJTaW1pbGFyaXR5Ijo5OS45ODMzLCJGYWNlIjp7IkJvdW5kaW5nQm94Ijp7IkhlaWdodCI6MC40MzcwMjQsIldpZHRoIjowLjI0Njk4NSwiTGVmdCI6MC4zNjM1OTksIlRvcCI6MC41MTQ3NzV9LCJGYWNlSWQiOiJlZTk4ZjYyZC04ZWJjLTRiZTYtODYwYS0zODI1NjFmZDIwOWUiLCJDb25maWRlbmNlIjoxMDAuMCwiSW1hZ2VJZCI6Ijc5MDBlMGY4LWZjYTMtMzIyOS04NTgxLWIwOWRmY2E0NjRjYyJ9fSx7IlNpbWlsYXJpdHkiOjk5Ljk1NzQ3LCJGYWNlIjp7IkJvdW5kaW5nQm94Ijp7IkhlaWdodCI6MC4zOTc0OTIsIldpZHRoIjowLjIzNTQ5MiwiTGVmdCI6MC4zNzAzNzQsIlRvcCI6MC42MTg2MjF9LCJGYWNlSWQiOiIzMjA0OTg3NC1iNzQzLTRiMDAtOGExOS03OTNlOTRhZjQxOWIiLCJDb25maWRlbmNlIjoxMDAuMCwiSW1hZ2VJZCI6IjY5YmZiNzdlLWU1MzctMzI0MS1hMjdlLWZhMTcxOTdiZDQxNSJ9fSx7IlNpbWlsYXJpdHkiOjk5Ljk1NDU3NSwiRmFjZSI6eyJCb3VuZGluZ0JveCI6eyJIZWlnaHQiOjAuNjg1MDg2LCJXaWR0aCI6MC41MTY5NDIsIkxlZnQiOjAuMTYwMDMxLCJUb3AiOjAuMjc0NTM1fSwiRmFjZUlkIjoiYmUwMzIzOTMtOTYyYi00OGJkLThjMWUtYzJlOWQ3Zjk5OWYwIiwiQ29uZmlkZW5jZSI6OTkuOTk5NiwiSW1hZ2VJZCI6Ijc0ODIwNDg1LTNhZTctM2RhNy1hMmNiLWIzNWIyZDVhZTRmMCJ9fSx7IlNpbWlsYXJpdHkiOjk5Ljk1NDAyNSwiRmFjZSI6eyJCb3VuZGluZ0JveCI6eyJIZWlnaHQiOjAuMzc4MTg2LCJXaWR0aCI6MC4yMDY1MjEsIkxlZnQiOjAuMzA4NTQ0LCJUb3AiOjAuNTA4OTUzfSwiRmFjZUlkIjoiMWM5ZjFjYTgtNzZhYS00MjYxLTk0NTEtZTNkOWU2OTUyMzNlIiwiQ29uZmlkZW5jZSI6MTAwLjAsIkltYWdlSWQiOiJlNDEyN2YwNC1jNzVhLTMzMGItOTljNy1mYTkzYTE0ZjQyNmQifX0seyJTaW1pbGFyaXR5Ijo5OS45NTA5NCwiRmFjZSI6eyJCb3VuZGluZ0JveCI6eyJIZWlnaHQiOjAuNDY5NjMyLCJXaWR0aCI6MC4yNTU3NDcsIkxlZnQiOjAuMzY3NzY5LCJUb3AiOjAuNDMxOTV9LCJGYWNlSWQiOiI3ZmJiNjc5NS0zMjc1LTQwMWMtOTZlMi0wMzE0M2ZiOTgwMTUiLCJDb25maWRlbmNlIjoxMDAuMCwiSW1hZ2VJZCI6ImI4YjZkZDM3LTM3NTEtM2YyMi1hMDJiLWIzOTNlY2M5YjM3YyJ9fSx7IlNpbWlsYXJpdHkiOjk5Ljk0MTEyNCwiRmFjZSI6eyJCb3VuZGluZ0JveCI6eyJIZWlnaHQiOjAuNTc3OTkxLCJXaWR0aCI6MC41OTY2NDQsIkxlZnQiOjAuMzQwNDA2LCJUb3AiOjAuNDEwNTUyfSwiRmFjZUlkIjoiMTE1ZjhmZjktYmFmZC00YjQ0LThiMjgtMzM3ZTE0NWEzMWMxIiwiQ29uZmlkZW5jZSI6OTkuOTk5NywiSW1hZ2VJZCI6ImQwYzFlYjBjLTliMzQtMzViMi1iOWYwLWY2YjJmNTYwMzY4YyJ9fSx7IlNpbWlsYXJpdHkiOjk5LjkzMDUsIkZhY2UiOnsiQm91bmRpbmdCb3giOnsiSGVpZ2h0IjowLjM0NjYyNywiV2lkdGgiOjAuMTg5MzczLCJMZWZ0IjowLjM1Njc2MiwiVG9wIjowLjUyMTM3NH0sIkZhY2VJZCI6Ijc1NTUwOGZmLWNhMmQtNDM3YS04ZWRjLTE2MDk5NzI5NTM3OSIsIkNvbmZpZGVuY2UiOjEwMC4wLCJJbWFnZUlkIjoiZDE3ZjgzYjgtMTZkYy0zNDBmLTllMzYtZDAzN2ZmOTVjMTMxIn19LHsiU2ltaWxhcml0eSI6OTkuOTI0Njc1LCJGYWNlIjp7IkJvdW5kaW5nQm94Ijp7IkhlaWdodCI6MC40NzI3MjUsIldpZHRoIjowLjI1OTE1NSwiTGVmdCI6MC4zMjU0NzMsIlRvcCI6MC41MTc4NTl9LCJGYWNlSWQiOiIzYzBiNTI2ZS1hZWMzLTQxMWItYmNiNC0xNTNkYTMxMzVlZjAiLCJDb25maWRlbmNlIjo5OS45OTk5LCJJbWFnZUlkIjoiODM2N2MwYmUtMTM4OS0zOGEzLWEwNDAtNjFkYWUzNmY4ZGM1In19LHsiU2ltaWxhcml0eSI6OTkuOTIzMDMsIkZhY2UiOnsiQm91bmRpbmdCb3giOnsiSGVpZ2h0IjowLjY0MDI5MiwiV2lkdGgiOjAuNTA5NjY4LCJMZWZ0IjowLjIyNTc3NCwiVG9wIjowLjMyMDc0NH0sIkZhY2VJZCI6ImJmZTFmZWFkLTc1NTItNGZlMC05NTExLWM1MGZlYjViMTdmMSIsIkNvbmZpZGVuY2UiOjk5Ljk5OTMwNiwiSW1hZ2VJZCI6Ijk5MDZkNjI3LTUzYmYtMzQxMS04ZmVkLWE1Zjc0ZmQ0NGQ2NSJ9fSx7IlNpbWlsYXJpdHkiOjk5LjkyMTM2NCwiRmFjZSI6eyJCb3VuZGluZ0JveCI6eyJIZWlnaHQiOjAuMzg5MTEzLCJXaWR0aCI6MC4yMzY2OTQsIkxlZnQiOjAuNDA5ODYsIlRvcCI6MC42NzAyNX0sIkZhY2VJZCI6IjlmM2I1OTk2LTgwZDYtNDkzYS1hYjU0LTUwNDM4YjlmNTYzZiIsIkNvbmZpZGVuY2UiOjEwMC4wLCJJbWFnZUlkIjoiNjczYjhhOTMtODUyZS0zZTE1LTk5NTUtNDA2YWJmNmZjMDBmIn19LHsiU2ltaWxhcml0eSI6OTkuOTAwMTgsIkZhY2UiOnsiQm91bmRpbmdCb3giOnsiSGVpZ2h0IjowLjM3NTk4OCwiV2lkdGgiOjAuMjMzMzg3LCJMZWZ0IjowLjM3NDA1MywiVG9wIjowLjY4MTI5N30sIkZhY2VJZCI6ImNjN2FlZTFkLTRmZTQtNDViNS05ZTc3LWY3ZjRlMTY3NWE5NyIsIkNvbmZpZGVuY2UiOjEwMC4wLCJJbWFnZUlkIjoiZmM2MGI2ZjQtMjA2YS0zYzIwLTlmMDUtMDc1Mjc2NzA2OGUwIn19LHsiU2ltaWxhcml0eSI6OTkuODkyNTcsIkZhY2UiOnsiQm91bmRpbmdCb3giOnsiSGVpZ2h0IjowLjQ3MTc3OCwiV2lkdGgiOjAuMzU1NTU4LCJMZWZ0Ijo1LjU2MjY2RS01LCJUb3AiOjAuNTY0OTA4fSwiRmFjZUlkIjoiYmFhYmRmMDgtNWI2NC00NjhlLWFiMmQtNTQwYzc1NzM4YTQ2IiwiQ29uZmlkZW5jZSI6MTAwLjAsIkltYWdlSWQiOiIwY2RmNDgzZi02ZDQ4LTM3ZDAtYTNkNS1iNzJhODViNjZmMTIifX0seyJTaW1pbGFyaXR5Ijo5OS44ODU4NywiRmFjZSI6eyJCb3VuZGluZ0JveCI6eyJIZWlnaHQiOjAuOTc0MzIzLCJXaWR0aCI6MC43MDc3MDMsIkxlZnQiOjAuMDUyMDQwMSwiVG9wIjotMC4wMDQyOTY5NX0sIkZhY2VJZCI6IjYyOGYyYjA3LThhY2ItNGI0OS1hZjc0LWVjYTY3NDE2YjdhMyIsIkNvbmZpZGVuY2UiOjk5Ljk5OTUsIkltYWdlSWQiOiIxMDZlODg4YS05YjFiLTNjM2EtODFmOC1hNmM4ODI5N2NmNDEifX0seyJTaW1pbGFyaXR5Ijo5OS44ODQ0NywiRmFjZSI6eyJCb3VuZGluZ0JveCI6eyJIZWlnaHQiOjAuOTY2Mjk4LCJXaWR0aCI6MC43MDc1MjQsIkxlZnQiOjAuMDU0Mzc4MiwiVG9wIjotMC4wMDEyODQ0fSwiRmFjZUlkIjoiMzY1MjFlN2MtOWJjMS00MzIxLWExZjktM2Y1YmYyYjdjNWUxIiwiQ29uZmlkZW5jZSI6OTkuOTk5NSwiSW1hZ2VJZCI6ImNhYzJlZDhlLWNhYTItMzAxNy1iNTI1LTBmMGRkMThhMDE5ZCJ9fSx7IlNpbWlsYXJpdHkiOjk5Ljg4MzE1LCJGYWNlIjp7IkJvdW5kaW5nQm94Ijp7IkhlaWdodCI6MC45NTcyMDksIldpZHRoIjowLjcyMzkxNSwiTGVmdCI6MC4wNTI4NjgsIlRvcCI6MC4wMDI2ODg2M30sIkZhY2VJZCI6IjFjYTBhOWU3LWYzNDEtNDQ5Yy04OGQ4LWQ2OWVkYjU5Njk1NiIsIkNvbmZpZGVuY2UiOjk5Ljk5OTQsIkltYWdlSWQiOiI0NDQzMWJmYi1jYTc4LTMxZTEtOTQ1NS02N2Q1OWQzZGI0MDgifX1dfV19", "approximateArrivalTimestamp": 1586930703.157}, "eventSource": "aws:kinesis", "eventVersion": "1.0", "eventID": "shardId-000000000000:49605974038509424079760656864102544007978456824330321922", "eventName": "aws:kinesis:record", "invokeIdentityArn": "arn:aws:iam::090918556265:role/LambdaKinesis", "awsRegion": "us-east-1", "eventSourceARN": "arn:aws:kinesis:us-east-1:090918556265:stream/face-stream/consumer/face_consumer:1586654788"}, {"kinesis": {"kinesisSchemaVersion": "1.0", "partitionKey": "e4a38a83-fe6c-4e5e-9bd1-0c8e7a0f91d0", "sequenceNumber": "49605974038509424079760656864402357611242884997096407042", "data": "eyJJbnB1dEluZm9ybWF0aW9uIjp7IktpbmVzaXNWaWRlbyI6eyJTdHJlYW1Bcm4iOiJhcm46YXdzOmtpbmVzaXN2aWRlbzp1cy1lYXN0LTE6MDkwOTE4NTU2MjY1OnN0cmVhbS9tYWNib29rLWNhbWVyYS8xNTg2NTU1MDU0OTg5IiwiRnJhZ21lbnROdW1iZXIiOiI5MTM0Mzg1MjMzMzE4MTY3MDA4MjEyMTM2NTU3ODA1MTk3Njg5ODQ0MDI4NTU4MCIsIlNlcnZlclRpbWVzdGFtcCI6MS41ODY5MzA2OTcxODNFOSwiUHJvZHVjZXJUaW1lc3RhbXAiOjEuNTg2OTMwNjk2MzM2RTksIkZyYW1lT2Zmc2V0SW5TZWNvbmRzIjo0LjAwMDk5OTkyNzUyMDc1Mn19LCJTdHJlYW1Qcm9jZXNzb3JJbmZvcm1hdGlvbiI6eyJTdGF0dXMiOiJSVU5OSU5HIn0sIkZhY2VTZWFyY2hSZXNwb25zZSI6W3siRGV0ZWN0ZWRGYWNlIjp7IkJvdW5kaW5nQm94Ijp7IkhlaWdodCI6MC41MDk0MTgzLCJXaWR0aCI6MC4yOTUzMDk3LCJMZWZ0IjowLjM3NDY3ODEzLCJUb3AiOjAuNDYwNDQ2NjN9LCJDb25maWRlbmNlIjo5OS45OTk5NiwiTGFuZG1hcmtzIjpbeyJYIjowLjQzNzk4MzY2LCJZIjowLjYyMTU4ODA1LCJUeXBlIjoiZXllTGVmdCJ9LHsiWCI6MC41NzQ5NjMxLCJZIjowLjYxNTE1MzIsIlR5cGUiOiJleWVSaWdodCJ9LHsiWCI6MC40NTgzMjUwNiwiWSI6MC44MzIzNzYsIlR5cGUiOiJtb3V0aExlZnQifSx7IlgiOjAuNTcxNDg1MywiWSI6MC44MjY4MzIyLCJUeXBlIjoibW91dGhSaWdodCJ9LHsiWCI6MC41MTgzNTM3LCJZIjowLjczMzQ2NSwiVHlwZSI6Im5vc2UifV0sIlBvc2UiOnsiUGl0Y2giOi0wLjUxNjM0NjIsIlJvbGwiOi0yLjQ5Mzc0LCJZYXciOjEuNzU3MTA3M30sIlF1YWxpdHkiOnsiQnJpZ2h0bmVzcyI6NzcuOTc4NTE2LCJTaGFycG5lc3MiOjc4LjY0MzV9fSwiTWF0Y2hlZEZhY2VzIjpbeyJTaW1pbGFyaXR5Ijo5OS45OTMxMSwiRmFjZSI6eyJCb3VuZGluZ0JveCI6eyJIZWlnaHQiOjAuNTEyMDc4LCJXaWR0aCI6MC4yNzc0NiwiTGVmdCI6MC4zNzAyLCJUb3AiOjAuNDMzODcyfSwiRmFjZUlkIjoiODllY2RkYmEtZmJlNy00N2NjLWEyMWEtM2U3NWYwNmY0YTI4IiwiQ29uZmlkZW5jZSI6OTkuOTk5OSwiSW1hZ2VJZCI6IjMzYzI3MzA4LWY1NzctM2JmYS1hODkzLWEyOWUxNGUyMmI1NSJ9fSx7IlNpbWlsYXJpdHkiOjk5Ljk5MTI3LCJGYWNlIjp7IkJvdW5kaW5nQm94Ijp7IkhlaWdodCI6MC40NjMzNTIsIldpZHRoIjowLjI1MjkxMywiTGVmdCI6MC4zOTg5MjgsIlRvcCI6MC41MTQxNzJ9LCJGYWNlSWQiOiIzYWY0YzFmMC0xYzU3LTQ1NmYtOTI2Ni1jMzA4YjkzNmMxZWYiLCJDb25maWRlbmNlIjoxMDAuMCwiSW1hZ2VJZCI6ImE4NzkyMGEwLTA1ZGEtMzg5YS04ZjgwLWY3NzkyZGMwMWQwNyJ9fSx7IlNpbWlsYXJpdHkiOjk5Ljk5MDc1LCJGYWNlIjp7IkJvdW5kaW5nQm94Ijp7IkhlaWdodCI6MC40NzgzMzcsIldpZHRoIjowLjI5ODE3MywiTGVmdCI6MC40MjE5MjcsIlRvcCI6MC40NzU4NjN9LCJGYWNlSWQiOiI2OTNiZTUwMS05NDM4LTRmZmMtOGE0Mi1mMzI3YjAyOWJiOWMiLCJDb25maWRlbmNlIjo5OS45OTk5LCJJbWFnZUlkIjoiNjMwYjQ1ZDEtM2ZiMS0zMDA3LWEzZDctZmFmYWY2MGQ5YzM4In19LHsiU2ltaWxhcml0eSI6OTkuOTg5NTI1LCJGYWNlIjp7IkJvdW5kaW5nQm94Ijp7IkhlaWdodCI6MC41MTQzNjMsIldpZHRoIjowLjI4MjczOSwiTGVmdCI6MC40NDQyMDMsIlRvcCI6MC40Nzg0NDF9LCJGYWNlSWQiOiIyNDMwMWUyZi1lMmU4LTQ3ZWYtYTYyOS00NTY5YjZmZTMzYzAiLCJDb25maWRlbmNlIjoxMDAuMCwiSW1hZ2VJZCI6IjNhMGJiNWRkLTU5MWUtM2ZjMS1hMzcxLWM1OWMxMjZmYjI4MiJ9fSx7IlNpbWlsYXJpdHkiOjk5Ljk4ODQ0LCJGYWNlIjp7IkJvdW5kaW5nQm94Ijp7IkhlaWdodCI6MC40ODI0MDYsIldpZHRoIjowLjI5NjA4NCwiTGVmdCI6MC40MjUzMywiVG9wIjowLjQ3MzI3NH0sIkZhY2VJZCI6IjU0N2M3NDJmLWUzY2MtNDNkZS05Yjk2LWVlOWQ3N2YzOGUxZiIsIkNvbmZpZGVuY2UiOjk5Ljk5OTksIkltYWdlSWQiOiJjYzUyNjBjYy04NjNjLTM0NWItOWE2NS0yMzU5YmFjZjYwZGQifX0seyJTaW1pbGFyaXR5Ijo5OS45ODQ2NSwiRmFjZSI6eyJCb3VuZGluZ0JveCI6eyJIZWlnaHQiOjAuNDM3MDI0LCJXaWR0aCI6MC4yNDY5ODUsIkxlZnQiOjAuMzYzNTk5LCJUb3AiOjAuNTE0Nzc1fSwiRmFjZUlkIjoiZWU5OGY2MmQtOGViYy00YmU2LTg2MGEtMzgyNTYxZmQyMDllIiwiQ29uZmlkZW5jZSI6MTAwLjAsIkltYWdlSWQiOiI3OTAwZTBmOC1mY2EzLTMyMjktODU4MS1iMDlkZmNhNDY0Y2MifX0seyJTaW1pbGFyaXR5Ijo5OS45NjI2NCwiRmFjZSI6eyJCb3VuZGluZ0JveCI6eyJIZWlnaHQiOjAuMzk3NDkyLCJXaWR0aCI6MC4yMzU0OTIsIkxlZnQiOjAuMzcwMzc0LCJUb3AiOjAuNjE4NjIxfSwiRmFjZUlkIjoiMzIwNDk4NzQtYjc0My00YjAwLThhMTktNzkzZTk0YWY0MTliIiwiQ29uZmlkZW5jZSI6MTAwLjAsIkltYWdlSWQiOiI2OWJmYjc3ZS1lNTM3LTMyNDEtYTI3ZS1mYTE3MTk3YmQ0MTUifX0seyJTaW1pbGFyaXR5Ijo5OS45NTgwMSwiRmFjZSI6eyJCb3VuZGluZ0JveCI6eyJIZWlnaHQiOjAuNjg1MDg2LCJXaWR0aCI6MC41MTY5NDIsIkxlZnQiOjAuMTYwMDMxLCJUb3AiOjAuMjc0NTM1fSwiRmFjZUlkIjoiYmUwMzIzOTMtOTYyYi00OGJkLThjMWUtYzJlOWQ3Zjk5OWYwIiwiQ29uZmlkZW5jZSI6OTkuOTk5NiwiSW1hZ2VJZCI6Ijc0ODIwNDg1LTNhZTctM2RhNy1hMmNiLWIzNWIyZDVhZTRmMCJ9fSx7IlNpbWlsYXJpdHkiOjk5Ljk1NDc0LCJGYWNlIjp7IkJvdW5kaW5nQm94Ijp7IkhlaWdodCI6MC4zNzgxODYsIldpZHRoIjowLjIwNjUyMSwiTGVmdCI6MC4zMDg1NDQsIlRvcCI6MC41MDg5NTN9LCJGYWNlSWQiOiIxYzlmMWNhOC03NmFhLTQyNjEtOTQ1MS1lM2Q5ZTY5NTIzM2UiLCJDb25maWRlbmNlIjoxMDAuMCwiSW1hZ2VJZCI6ImU0MTI3ZjA0LWM3NWEtMzMwYi05OWM3LWZhOTNhMTRmNDI2ZCJ9fSx7IlNpbWlsYXJpdHkiOjk5Ljk1MjQ0LCJGYWNlIjp7IkJvdW5kaW5nQm94Ijp7IkhlaWdodCI6MC40Njk2MzIsIldpZHRoIjowLjI1NTc0NywiTGVmdCI6MC4zNjc3NjksIlRvcCI6MC40MzE5NX0sIkZhY2VJZCI6IjdmYmI2Nzk1LTMyNzUtNDAxYy05NmUyLTAzMTQzZmI5ODAxNSIsIkNvbmZpZGVuY2UiOjEwMC4wLCJJbWFnZUlkIjoiYjhiNmRkMzctMzc1MS0zZjIyLWEwMmItYjM5M2VjYzliMzdjIn19LHsiU2ltaWxhcml0eSI6OTkuOTQ0MzMsIkZhY2UiOnsiQm91bmRpbmdCb3giOnsiSGVpZ2h0IjowLjU3Nzk5MSwiV2lkdGgiOjAuNTk2NjQ0LCJMZWZ0IjowLjM0MDQwNiwiVG9wIjowLjQxMDU1Mn0sIkZhY2VJZCI6IjExNWY4ZmY5LWJhZmQtNGI0NC04YjI4LTMzN2UxNDVhMzFjMSIsIkNvbmZpZGVuY2UiOjk5Ljk5OTcsIkltYWdlSWQiOiJkMGMxZWIwYy05YjM0LTM1YjItYjlmMC1mNmIyZjU2MDM2OGMifX0seyJTaW1pbGFyaXR5Ijo5OS45MzY2NDYsIkZhY2UiOnsiQm91bmRpbmdCb3giOnsiSGVpZ2h0IjowLjM4OTExMywiV2lkdGgiOjAuMjM2Njk0LCJMZWZ0IjowLjQwOTg2LCJUb3AiOjAuNjcwMjV9LCJGYWNlSWQiOiI5ZjNiNTk5Ni04MGQ2LTQ5M2EtYWI1NC01MDQzOGI5ZjU2M2YiLCJDb25maWRlbmNlIjoxMDAuMCwiSW1hZ2VJZCI6IjY3M2I4YTkzLTg1MmUtM2UxNS05OTU1LTQwNmFiZjZmYzAwZiJ9fSx7IlNpbWlsYXJpdHkiOjk5LjkzNjYsIkZhY2UiOnsiQm91bmRpbmdCb3giOnsiSGVpZ2h0IjowLjM0NjYyNywiV2lkdGgiOjAuMTg5MzczLCJMZWZ0IjowLjM1Njc2MiwiVG9wIjowLjUyMTM3NH0sIkZhY2VJZCI6Ijc1NTUwOGZmLWNhMmQtNDM3YS04ZWRjLTE2MDk5NzI5NTM3OSIsIkNvbmZpZGVuY2UiOjEwMC4wLCJJbWFnZUlkIjoiZDE3ZjgzYjgtMTZkYy0zNDBmLTllMzYtZDAzN2ZmOTVjMTMxIn19LHsiU2ltaWxhcml0eSI6OTkuOTIxNzE1LCJGYWNlIjp7IkJvdW5kaW5nQm94Ijp7IkhlaWdodCI6MC40NzI3MjUsIldpZHRoIjowLjI1OTE1NSwiTGVmdCI6MC4zMjU0NzMsIlRvcCI6MC41MTc4NTl9LCJGYWNlSWQiOiIzYzBiNTI2ZS1hZWMzLTQxMWItYmNiNC0xNTNkYTMxMzVlZjAiLCJDb25maWRlbmNlIjo5OS45OTk5LCJJbWFnZUlkIjoiODM2N2MwYmUtMTM4OS0zOGEzLWEwNDAtNjFkYWUzNmY4ZGM1In19LHsiU2ltaWxhcml0eSI6OTkuOTE3ODcsIkZhY2UiOnsiQm91bmRpbmdCb3giOnsiSGVpZ2h0IjowLjY0MDI5MiwiV2lkdGgiOjAuNTA5NjY4LCJMZWZ0IjowLjIyNTc3NCwiVG9wIjowLjMyMDc0NH0sIkZhY2VJZCI6ImJmZTFmZWFkLTc1NTItNGZlMC05NTExLWM1MGZlYjViMTdmMSIsIkNvbmZpZGVuY2UiOjk5Ljk5OTMwNiwiSW1hZ2VJZCI6Ijk5MDZkNjI3LTUzYmYtMzQxMS04ZmVkLWE1Zjc0ZmQ0NGQ2NSJ9fSx7IlNpbWlsYXJpdHkiOjk5LjkxMzI3LCJGYWNlIjp7IkJvdW5kaW5nQm94Ijp7IkhlaWdodCI6MC4zNzU5ODgsIldpZHRoIjowLjIzMzM4NywiTGVmdCI6MC4zNzQwNTMsIlRvcCI6MC42ODEyOTd9LCJGYWNlSWQiOiJjYzdhZWUxZC00ZmU0LTQ1YjUtOWU3Ny1mN2Y0ZTE2NzVhOTciLCJDb25maWRlbmNlIjoxMDAuMCwiSW1hZ2VJZCI6ImZjNjBiNmY0LTIwNmEtM2MyMC05ZjA1LTA3NTI3NjcwNjhlMCJ9fSx7IlNpbWlsYXJpdHkiOjk5LjkxMjIsIkZhY2UiOnsiQm91bmRpbmdCb3giOnsiSGVpZ2h0IjowLjQ3MTc3OCwiV2lkdGgiOjAuMzU1NTU4LCJMZWZ0Ijo1LjU2MjY2RS01LCJUb3AiOjAuNTY0OTA4fSwiRmFjZUlkIjoiYmFhYmRmMDgtNWI2NC00NjhlLWFiMmQtNTQwYzc1NzM4YTQ2IiwiQ29uZmlkZW5jZSI6MTAwLjAsIkltYWdlSWQiOiIwY2RmNDgzZi02ZDQ4LTM3ZDAtYTNkNS1iNzJhODViNjZmMTIifX0seyJTaW1pbGFyaXR5Ijo5OS45MDE4MSwiRmFjZSI6eyJCb3VuZGluZ0JveCI6eyJIZWlnaHQiOjAuNjg3ODg3LCJXaWR0aCI6MC41NDA1NzQsIkxlZnQiOi0wLjAwOTI4Mjk0LCJUb3AiOjAuMzkwNjQ0fSwiRmFjZUlkIjoiNjkxMzM0NjgtN2Q2ZS00ZjY5LTljYzQtOWVkNjNmZTc1YmVkIiwiQ29uZmlkZW5jZSI6MTAwLjAsIkltYWdlSWQiOiJiZjY0MzRjOS05MjI1LTNiMDYtYWVlMi02MzZhMjExMTU5NmEifX0seyJTaW1pbGFyaXR5Ijo5OS45MDA1NCwiRmFjZSI6eyJCb3VuZGluZ0JveCI6eyJIZWlnaHQiOjAuNjEyNzA5LCJXaWR0aCI6MC40NjQwMjIsIkxlZnQiOjAuMDAzMTM4MDUsIlRvcCI6MC40MTk0Nzl9LCJGYWNlSWQiOiIxMDRkYjI2ZS04ZjVhLTRmZWEtYWRjOS1hMGE1NzM5YjRmMzAiLCJDb25maWRlbmNlIjoxMDAuMCwiSW1hZ2VJZCI6ImRhODllN2RmLWY3NTUtMzVlNy1hMWUxLTdlNGVkYWI2Y2EyNyJ9fSx7IlNpbWlsYXJpdHkiOjk5Ljg5OTkxLCJGYWNlIjp7IkJvdW5kaW5nQm94Ijp7IkhlaWdodCI6MC42MTE0NDEsIldpZHRoIjowLjUwODI2MiwiTGVmdCI6LTAuMDIyNzA5NCwiVG9wIjowLjM5NTA1MX0sIkZhY2VJZCI6ImUyNzViZmU3LTZjNzctNDNiYy1hZTY1LTFiZWVlNzk3NWFhZCIsIkNvbmZpZGVuY2UiOjk5Ljk5OTUsIkltYWdlSWQiOiI5ZTBjM2RiZC03YTJkLTMyZGMtYTQ3Mi05YTZiZDM2NmFkYTQifX1dfV19", "approximateArrivalTimestamp": 1586930704.229}, "eventSource": "aws:kinesis", "eventVersion": "1.0", "eventID": "shardId-000000000000:49605974038509424079760656864402357611242884997096407042", "eventName": "aws:kinesis:record", "invokeIdentityArn": "arn:aws:iam::090918556265:role/LambdaKinesis", "awsRegion": "us-east-1", "eventSourceARN": "arn:aws:kinesis:us-east-1:090918556265:stream/face-stream/consumer/face_consumer:1586654788"}]}
 """
 
+def run_frames(face_records, frames, s3_handler, reko_handler, quality_gate=None, sampler=None, tracker=None):
+    # records of one fragment through the Lambda pipeline, with their frames already fetched
+    groups = lambda_function.group_by_fragment(face_records)
+    face_tracks = lambda_function.track_faces(face_records, tracker) if tracker is not None else None
+    with mock.patch("lambda_function.fetch_fragment", return_value=frames), \
+            Pipeline(media=1, faces=2, upload=2) as pipeline:
+        photos, failed = lambda_function.run_pipeline(pipeline, groups, s3_handler, reko_handler, quality_gate,
+                                                      sampler, face_tracks)
+    assert failed == {}, failed
+    return photos
+
+
 class KVSTest(unittest.TestCase):
 
     def test_lambda(self):
@@ -72,3 +121,1661 @@ class KVSTest(unittest.TestCase):
                 dynamo_handler.create_image_record(face_id, s3_handler.bucket_name, "face.jpg")
             break
 
+
+class FakeClient:
+    """Stands in for every boto3 client and counts the API calls."""
+
+    def __init__(self, service, **kwargs):
+        self.service = service
+        self.calls = []
+        self.keys = []
+        self.images = []
+
+    def get_data_endpoint(self, **kwargs):
+        self.calls.append("get_data_endpoint")
+        return {"DataEndpoint": "https://media.example.com"}
+
+    def get_media(self, **kwargs):
+        self.calls.append("get_media")
+        return {"ContentType": "video/webm", "Payload": io.BytesIO(b"")}
+
+    def upload_file(self, *args):
+        self.calls.append("upload_file")
+
+    def put_object(self, **kwargs):
+        self.calls.append("put_object")
+        self.keys.append(kwargs["Key"])
+
+    def index_faces(self, **kwargs):
+        self.calls.append("index_faces")
+        self.images.append(kwargs["Image"])
+        return {"FaceRecords": [{"Face": {"FaceId": "face-1",
+                                          "BoundingBox": {"Top": 0.1, "Left": 0.1, "Height": 0.5, "Width": 0.5}}}]}
+
+    def get_item(self, **kwargs):
+        self.calls.append("get_item")
+        return {}
+
+    def put_item(self, **kwargs):
+        self.calls.append("put_item")
+
+    def update_item(self, **kwargs):
+        self.calls.append("update_item")
+
+
+def camera_frame():
+    # a textured frame that passes the quality gate
+    return np.random.default_rng(0).integers(0, 255, (480, 640, 3), dtype=np.uint8)
+
+
+class RegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        registry.reset()
+        kv_media_handler.reset_endpoints()
+        kv_media_handler.fragment_cache.clear()
+        self.clients = []
+
+    def tearDown(self):
+        registry.reset()
+        kv_media_handler.reset_endpoints()
+        kv_media_handler.fragment_cache.clear()
+
+    def make_client(self, service, **kwargs):
+        client = FakeClient(service, **kwargs)
+        self.clients.append(client)
+        return client
+
+    def count_calls(self, name):
+        return sum(client.calls.count(name) for client in self.clients)
+
+    def test_clients_reused_across_invocations(self):
+        event = json.loads(response_json)
+        frame = np.zeros((48, 64, 3), dtype=np.uint8)
+        with mock.patch("boto3.client", side_effect=self.make_client), \
+                mock.patch.object(kv_media_handler, "extract_frames",
+                                  side_effect=lambda payload, offsets: [frame.copy() for _ in offsets]):
+            for _ in range(3):
+                lambda_handler(event, None)
+
+        services = sorted(client.service for client in self.clients)
+        self.assertEqual(services, ["dynamodb", "kinesis-video-media", "kinesisvideo", "rekognition", "s3"])
+        self.assertEqual(self.count_calls("get_data_endpoint"), 1)
+        # both records share a fragment, later invocations hit the fragment cache
+        self.assertEqual(self.count_calls("get_media"), 1)
+
+    def test_archive_frame_modes(self):
+        event = json.loads(response_json)
+        frame = camera_frame()
+        uploaded = {}
+        for mode in ["sync", "background", "off"]:
+            registry.reset()
+            kv_media_handler.fragment_cache.clear()
+            self.clients = []
+            with mock.patch("boto3.client", side_effect=self.make_client), \
+                    mock.patch("lambda_function.ARCHIVE_FRAME", mode), \
+                    mock.patch("lambda_function.MIN_INTERVAL", 0), \
+                    mock.patch.object(kv_media_handler, "extract_frames",
+                                      side_effect=lambda payload, offsets: [frame.copy() for _ in offsets]):
+                lambda_handler(event, None)
+            s3_client = next(c for c in self.clients if c.service == "s3")
+            reko_client = next(c for c in self.clients if c.service == "rekognition")
+            uploaded[mode] = sorted(s3_client.keys)
+            # every face of the fixture was matched by the stream processor
+            self.assertEqual(reko_client.images, [])
+
+        self.assertEqual(uploaded["sync"], uploaded["background"])
+        self.assertEqual(len(uploaded["sync"]), 4)
+        self.assertEqual(len(uploaded["off"]), 2)
+        self.assertFalse(any("_frame" in key for key in uploaded["off"]))
+
+    def test_only_unmatched_faces_indexed(self):
+        face_recognition_record = decode_base64_and_load_json(json.loads(response_json)["Records"][0]["kinesis"]["data"])
+        matched = face_recognition_record["FaceSearchResponse"][0]
+        weak = json.loads(json.dumps(matched))
+        for m in weak["MatchedFaces"]:
+            m["Similarity"] = 50.0
+        unmatched = {"DetectedFace": matched["DetectedFace"], "MatchedFaces": []}
+        face_recognition_record["FaceSearchResponse"] = [matched, weak, unmatched]
+
+        s3_client = FakeClient("s3")
+        reko_client = FakeClient("rekognition")
+        with mock.patch("boto3.client", side_effect=[s3_client, reko_client]):
+            s3_handler = S3Handler("visitor-images")
+            reko_handler = RekoHanlder("Faces", "FaceDetect")
+        frame = np.zeros((48, 64, 3), dtype=np.uint8)
+        with mock.patch("lambda_function.ARCHIVE_FRAME", "off"):
+            photos = run_frames([face_recognition_record], [frame], s3_handler, reko_handler)
+
+        self.assertEqual(reko_client.calls, ["index_faces", "index_faces"])
+        self.assertTrue(all("Bytes" in image for image in reko_client.images))
+        self.assertEqual(len(s3_client.keys), 3)
+        self.assertEqual(len(photos), 3)
+
+    def test_endpoint_invalidated_on_error(self):
+        with mock.patch("boto3.client", side_effect=self.make_client):
+            handler = KVMediaHandler("arn:stream")
+            client = handler.get_client()
+            client.get_media = mock.Mock(side_effect=RuntimeError("connection reset"))
+            with self.assertRaises(RuntimeError):
+                handler.get_image_from_stream(1586930696.336, 0)
+            handler.get_client()
+        self.assertEqual(self.count_calls("get_data_endpoint"), 2)
+
+    def test_endpoint_expires(self):
+        with mock.patch("boto3.client", side_effect=self.make_client):
+            kv_media_handler.get_endpoint("arn:stream")
+            kv_media_handler.get_endpoint("arn:stream")
+            kv_media_handler.get_endpoint("arn:stream", ttl=0)
+        self.assertEqual(self.count_calls("get_data_endpoint"), 2)
+
+
+def h264_frame(luma, mb_width, mb_height):
+    """An IDR slice made of uncompressed I_PCM macroblocks, filled with one gray level."""
+    slice_data = bytearray(bytes.fromhex("05888421a0"))
+    for i in range(mb_width * mb_height):
+        if i > 0:
+            slice_data += bytes.fromhex("0d00")
+        slice_data += bytes([luma]) * 256 + bytes([128]) * 128
+    slice_data += b"\x80"
+    return bytes(slice_data)
+
+
+def h264_mkv(lumas, fps=10, frames_per_cluster=10, start=0):
+    """A 128x96 H.264 Matroska file, one frame per gray level, keyframe flag at each cluster start."""
+    sps = bytes.fromhex("6742000af841a2")
+    pps = bytes.fromhex("68ce3880")
+    avcc = bytes([1, 0x42, 0x00, 0x0a, 0xff, 0xe1]) + len(sps).to_bytes(2, "big") + sps + \
+        bytes([1]) + len(pps).to_bytes(2, "big") + pps
+    header = mkv.element(mkv.EBML, mkv.element(0x4282, b"matroska") + mkv.uint_element(0x4287, 2))
+    info = mkv.element(mkv.INFO, mkv.uint_element(mkv.TIMECODE_SCALE, 1000000))
+    video = mkv.element(0xE0, mkv.uint_element(0xB0, 128) + mkv.uint_element(0xBA, 96))
+    track = mkv.element(mkv.TRACK_ENTRY, mkv.uint_element(mkv.TRACK_NUMBER, 1) + mkv.uint_element(0x73C5, 1) +
+                        mkv.uint_element(mkv.TRACK_TYPE, 1) + mkv.element(0x86, b"V_MPEG4/ISO/AVC") +
+                        mkv.element(0x63A2, avcc) + video)
+    clusters = b""
+    for first in range(0, len(lumas), frames_per_cluster):
+        cluster_timecode = start + first * 1000 // fps
+        blocks = mkv.uint_element(mkv.TIMECODE, cluster_timecode)
+        for i in range(first, min(first + frames_per_cluster, len(lumas))):
+            nal = h264_frame(lumas[i], 8, 6)
+            flags = 0x80 if i == first else 0x00
+            relative = (i - first) * 1000 // fps
+            blocks += mkv.element(mkv.SIMPLE_BLOCK, bytes([0x81]) + relative.to_bytes(2, "big") + bytes([flags]) +
+                                  len(nal).to_bytes(4, "big") + nal)
+        clusters += mkv.element(mkv.CLUSTER, blocks)
+    return header + mkv.element(mkv.SEGMENT, info + mkv.element(mkv.TRACKS, track) + clusters)
+
+
+class StreamingBody:
+    """Only supports read and close, like the GetMedia payload."""
+
+    def __init__(self, data):
+        self.stream = io.BytesIO(data)
+
+    def read(self, size):
+        return self.stream.read(size)
+
+    def close(self):
+        self.stream.close()
+
+
+def gray_level(frame):
+    # the decoder maps the limited range luma back to full range, gray levels are 7 apart
+    luma = frame.mean() * 219 / 255 + 16
+    return MkvTest.lumas[int(np.argmin([abs(luma - level) for level in MkvTest.lumas]))]
+
+
+class MkvTest(unittest.TestCase):
+    lumas = [20 + 7 * i for i in range(30)]
+
+    def test_frame_at_offset(self):
+        data = h264_mkv(self.lumas)
+        for offset, expected in [(0, 0), (0.5, 5), (1.0, 10), (1.5, 15), (2.9, 29), (1.2499, 12)]:
+            frame = kv_media_handler.extract_frame(StreamingBody(data), offset)
+            self.assertEqual(frame.shape, (96, 128, 3))
+            self.assertEqual(gray_level(frame), self.lumas[expected], offset)
+
+    def test_reads_only_up_to_offset(self):
+        data = h264_mkv(self.lumas)
+        reader = mkv.MkvReader(StreamingBody(data))
+        blocks, indexes = mkv.select_blocks(reader, [1.3])
+        # decoding starts at the keyframe of the second cluster
+        self.assertEqual(len(blocks), 4)
+        self.assertTrue(blocks[0].keyframe)
+        self.assertEqual(indexes, [3])
+        self.assertLess(reader.bytes_read, len(data) * 2 / 3)
+
+    def test_offset_past_the_end(self):
+        frame = kv_media_handler.extract_frame(StreamingBody(h264_mkv(self.lumas)), 10)
+        self.assertEqual(gray_level(frame), self.lumas[-1])
+
+    def test_fragments_in_one_stream(self):
+        # GetMedia returns one Matroska document per fragment
+        data = h264_mkv(self.lumas[:20], start=0) + h264_mkv(self.lumas[20:], start=2000)
+        frames = mkv.extract_frames(StreamingBody(data), [2.5, 0.3])
+        self.assertEqual([gray_level(f) for f in frames], [self.lumas[25], self.lumas[3]])
+
+    def test_opencv_without_stream_capture(self):
+        # an OpenCV older than 4.11 decodes from a temporary file, removed once read
+        paths = []
+        mkstemp = mkv.tempfile.mkstemp
+
+        def temporary(**kwargs):
+            fd, path = mkstemp(**kwargs)
+            paths.append(path)
+            return fd, path
+        data = h264_mkv(self.lumas[:20], start=0) + h264_mkv(self.lumas[20:], start=2000)
+        with mock.patch.object(mkv, "reads_streams", return_value=False), \
+                mock.patch.object(mkv.tempfile, "mkstemp", temporary):
+            frames = mkv.extract_frames(StreamingBody(data), [2.5, 0.3])
+        self.assertEqual([gray_level(f) for f in frames], [self.lumas[25], self.lumas[3]])
+        self.assertTrue(paths)
+        self.assertFalse(any(os.path.exists(path) for path in paths))
+
+    def test_not_a_video(self):
+        with self.assertRaises(RuntimeError):
+            kv_media_handler.extract_frame(StreamingBody(b""), 0)
+
+
+class FragmentCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        kv_media_handler.fragment_cache.clear()
+
+    def tearDown(self):
+        kv_media_handler.fragment_cache.clear()
+
+    def test_lru_eviction(self):
+        cache = FragmentCache(max_bytes=3 * 100)
+        for fragment in ["a", "b", "c"]:
+            cache.put(("arn", fragment), 0.0, np.zeros(100, dtype=np.uint8))
+        self.assertIsNotNone(cache.get(("arn", "a"), 0.0))
+        cache.put(("arn", "d"), 0.0, np.zeros(100, dtype=np.uint8))
+
+        self.assertIsNone(cache.get(("arn", "b"), 0.0))
+        self.assertIsNotNone(cache.get(("arn", "a"), 0.0))
+        self.assertIsNone(cache.get(("arn", "a"), 1.0))
+        self.assertEqual(cache.stats(), {"hits": 2, "misses": 2, "evictions": 1, "fragments": 3, "bytes": 300})
+
+    def test_fragment_fetched_once(self):
+        data = h264_mkv(MkvTest.lumas)
+        client = mock.Mock()
+        client.get_media.side_effect = lambda **kwargs: {"ContentType": "video/h264",
+                                                         "Payload": StreamingBody(data)}
+        handler = KVMediaHandler("arn:stream")
+        handler.client = client
+        handler.endpoint = "https://media.example.com"
+        with mock.patch.object(kv_media_handler, "get_endpoint", return_value=handler.endpoint):
+            frames = handler.get_images_from_fragment("1", 1586930696.336, [0.5, 2.0, 1.0])
+            again = handler.get_images_from_fragment("1", 1586930696.336, [1.0, 2.5])
+
+        self.assertEqual([gray_level(f) for f in frames], [MkvTest.lumas[5], MkvTest.lumas[20], MkvTest.lumas[10]])
+        self.assertEqual([gray_level(f) for f in again], [MkvTest.lumas[10], MkvTest.lumas[25]])
+        self.assertEqual(client.get_media.call_count, 2)
+        self.assertFalse(frames[0].flags.writeable)
+
+
+class EncodeImageTest(unittest.TestCase):
+
+    def test_quality_and_format(self):
+        image = np.random.default_rng(0).integers(0, 255, (96, 128, 3), dtype=np.uint8)
+        low = kv_media_handler.encode_image(image, ".jpg", 20)
+        high = kv_media_handler.encode_image(image, ".jpg", 95)
+        png = kv_media_handler.encode_image(image, ".png")
+        self.assertLess(len(low), len(high))
+        self.assertTrue(png.startswith(b"\x89PNG"))
+        decoded = cv2.imdecode(np.frombuffer(png, dtype=np.uint8), cv2.IMREAD_COLOR)
+        self.assertTrue((decoded == image).all())
+
+
+class FakeDynamoDB:
+    """In-memory table that understands the expressions DynamoHandler sends."""
+
+    def __init__(self, failures=()):
+        self.items = {}
+        # items of the time series layout, keyed by (faceId, capturedAt)
+        self.rows = {}
+        self.calls = []
+        # error codes raised by the next write calls, one per call
+        self.failures = list(failures)
+
+    def fail(self, operation):
+        if self.failures:
+            code = self.failures.pop(0)
+            raise ClientError({"Error": {"Code": code, "Message": code}}, operation)
+
+    def get_item(self, TableName, Key, **kwargs):
+        self.calls.append("get_item")
+        item = self.items.get(Key["faceId"]["S"])
+        return {"Item": item} if item is not None else {}
+
+    def put_item(self, TableName, Item):
+        self.calls.append("put_item")
+        self.fail("PutItem")
+        if "capturedAt" in Item:
+            self.rows[(Item["faceId"]["S"], int(Item["capturedAt"]["N"]))] = Item
+        else:
+            self.items[Item["faceId"]["S"]] = Item
+
+    def batch_write_item(self, RequestItems):
+        self.calls.append("batch_write_item")
+        (table, requests), = RequestItems.items()
+        assert len(requests) <= 25
+        keys = [(r["PutRequest"]["Item"]["faceId"]["S"], r["PutRequest"]["Item"]["capturedAt"]["N"]) for r in requests]
+        assert len(keys) == len(set(keys))
+        if self.failures and self.failures[0] == "Unprocessed":
+            # DynamoDB skips part of the batch under load
+            self.failures.pop(0)
+            unprocessed, requests = requests[len(requests) // 2:], requests[:len(requests) // 2]
+        else:
+            self.fail("BatchWriteItem")
+            unprocessed = []
+        for r in requests:
+            item = r["PutRequest"]["Item"]
+            self.rows[(item["faceId"]["S"], int(item["capturedAt"]["N"]))] = item
+        return {"UnprocessedItems": {table: unprocessed} if unprocessed else {}}
+
+    def query(self, TableName, KeyConditionExpression, ExpressionAttributeValues, ScanIndexForward, Limit,
+              ExclusiveStartKey=None):
+        self.calls.append("query")
+        values = ExpressionAttributeValues
+        start = int(values[":start"]["N"]) if ":start" in values else 0
+        end = int(values[":end"]["N"]) if ":end" in values else 2 ** 53
+        rows = sorted((captured_at, item) for (face_id, captured_at), item in self.rows.items()
+                      if face_id == values[":f"]["S"] and start <= captured_at <= end)
+        if not ScanIndexForward:
+            rows.reverse()
+        if ExclusiveStartKey is not None:
+            last = int(ExclusiveStartKey["capturedAt"]["N"])
+            rows = [r for r in rows if (r[0] > last if ScanIndexForward else r[0] < last)]
+        page = [item for _, item in rows[:Limit]]
+        response = {"Items": page}
+        if len(rows) > Limit:
+            response["LastEvaluatedKey"] = {"faceId": page[-1]["faceId"], "capturedAt": page[-1]["capturedAt"]}
+        return response
+
+    def check(self, Key, ExpressionAttributeValues, ConditionExpression=None, **kwargs):
+        # only "NOT contains(photoKeys, :kN) AND ..." is understood
+        if ConditionExpression is None:
+            return True
+        item = self.items.get(Key["faceId"]["S"], {})
+        stored = set(item.get("photoKeys", {}).get("SS", []))
+        names = [c[len("NOT contains(photoKeys, "):-1] for c in ConditionExpression.split(" AND ")]
+        return not any(ExpressionAttributeValues[name]["S"] in stored for name in names)
+
+    def apply_update(self, Key, UpdateExpression, ExpressionAttributeValues, **kwargs):
+        face_id = Key["faceId"]["S"]
+        values = ExpressionAttributeValues
+        if UpdateExpression == "SET photos = list_append(if_not_exists(photos, :empty), :i) ADD photoKeys :keys":
+            item = self.items.setdefault(face_id, {"faceId": {"S": face_id}, "photos": values[":empty"]})
+            stored = item.get("photoKeys", {}).get("SS", [])
+            item["photoKeys"] = {"SS": sorted(set(stored) | set(values[":keys"]["SS"]))}
+        elif UpdateExpression == "SET photos = list_append(photos, :i)":
+            item = self.items[face_id]
+        else:
+            raise NotImplementedError(UpdateExpression)
+        item["photos"] = {"L": item["photos"]["L"] + values[":i"]["L"]}
+
+    def update_item(self, **kwargs):
+        self.calls.append("update_item")
+        self.fail("UpdateItem")
+        if not self.check(**kwargs):
+            raise ClientError({"Error": {"Code": "ConditionalCheckFailedException", "Message": "failed"}}, "UpdateItem")
+        self.apply_update(**kwargs)
+
+    def transact_write_items(self, TransactItems):
+        self.calls.append("transact_write_items")
+        self.fail("TransactWriteItems")
+        keys = [t["Update"]["Key"]["faceId"]["S"] for t in TransactItems]
+        assert len(keys) == len(set(keys)) <= 100
+        reasons = [{"Code": "None"} if self.check(**t["Update"]) else {"Code": "ConditionalCheckFailed"}
+                   for t in TransactItems]
+        if any(r["Code"] != "None" for r in reasons):
+            raise ClientError({"Error": {"Code": "TransactionCanceledException", "Message": "canceled"},
+                               "CancellationReasons": reasons}, "TransactWriteItems")
+        for t in TransactItems:
+            self.apply_update(**t["Update"])
+
+    def batch_get_item(self, RequestItems):
+        self.calls.append("batch_get_item")
+        (table, request), = RequestItems.items()
+        keys = request["Keys"]
+        assert len(keys) <= 100
+        unprocessed = []
+        if self.failures and self.failures[0] == "Unprocessed":
+            self.failures.pop(0)
+            keys, unprocessed = keys[:len(keys) // 2], keys[len(keys) // 2:]
+        items = [self.items[k["faceId"]["S"]] for k in keys if k["faceId"]["S"] in self.items]
+        response = {"Responses": {table: items}}
+        if unprocessed:
+            response["UnprocessedKeys"] = {table: {**request, "Keys": unprocessed}}
+        return response
+
+    def photo_keys(self, face_id):
+        return [p["M"]["objectKey"]["S"] for p in self.items[face_id]["photos"]["L"]]
+
+
+class FakeClock:
+    """monotonic and sleep of handler.throttle, sleeping only moves the clock."""
+
+    def __init__(self, test):
+        self.now = 1000.0
+        self.slept = []
+        for name, value in (("monotonic", lambda: self.now), ("sleep", self.sleep)):
+            patcher = mock.patch.object(throttle, name, value)
+            patcher.start()
+            test.addCleanup(patcher.stop)
+        throttle.reset()
+        metrics.reset()
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class DynamoWriteTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock(self)
+
+    def make_handler(self, client):
+        with mock.patch("boto3.client", return_value=client):
+            return DynamoHandler("visitors")
+
+    def test_upsert_is_one_call(self):
+        client = FakeDynamoDB()
+        handler = self.make_handler(client)
+        handler.upsert_image("face-1", "visitor-images", "a.jpg")
+        handler.upsert_image("face-1", "visitor-images", "b.jpg")
+        self.assertEqual(client.calls, ["update_item", "update_item"])
+        self.assertEqual(client.photo_keys("face-1"), ["a.jpg", "b.jpg"])
+
+    def test_flush_merges_faces(self):
+        client = FakeDynamoDB()
+        handler = self.make_handler(client)
+        handler.upsert_image("face-1", "visitor-images", "old.jpg")
+        for i in range(150):
+            handler.buffer_image(f"face-{i % 120}", "visitor-images", f"{i}.jpg")
+        handler.flush()
+
+        # 120 faces, 100 per transaction
+        self.assertEqual(client.calls, ["update_item", "transact_write_items", "transact_write_items"])
+        self.assertEqual(client.photo_keys("face-1"), ["old.jpg", "1.jpg", "121.jpg"])
+        self.assertEqual(client.photo_keys("face-119"), ["119.jpg"])
+        handler.flush()
+        self.assertEqual(len(client.calls), 3)
+
+    def test_flush_retries_throttling(self):
+        client = FakeDynamoDB(failures=["TransactionCanceledException", "ProvisionedThroughputExceededException"])
+        handler = self.make_handler(client)
+        handler.buffer_image("face-1", "visitor-images", "a.jpg")
+        handler.buffer_image("face-2", "visitor-images", "b.jpg")
+        handler.flush()
+        self.assertEqual(client.calls, ["transact_write_items"] * 3)
+        self.assertEqual(client.photo_keys("face-2"), ["b.jpg"])
+
+    def test_replayed_photos_are_not_appended_again(self):
+        client = FakeDynamoDB()
+        handler = self.make_handler(client)
+        handler.buffer_image("face-1", "visitor-images", "a.jpg")
+        handler.buffer_image("face-2", "visitor-images", "b.jpg")
+        handler.flush()
+        # the batch is read again with a new photo of face-1
+        handler.buffer_image("face-1", "visitor-images", "a.jpg")
+        handler.buffer_image("face-1", "visitor-images", "c.jpg")
+        handler.buffer_image("face-2", "visitor-images", "b.jpg")
+        handler.flush()
+        handler.upsert_image("face-2", "visitor-images", "b.jpg")
+
+        # the canceled transaction is not retried as is, each photo goes on its own
+        self.assertEqual(client.calls, ["transact_write_items"] * 2 + ["update_item"] * 4)
+        self.assertEqual(client.photo_keys("face-1"), ["a.jpg", "c.jpg"])
+        self.assertEqual(client.photo_keys("face-2"), ["b.jpg"])
+
+    def test_many_photos_of_a_face(self):
+        client = FakeDynamoDB()
+        handler = self.make_handler(client)
+        for i in range(120):
+            handler.buffer_image("face-1", "visitor-images", f"{i}.jpg")
+        handler.buffer_image("face-2", "visitor-images", "b.jpg")
+        handler.flush()
+        self.assertEqual(client.calls, ["transact_write_items", "update_item", "update_item"])
+        self.assertEqual(client.photo_keys("face-1"), [f"{i}.jpg" for i in range(120)])
+
+    def test_flush_raises_other_errors(self):
+        client = FakeDynamoDB(failures=["ValidationException"])
+        handler = self.make_handler(client)
+        handler.buffer_image("face-1", "visitor-images", "a.jpg")
+        with self.assertRaises(ClientError):
+            handler.flush()
+        self.assertEqual(client.calls, ["update_item"])
+
+
+class DynamoTimeSeriesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock(self)
+
+    def make_handler(self, client):
+        with mock.patch("boto3.client", return_value=client):
+            return DynamoHandler("visitors", layout="timeseries")
+
+    def test_create_with_sort_key(self):
+        client = mock.Mock()
+        self.make_handler(client).create()
+        key_schema = client.create_table.call_args.kwargs["KeySchema"]
+        self.assertEqual([k["KeyType"] for k in key_schema], ["HASH", "RANGE"])
+
+    def test_flush_in_batches_of_25(self):
+        client = FakeDynamoDB(failures=["Unprocessed"])
+        handler = self.make_handler(client)
+        for i in range(30):
+            handler.buffer_image("face-1", "visitor-images", f"{i}.jpg", 1000 + i)
+        # the same photo twice is written once
+        handler.buffer_image("face-1", "visitor-images", "0.jpg", 1000)
+        handler.flush()
+        self.assertEqual(client.calls, ["batch_write_item"] * 3)
+        self.assertEqual(len(client.rows), 30)
+
+    def test_latest_and_range_pages(self):
+        client = FakeDynamoDB()
+        handler = self.make_handler(client)
+        for i in range(7):
+            handler.upsert_image("face-1", "visitor-images", f"{i}.jpg", 1000 + i)
+        handler.upsert_image("face-2", "visitor-images", "other.jpg", 1003)
+
+        photos, next_key = handler.latest_images("face-1", limit=3)
+        self.assertEqual([p["objectKey"] for p in photos], ["6.jpg", "5.jpg", "4.jpg"])
+        photos, next_key = handler.latest_images("face-1", limit=3, start_key=next_key)
+        self.assertEqual([p["objectKey"] for p in photos], ["3.jpg", "2.jpg", "1.jpg"])
+
+        photos, next_key = handler.images_between("face-1", 1002, 1004)
+        self.assertEqual([p["capturedAt"] for p in photos], [1002, 1003, 1004])
+        self.assertIsNone(next_key)
+
+
+class FaceSamplerTest(unittest.TestCase):
+
+    def test_one_photo_per_interval(self):
+        sampler = FaceSampler(min_interval=5)
+        candidates = [("a", 100.0, 0.2), ("a", 101.0, 0.5), ("b", 101.0, 0.1), ("a", 104.9, 0.3),
+                      ("a", 105.0, 0.1), ("a", 107.0, 0.4)]
+        # the best of [100, 105) and of [105, 110) for a, the only one for b
+        self.assertEqual(sampler.select(candidates), [1, 2, 5])
+        self.assertEqual((sampler.kept, sampler.skipped), (3, 3))
+
+    def test_forget_reopens_the_window(self):
+        sampler = FaceSampler(min_interval=5)
+        self.assertEqual(sampler.select([("a", 100.0, 0.2)]), [0])
+        sampler.forget("a", 112.0)
+        self.assertEqual(sampler.archived([("a", 103.0, 0.1)]), [0])
+        sampler.forget("a", 103.0)
+        self.assertEqual(sampler.archived([("a", 103.0, 0.1)]), [])
+
+    def test_window_survives_invocations(self):
+        sampler = FaceSampler(min_interval=5)
+        self.assertEqual(sampler.select([("a", 100.0, 0.2)]), [0])
+        # already archived a photo in this window, even a better one is skipped
+        self.assertEqual(sampler.select([("a", 103.0, 0.9)]), [])
+        self.assertEqual(sampler.select([("a", 106.0, 0.1)]), [0])
+
+    def test_shared_store(self):
+        store = mock.Mock()
+        store.load.return_value = {"a": 100.0}
+        with mock.patch("handler.dedup.WindowStore", return_value=store):
+            sampler = FaceSampler(min_interval=5, table="visitor-windows")
+        self.assertEqual(sampler.select([("a", 102.0, 0.5), ("b", 102.0, 0.5)]), [1])
+        store.save.assert_called_once_with("b", 102.0, 5)
+
+    def test_store_backs_off_on_unprocessed_keys(self):
+        clock = FakeClock(self)
+        expires = {"N": str(int(time.time()) + 60)}
+        items = [{"faceId": {"S": f}, "windowStart": {"N": "100.0"}, "expiresAt": expires} for f in "ab"]
+        client = mock.Mock()
+        # one key left out when the table is at capacity, then served
+        client.batch_get_item.side_effect = [
+            {"Responses": {"windows": items[:1]},
+             "UnprocessedKeys": {"windows": {"Keys": [{"faceId": {"S": "b"}}]}}},
+            {"Responses": {"windows": items[1:]}},
+        ]
+        with mock.patch("boto3.client", return_value=client):
+            store = WindowStore("windows")
+        self.assertEqual(store.load(["a", "b"]), {"a": 100.0, "b": 100.0})
+        # a backoff, not a busy loop against the throttled table
+        self.assertTrue(clock.slept)
+        self.assertEqual(metrics.snapshot()["Retries"], 1)
+        self.assertEqual(metrics.snapshot()["ReadThrottles"], 1)
+
+    def test_records_without_kept_faces_are_dropped(self):
+        event = json.loads(response_json)
+        face_records = [decode_base64_and_load_json(r["kinesis"]["data"]) for r in event["Records"]]
+        unknown = {"DetectedFace": face_records[1]["FaceSearchResponse"][0]["DetectedFace"], "MatchedFaces": []}
+        face_records.append(json.loads(json.dumps(face_records[1])))
+        face_records[2]["FaceSearchResponse"].append(unknown)
+
+        sampler = FaceSampler(min_interval=5)
+        face_id = face_records[0]["FaceSearchResponse"][0]["MatchedFaces"][0]["Face"]["FaceId"]
+        self.assertEqual(sampler.select([(face_id, 1586930698.0, 1.0)]), [0])
+        sampled = sample_faces(face_records, sampler)
+        # the visitor already has a photo in this window, the unknown face is kept
+        self.assertEqual(len(sampled), 1)
+        self.assertEqual(sampled[0]["FaceSearchResponse"], [unknown])
+
+    def test_face_keeps_its_key_after_sampling(self):
+        event = json.loads(response_json)
+        face_record = decode_base64_and_load_json(event["Records"][1]["kinesis"]["data"])
+        known = face_record["FaceSearchResponse"][0]
+        unknown = {"DetectedFace": known["DetectedFace"], "MatchedFaces": []}
+        face_record["FaceSearchResponse"] = [known, unknown]
+        original = lambda_function.face_key(face_record, 1, None)
+
+        sampler = FaceSampler(min_interval=5)
+        sampler.select([(known["MatchedFaces"][0]["Face"]["FaceId"], 1586930698.0, 1.0)])
+        sampled, = sample_faces([face_record], sampler)
+        # the known face is sampled out, the unknown one is now first but keeps the key of the second face
+        self.assertEqual(sampled["FaceSearchResponse"], [unknown])
+        self.assertEqual(lambda_function.face_key(sampled, 0, None), original)
+        self.assertNotEqual(lambda_function.face_key(sampled, 0, None),
+                            lambda_function.face_key(decode_base64_and_load_json(
+                                event["Records"][1]["kinesis"]["data"]), 0, None))
+
+    def test_new_window_keeps_every_candidate(self):
+        event = json.loads(response_json)
+        face_records = [decode_base64_and_load_json(r["kinesis"]["data"]) for r in event["Records"]]
+        # the photo is chosen once the quality gate has seen the frames
+        self.assertEqual(len(sample_faces(face_records, FaceSampler(min_interval=5))), 2)
+
+    def test_best_face_rejected_by_the_gate(self):
+        event = json.loads(response_json)
+        face_records = [decode_base64_and_load_json(r["kinesis"]["data"]) for r in event["Records"]]
+        # the second record has the larger face, but its frame is blurry
+        blurry = np.full((480, 640, 3), 128, dtype=np.uint8)
+        s3_handler = mock.Mock(bucket_name="visitor-images")
+        with mock.patch("lambda_function.ARCHIVE_FRAME", "background"):
+            photos = run_frames(face_records, [camera_frame(), blurry], s3_handler, mock.Mock(),
+                                QualityGate(), FaceSampler(min_interval=5))
+        face_key = lambda_function.face_key(face_records[0], 0, None)
+        self.assertEqual([key for _, key, _ in photos], [face_key])
+        uploaded = [c.args[1] for c in s3_handler.upload_bytes.call_args_list]
+        self.assertEqual(sorted(uploaded), sorted([face_key, lambda_function.frame_key(face_records[0])]))
+
+
+class FaceTrackerTest(unittest.TestCase):
+
+    def setUp(self):
+        event = json.loads(response_json)
+        self.records = [decode_base64_and_load_json(r["kinesis"]["data"]) for r in event["Records"]]
+        for record in self.records:
+            record["FaceSearchResponse"][0]["MatchedFaces"] = []
+
+    def moved(self, record, dx, offset):
+        # the record with its face dx to the right, offset seconds later
+        record = json.loads(json.dumps(record))
+        record["InputInformation"]["KinesisVideo"]["FrameOffsetInSeconds"] += offset
+        detected_face = record["FaceSearchResponse"][0]["DetectedFace"]
+        detected_face["BoundingBox"]["Left"] += dx
+        for landmark in detected_face["Landmarks"]:
+            landmark["X"] += dx
+        return record
+
+    def test_iou(self):
+        boxes = np.array([[0, 0, 1, 1], [0.5, 0, 1, 1]])
+        np.testing.assert_allclose(iou(boxes, boxes[:1]), [[1], [1 / 3]])
+        np.testing.assert_allclose(iou(boxes[:1], np.array([[2, 2, 1, 1], [0, 0, 0, 0]])), [[0, 0]])
+
+    def test_faces_followed_across_records(self):
+        tracker = FaceTracker(ttl=2)
+        first, = tracker.update(self.records[0])
+        self.assertIs(tracker.update(self.records[1])[0], first)
+        self.assertIs(tracker.update(self.moved(self.records[1], 0.05, 1))[0], first)
+        # too far to overlap, then back in place after the track expired
+        self.assertIsNot(tracker.update(self.moved(self.records[1], 0.5, 2))[0], first)
+        self.assertIsNot(tracker.update(self.moved(self.records[1], 0.05, 4))[0], first)
+
+    def test_landmarks_tell_overlapping_faces_apart(self):
+        tracker = FaceTracker(ttl=2)
+        first, = tracker.update(self.records[0])
+        other = self.moved(self.records[1], 0, 0)
+        for landmark in other["FaceSearchResponse"][0]["DetectedFace"]["Landmarks"]:
+            landmark["Y"] -= 0.2
+        self.assertIsNot(tracker.update(other)[0], first)
+
+    def test_streams_tracked_apart(self):
+        tracker = FaceTracker(ttl=2)
+        first, = tracker.update(self.records[0])
+        other = self.moved(self.records[1], 0, 0)
+        other["InputInformation"]["KinesisVideo"]["StreamArn"] += "-other"
+        self.assertIsNot(tracker.update(other)[0], first)
+
+    def test_one_index_per_track(self):
+        reko_client = FakeClient("rekognition")
+        with mock.patch("boto3.client", return_value=reko_client):
+            reko_handler = RekoHanlder("Faces", "FaceDetect")
+        s3_handler = mock.Mock(bucket_name="visitor-images")
+        frame = np.zeros((48, 64, 3), dtype=np.uint8)
+        with mock.patch("lambda_function.ARCHIVE_FRAME", "off"):
+            photos = run_frames(self.records, [frame, frame], s3_handler, reko_handler, tracker=FaceTracker(ttl=2))
+        self.assertEqual(reko_client.calls, ["index_faces"])
+        self.assertEqual(len({face_id for face_id, _, _ in photos}), 1)
+        self.assertEqual(len(photos), 2)
+
+    def test_lambda_indexes_once_per_track(self):
+        indexed = []
+        for ttl in (0, 2):
+            registry.reset()
+            throttle.reset()
+            aws = FakeAWS()
+            event = kinesis_event(records=5, faces=2, matched=0)
+            with mock.patch("boto3.client", aws.client), mock.patch("lambda_function.TRACK_TTL", ttl), \
+                    mock.patch("builtins.print"):
+                lambda_handler(event, None)
+            indexed.append(sum(c.faces for c in aws.clients))
+            self.assertEqual(aws.uploaded(), 15)
+        self.addCleanup(registry.reset)
+        self.assertEqual(indexed, [10, 2])
+
+    def test_matched_face_names_its_track(self):
+        matched = json.loads(response_json)
+        matched = decode_base64_and_load_json(matched["Records"][1]["kinesis"]["data"])
+        reko_handler = mock.Mock()
+        frame = np.zeros((48, 64, 3), dtype=np.uint8)
+        with mock.patch("lambda_function.ARCHIVE_FRAME", "off"), mock.patch("lambda_function.MIN_INTERVAL", 0):
+            photos = run_frames([self.records[0], matched], [frame, frame], mock.Mock(bucket_name="visitor-images"),
+                                reko_handler, tracker=FaceTracker(ttl=2))
+        face_id = matched["FaceSearchResponse"][0]["MatchedFaces"][0]["Face"]["FaceId"]
+        # the unmatched face of the first frame takes the FaceId of the match that follows it
+        self.assertEqual([p[0] for p in photos], [face_id, face_id])
+        self.assertEqual(reko_handler.index_faces.call_count, 0)
+
+
+class PipelineTest(unittest.TestCase):
+
+    def test_stage_backpressure(self):
+        release = threading.Event()
+        stage = Stage("test", workers=1, backlog=1)
+        stage.submit(release.wait)
+        stage.submit(release.wait)
+        blocked = threading.Thread(target=stage.submit, args=(release.wait,))
+        blocked.start()
+        blocked.join(0.1)
+        # a third task does not fit in one running and one queued
+        self.assertTrue(blocked.is_alive())
+        release.set()
+        blocked.join(1)
+        self.assertFalse(blocked.is_alive())
+        stage.shutdown()
+
+    def test_photos_in_record_order(self):
+        event = json.loads(response_json)
+        face_records = [decode_base64_and_load_json(r["kinesis"]["data"]) for r in event["Records"]]
+        records = []
+        for fragment in range(6):
+            for record in face_records:
+                record = json.loads(json.dumps(record))
+                record["InputInformation"]["KinesisVideo"]["FragmentNumber"] = str(fragment)
+                record["FaceSearchResponse"] *= 3
+                records.append(record)
+        groups = lambda_function.group_by_fragment(records)
+
+        s3_handler = mock.Mock(bucket_name="visitor-images")
+        s3_handler.upload_bytes.side_effect = lambda *args, **kwargs: time.sleep(random.uniform(0, 0.005))
+        frame = np.zeros((48, 64, 3), dtype=np.uint8)
+        with mock.patch("lambda_function.fetch_fragment", side_effect=lambda arn, rs: [frame] * len(rs)), \
+                mock.patch("lambda_function.ARCHIVE_FRAME", "background"):
+            with Pipeline(media=2, faces=3, upload=4) as pipeline:
+                photos, failed = lambda_function.run_pipeline(pipeline, groups, s3_handler, mock.Mock())
+
+        expected = [lambda_function.face_key(r, i, None) for r in records for i in range(3)]
+        self.assertEqual([key for _, key, _ in photos], expected)
+        self.assertEqual(s3_handler.upload_bytes.call_count, len(records) * 4)
+
+
+class ExtractFacesTest(unittest.TestCase):
+
+    def test_clamped_on_every_side(self):
+        image = np.arange(100 * 200).reshape(100, 200)
+        boxes = kv_media_handler.box_array([
+            {"Left": 0.25, "Top": 0.25, "Width": 0.5, "Height": 0.5},
+            {"Left": 0.9, "Top": 0.8, "Width": 0.2, "Height": 0.4},
+            {"Left": -0.1, "Top": -0.1, "Width": 0.2, "Height": 0.2},
+            {"Left": 1.5, "Top": 0.1, "Width": 0.1, "Height": 0.1},
+        ])
+        regions = kv_media_handler.face_regions(boxes, image.shape, box_ratio=2)
+        self.assertEqual(regions.tolist(), [[0, 100, 0, 200], [60, 100, 160, 200], [0, 20, 0, 40], [5, 25, 200, 200]])
+
+        crops = kv_media_handler.extract_faces(image, boxes, box_ratio=2)
+        self.assertEqual(crops[1].shape, (40, 40))
+        self.assertIsNone(crops[3])
+        # views of the frame, no copy
+        self.assertTrue(np.shares_memory(crops[0], image))
+
+    def test_thumbnails(self):
+        image = np.zeros((100, 200, 3), dtype=np.uint8)
+        boxes = kv_media_handler.box_array([{"Left": 0.1, "Top": 0.1, "Width": 0.3, "Height": 0.5},
+                                            {"Left": 0.9, "Top": 0.9, "Width": 0.3, "Height": 0.3}])
+        crops = kv_media_handler.extract_faces(image, boxes, size=(32, 48))
+        self.assertEqual([c.shape for c in crops], [(48, 32, 3), (48, 32, 3)])
+
+
+class QualityGateTest(unittest.TestCase):
+
+    def test_rejections(self):
+        gate = QualityGate(min_size=40, min_brightness=40, max_brightness=220, min_sharpness=20)
+        sharp = camera_frame()[:100, :100]
+        blurry = cv2.GaussianBlur(sharp, (31, 31), 10)
+        self.assertTrue(gate.accept(sharp, 100))
+        self.assertFalse(gate.accept(sharp, 30))
+        self.assertFalse(gate.accept(np.full((100, 100, 3), 10, dtype=np.uint8), 100))
+        self.assertFalse(gate.accept(np.full((100, 100, 3), 250, dtype=np.uint8), 100))
+        self.assertFalse(gate.accept(blurry, 100))
+        self.assertEqual(gate.stats(), {"accepted": 1, "too_small": 1, "too_dark": 1, "too_bright": 1,
+                                        "too_blurry": 1})
+
+        # 0 turns a check off, as with the environment variables
+        gate = QualityGate(min_size=0, min_brightness=0, max_brightness=0, min_sharpness=0)
+        self.assertTrue(gate.accept(np.full((100, 100, 3), 250, dtype=np.uint8), 100))
+        self.assertTrue(gate.accept(np.full((100, 100, 3), 10, dtype=np.uint8), 10))
+        self.assertTrue(gate.accept(blurry, 100))
+
+    def test_rejected_faces_skip_aws(self):
+        face_recognition_record = decode_base64_and_load_json(json.loads(response_json)["Records"][0]["kinesis"]["data"])
+        face_recognition_record["FaceSearchResponse"][0]["MatchedFaces"] = []
+        s3_handler, reko_handler = mock.Mock(), mock.Mock()
+        dark = np.full((480, 640, 3), 5, dtype=np.uint8)
+        self.assertEqual(run_frames([face_recognition_record], [dark], s3_handler, reko_handler, QualityGate()), [])
+        self.assertEqual(s3_handler.mock_calls + reko_handler.mock_calls, [])
+
+
+class MetricsTest(unittest.TestCase):
+
+    def test_emf(self):
+        metrics = Metrics()
+        with metrics.timer("S3Put"):
+            pass
+        metrics.count("S3Bytes", 2048, "Bytes")
+        metrics.count("S3Bytes", 1024, "Bytes")
+        record = json.loads(metrics.emf("FaceDetection", {"Function": "local"}))
+        self.assertEqual(record["Function"], "local")
+        self.assertEqual(record["S3Bytes"], 3072)
+        self.assertEqual(record["S3PutCalls"], 1)
+        self.assertEqual(len(record["S3Put"]), 1)
+        definition = record["_aws"]["CloudWatchMetrics"][0]
+        self.assertEqual(definition["Dimensions"], [["Function"]])
+        self.assertIn({"Name": "S3Put", "Unit": "Milliseconds"}, definition["Metrics"])
+
+        metrics.reset()
+        self.assertEqual(metrics.snapshot(), {})
+
+    def test_invocation_prints_metrics(self):
+        with mock.patch("builtins.print") as printed:
+            self.assertEqual(lambda_handler({"Records": []}, None), {'statusCode': 200, 'batchItemFailures': []})
+        record = json.loads(printed.call_args[0][0])
+        self.assertEqual(record["Records"], 0)
+        self.assertIn("Invocation", record)
+
+
+def throttling(code="ThrottlingException"):
+    return ClientError({"Error": {"Code": code, "Message": code}}, "IndexFaces")
+
+
+class ThrottleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock(self)
+
+    def test_retries_throttling(self):
+        function = mock.Mock(side_effect=[throttling(), throttling("ProvisionedThroughputExceededException"), "ok"])
+        self.assertEqual(throttle.call("rekognition", "IndexFaces", function, Image="a"), "ok")
+        self.assertEqual(function.call_count, 3)
+        function.assert_called_with(Image="a")
+        counters = metrics.snapshot()
+        self.assertEqual(counters["Throttles"], 2)
+        self.assertEqual(counters["IndexFacesThrottles"], 2)
+        self.assertEqual(counters["Retries"], 2)
+
+    def test_other_errors_are_not_retried(self):
+        function = mock.Mock(side_effect=throttling("InvalidParameterException"))
+        with self.assertRaises(ClientError):
+            throttle.call("rekognition", "IndexFaces", function)
+        self.assertEqual(function.call_count, 1)
+        function = mock.Mock(side_effect=[throttling("TransactionConflictException"), "ok"])
+        self.assertEqual(throttle.call("dynamodb", "Write", function, retryable={"TransactionConflictException"}), "ok")
+
+    def test_throttling_halves_the_rate(self):
+        bucket = throttle.limiter("rekognition", "IndexFaces")
+        self.assertEqual(bucket.rate, 5)
+        function = mock.Mock(side_effect=[throttling(), throttling(), "ok"])
+        throttle.call("rekognition", "IndexFaces", function)
+        # the second error comes within 1/rate seconds of the first, the rate is only halved once
+        self.assertEqual(bucket.rate, 2.5 + 5 * throttle.INCREASE)
+        for _ in range(100):
+            bucket.on_success()
+        self.assertEqual(bucket.rate, 5)
+
+    def test_rate_limit_waits(self):
+        function = mock.Mock(return_value="ok")
+        for _ in range(15):
+            throttle.call("rekognition", "SearchFacesByImage", function)
+        # a burst of 5, then one call every 1/5 s
+        self.assertAlmostEqual(sum(self.clock.slept), 2.0)
+        self.assertAlmostEqual(metrics.snapshot()["ThrottleWait"], 2000)
+
+    def test_retry_budget(self):
+        throttle.budget.reset(retries=3)
+        function = mock.Mock(side_effect=throttling())
+        with self.assertRaises(ClientError):
+            throttle.call("s3", "PutObject", function)
+        self.assertEqual(function.call_count, 4)
+        # the budget is shared, the next call fails on its first error
+        with self.assertRaises(ClientError):
+            throttle.call("rekognition", "IndexFaces", function)
+        self.assertEqual(function.call_count, 5)
+
+    def test_deadline(self):
+        throttle.budget.reset(seconds=1)
+        function = mock.Mock(return_value="ok")
+        with self.assertRaises(throttle.DeadlineExceeded):
+            for _ in range(20):
+                throttle.call("rekognition", "IndexFaces", function)
+        # 5 of the burst and the ones fitting in the second left
+        self.assertEqual(function.call_count, 10)
+
+    def test_deadline_never_negative(self):
+        context = mock.Mock(function_name="face", get_remaining_time_in_millis=lambda: 1000)
+        with mock.patch("builtins.print"):
+            lambda_handler({"Records": []}, context)
+        self.assertEqual(throttle.budget.deadline, self.clock.now)
+        # the burst still goes out
+        function = mock.Mock(return_value="ok")
+        for _ in range(5):
+            throttle.call("rekognition", "IndexFaces", function)
+        with self.assertRaises(throttle.DeadlineExceeded):
+            throttle.call("rekognition", "IndexFaces", function)
+
+    def test_timer_leaves_out_the_waits(self):
+        function = mock.Mock(side_effect=[throttling(), "ok"])
+        throttle.call("rekognition", "IndexFaces", function, timer="IndexFaces")
+        counters = metrics.snapshot()
+        # both attempts are timed, the backoff in between is RetryWait
+        self.assertEqual(counters["IndexFacesCalls"], 2)
+        self.assertEqual(len(counters["IndexFaces"]), 2)
+        self.assertIn("RetryWait", counters)
+
+    def test_rate_from_environment(self):
+        with mock.patch.dict(os.environ, {"RATE_KINESIS_VIDEO_MEDIA_GETMEDIA": "20"}):
+            self.assertEqual(throttle.limiter("kinesis-video-media", "GetMedia").rate, 20)
+
+    def test_unprocessed_items_back_off(self):
+        client = FakeDynamoDB(failures=["Unprocessed"] * throttle.MAX_ATTEMPTS)
+        with mock.patch("boto3.client", return_value=client):
+            handler = DynamoHandler("visitors", layout="timeseries")
+        for i in range(2):
+            handler.buffer_image("face-1", "visitor-images", f"{i}.jpg", 1000 + i)
+        with self.assertRaises(RuntimeError):
+            handler.flush()
+        self.assertEqual(client.calls, ["batch_write_item"] * throttle.MAX_ATTEMPTS)
+        self.assertEqual(metrics.snapshot()["WriteThrottles"], throttle.MAX_ATTEMPTS)
+
+
+class KeysTest(unittest.TestCase):
+
+    def test_no_collisions_at_high_rates(self):
+        # 4 cameras at 60 fps for 10 s, producer timestamps and offsets as floats like the stream processor sends
+        stream_arns = ["arn:aws:kinesisvideo:us-east-1:000000000000:stream/camera-%d/1586555054989" % c for c in range(4)]
+        frame_keys, face_keys = set(), set()
+        count = 0
+        for stream_arn in stream_arns:
+            for fragment in range(5):
+                producer_timestamp = 1586930696.336 + fragment * 2.0
+                for frame in range(120):
+                    offset = frame / 60 + 1e-9 * random.random()
+                    frame_keys.add(keys.frame_key(stream_arn, producer_timestamp, offset, ".jpg"))
+                    for i in range(3):
+                        face_keys.add(keys.face_key(stream_arn, producer_timestamp, offset, i, ".jpg"))
+                    count += 1
+        self.assertEqual(len(frame_keys), count)
+        self.assertEqual(len(face_keys), 3 * count)
+        # the writes spread over the hashed prefixes
+        self.assertGreater(len({key.split("/")[0] for key in frame_keys}), 200)
+
+    def test_layout(self):
+        stream_arn = "arn:aws:kinesisvideo:us-east-1:0:stream/macbook-camera/1586555054989"
+        key = keys.face_key(stream_arn, 1586930696.336, 3.000999927520752, 1, ".jpg")
+        partition, stream, name = key.split("/")
+        self.assertEqual((stream, name), ("macbook-camera-1586555054989", "1586930696336_3001_1.jpg"))
+        self.assertEqual(partition, keys.partition(stream + "/1586930696336_3001"))
+        # a frame and its faces share the prefix
+        frame_key = keys.frame_key(stream_arn, 1586930696.336, 3.000999927520752, ".jpg")
+        self.assertEqual(frame_key, partition + "/macbook-camera-1586555054989/1586930696336_3001_frame.jpg")
+
+    def test_content_keys_upload_once(self):
+        client = FakeAWS().client("s3")
+        with mock.patch("boto3.client", return_value=client):
+            s3_handler = S3Handler("visitor-images")
+        key = keys.content_key(b"crop", ".jpg")
+        self.assertEqual(key, keys.content_key(b"crop", ".jpg"))
+        self.assertNotEqual(key, keys.content_key(b"other crop", ".jpg"))
+        self.assertTrue(s3_handler.upload_bytes(b"crop", key, skip_existing=True))
+        self.assertFalse(s3_handler.upload_bytes(b"crop", key, skip_existing=True))
+        # another container finds it with a HEAD request
+        with mock.patch("boto3.client", return_value=client):
+            other = S3Handler("visitor-images")
+        with mock.patch.object(client, "put_object") as put_object:
+            self.assertFalse(other.upload_bytes(b"crop", key, skip_existing=True))
+        put_object.assert_not_called()
+
+    def test_content_mode_records_a_photo_once(self):
+        client = FakeDynamoDB()
+        with mock.patch("boto3.client", return_value=client):
+            handler = DynamoHandler("visitors")
+        key = keys.content_key(b"crop", ".jpg")
+        handler.buffer_image("face-1", "visitor-images", key)
+        handler.buffer_image("face-1", "visitor-images", key)
+        handler.flush()
+        self.assertEqual(client.photo_keys("face-1"), [key])
+
+
+class FakeS3:
+    """A bucket in memory, listed by key like S3 so deleting while listing is safe."""
+
+    def __init__(self, versioning=None, page_size=1000):
+        self.versioning = versioning
+        self.page_size = page_size
+        # (key, version id) -> last modified, None as version id without versioning
+        self.objects = {}
+        self.markers = set()
+        self.failing = set()
+        self.deletes = []
+        self.lock = threading.Lock()
+
+    def put(self, key, age=0, version=None, marker=False):
+        self.objects[(key, version)] = datetime.now(timezone.utc) - timedelta(seconds=age)
+        if marker:
+            self.markers.add((key, version))
+
+    def get_bucket_versioning(self, Bucket):
+        return {"Status": self.versioning} if self.versioning else {}
+
+    def page(self, prefix, after):
+        with self.lock:
+            entries = sorted(e for e in self.objects if e[0].startswith(prefix) and (after is None or e > after))
+        return entries[:self.page_size], len(entries) > self.page_size
+
+    def list_objects_v2(self, Bucket, Prefix, ContinuationToken=None):
+        entries, truncated = self.page(Prefix, (ContinuationToken, None) if ContinuationToken else None)
+        response = {"Contents": [{"Key": k, "LastModified": self.objects[(k, v)]} for k, v in entries],
+                    "IsTruncated": truncated}
+        if truncated:
+            response["NextContinuationToken"] = entries[-1][0]
+        return response
+
+    def list_object_versions(self, Bucket, Prefix, KeyMarker=None, VersionIdMarker=None):
+        entries, truncated = self.page(Prefix, (KeyMarker, VersionIdMarker) if KeyMarker else None)
+        response = {"Versions": [], "DeleteMarkers": [], "IsTruncated": truncated}
+        for k, v in entries:
+            kind = "DeleteMarkers" if (k, v) in self.markers else "Versions"
+            response[kind].append({"Key": k, "VersionId": v, "LastModified": self.objects[(k, v)]})
+        if truncated:
+            response["NextKeyMarker"], response["NextVersionIdMarker"] = entries[-1]
+        return response
+
+    def delete_objects(self, Bucket, Delete):
+        assert len(Delete["Objects"]) <= 1000
+        errors = []
+        with self.lock:
+            self.deletes.append(len(Delete["Objects"]))
+            for o in Delete["Objects"]:
+                if o["Key"] in self.failing:
+                    errors.append({"Key": o["Key"], "Code": "AccessDenied"})
+                else:
+                    del self.objects[(o["Key"], o.get("VersionId"))]
+        return {"Errors": errors} if errors else {}
+
+
+class EmptyBucketTest(unittest.TestCase):
+
+    def make_handler(self, client):
+        throttle.reset()
+        with mock.patch("boto3.client", return_value=client):
+            return S3Handler("visitor-images")
+
+    def test_deletes_in_batches_of_1000(self):
+        s3 = FakeS3(page_size=700)
+        for i in range(2500):
+            s3.put("%04d.jpg" % i)
+        with mock.patch("builtins.print"):
+            self.assertEqual(self.make_handler(s3).empty(workers=3), 2500)
+        self.assertEqual(s3.objects, {})
+        self.assertEqual(sorted(s3.deletes), [500, 1000, 1000])
+
+    def test_versions_and_delete_markers(self):
+        s3 = FakeS3(versioning="Suspended", page_size=3)
+        for i in range(4):
+            s3.put("%d.jpg" % i, version="v1")
+            s3.put("%d.jpg" % i, version="v2")
+        s3.put("gone.jpg", version="v3", marker=True)
+        with mock.patch("builtins.print"):
+            self.assertEqual(self.make_handler(s3).empty(), 9)
+        self.assertEqual(s3.objects, {})
+
+    def test_prefix_and_age(self):
+        s3 = FakeS3()
+        s3.put("a/old.jpg", age=3600)
+        s3.put("a/new.jpg")
+        s3.put("b/old.jpg", age=3600)
+        with mock.patch("builtins.print"):
+            self.assertEqual(self.make_handler(s3).empty(prefix="a/", older_than=600), 1)
+        self.assertEqual(sorted(k for k, _ in s3.objects), ["a/new.jpg", "b/old.jpg"])
+
+    def test_errors_are_raised(self):
+        s3 = FakeS3()
+        for key in ("a.jpg", "b.jpg", "c.jpg"):
+            s3.put(key)
+        s3.failing.add("b.jpg")
+        with mock.patch("builtins.print"), self.assertRaises(RuntimeError) as raised:
+            self.make_handler(s3).empty()
+        self.assertIn("b.jpg", str(raised.exception))
+        self.assertEqual(list(s3.objects), [("b.jpg", None)])
+
+    def test_missing_bucket(self):
+        s3 = mock.Mock()
+        s3.get_bucket_versioning.side_effect = ClientError({"Error": {"Code": "NoSuchBucket"}}, "GetBucketVersioning")
+        with mock.patch("builtins.print"):
+            self.assertEqual(self.make_handler(s3).empty(), 0)
+
+
+class VisitorHistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock(self)
+        self.dynamodb = FakeDynamoDB()
+        s3 = mock.Mock()
+        s3.generate_presigned_url.side_effect = lambda method, Params, ExpiresIn: "https://signed/" + Params["Key"]
+        with mock.patch("boto3.client", side_effect=[self.dynamodb, s3]):
+            self.dynamo_handler = DynamoHandler("visitors")
+            self.s3_handler = S3Handler("visitor-images")
+
+    def test_batched_reads(self):
+        for i in range(250):
+            self.dynamo_handler.buffer_image(f"face-{i}", "visitor-images", f"{i}.jpg")
+        self.dynamo_handler.flush()
+        self.dynamodb.calls.clear()
+        self.dynamodb.failures = ["Unprocessed"]
+        images = self.dynamo_handler.get_images([f"face-{i}" for i in range(250)] + ["unknown"])
+        # 100 keys per request, the unprocessed half of the first one asked again
+        self.assertEqual(self.dynamodb.calls, ["batch_get_item"] * 4)
+        self.assertEqual(len(images), 250)
+        self.assertEqual(images["face-7"], [{"bucket": "visitor-images", "objectKey": "7.jpg"}])
+
+    def test_cached_until_written(self):
+        history = VisitorHistory(self.dynamo_handler, self.s3_handler, ttl=60)
+        self.dynamo_handler.upsert_image("face-1", "visitor-images", "a.jpg")
+        photos = history.photos(["face-1", "face-2"])
+        self.assertEqual(photos["face-1"], [{"bucket": "visitor-images", "objectKey": "a.jpg",
+                                             "url": "https://signed/a.jpg"}])
+        self.assertEqual(photos["face-2"], [])
+        self.assertEqual(history.photos(["face-1", "face-2"]), photos)
+        self.assertEqual(self.dynamodb.calls.count("batch_get_item"), 1)
+
+        # a photo written by the ingest path drops the cached face
+        self.dynamo_handler.buffer_image("face-1", "visitor-images", "b.jpg")
+        self.dynamo_handler.flush()
+        self.assertEqual([p["objectKey"] for p in history.photos(["face-1"])["face-1"]], ["a.jpg", "b.jpg"])
+        self.assertEqual(self.dynamodb.calls.count("batch_get_item"), 2)
+
+    def test_ttl_and_size(self):
+        with mock.patch("handler.history.monotonic", lambda: self.clock.now):
+            history = VisitorHistory(self.dynamo_handler, self.s3_handler, ttl=60, max_size=2)
+            history.photos(["face-1", "face-2"])
+            history.photos(["face-3"])
+            # face-1 was the least recently used
+            history.photos(["face-1"])
+            self.assertEqual(self.dynamodb.calls.count("batch_get_item"), 3)
+            history.photos(["face-3"])
+            self.assertEqual(self.dynamodb.calls.count("batch_get_item"), 3)
+            self.clock.now += 61
+            history.photos(["face-3"])
+            self.assertEqual(self.dynamodb.calls.count("batch_get_item"), 4)
+
+
+class ConfigTest(unittest.TestCase):
+
+    def tearDown(self):
+        load_env.cache_clear()
+
+    def test_environment_overrides_file(self):
+        load_env.cache_clear()
+        with mock.patch.dict("os.environ", {"AWS_ENV_FILE": "/nonexistent.yaml", "AWS_DEFAULT_REGION": "eu-west-1",
+                                            "ARN_KVS": "arn:kvs"}):
+            env = load_env()
+            self.assertEqual(env["aws_default_region"], "eu-west-1")
+            self.assertEqual(env["arn_kvs"], "arn:kvs")
+            # parsed once
+            self.assertIs(load_env(), env)
+
+    def test_lazy_module(self):
+        module = LazyModule("colorsys")
+        self.assertIsNone(module.module)
+        self.assertEqual(module.rgb_to_hsv(0, 0, 0), (0, 0, 0))
+        self.assertIsNotNone(module.module)
+
+
+class OfflineBenchmarkTest(unittest.TestCase):
+
+    def setUp(self):
+        registry.reset()
+        throttle.reset()
+        kv_media_handler.reset_endpoints()
+        kv_media_handler.fragment_cache.clear()
+
+    tearDown = setUp
+
+    def test_lambda_against_fakes(self):
+        aws = FakeAWS()
+        event = kinesis_event(records=3, faces=2, fragments=2, matched=0.5)
+        with mock.patch("boto3.client", aws.client), mock.patch("lambda_function.MIN_INTERVAL", 0), \
+                mock.patch("builtins.print"):
+            lambda_handler(event, None)
+        # two faces and the frame of every record
+        self.assertEqual(aws.uploaded(), 9)
+        media = [c for c in aws.clients if c.service == "kinesis-video-media"]
+        self.assertEqual(len(media), 1)
+
+    def test_batch_larger_than_max_records(self):
+        aws = FakeAWS()
+        event = kinesis_event(records=7, faces=1, fragments=3, matched=1.0)
+        with mock.patch("boto3.client", aws.client), mock.patch("lambda_function.MIN_INTERVAL", 0), \
+                mock.patch("lambda_function.MAX_RECORDS", 3), \
+                mock.patch("lambda_function.process_records", wraps=lambda_function.process_records) as passes, \
+                mock.patch("builtins.print"):
+            lambda_handler(event, None)
+        # nothing is dropped, the records go through in passes of MAX_RECORDS
+        self.assertEqual([len(c.args[0]) for c in passes.call_args_list], [3, 3, 1])
+        self.assertEqual(aws.uploaded(), 14)
+        self.assertEqual(aws.written(), 7)
+
+    def test_records_grouped_by_fragment(self):
+        event = kinesis_event(records=6, faces=1, fragments=2)
+        face_records = [record for _, record in lambda_function.decode_records(event)]
+        groups = lambda_function.group_by_fragment(face_records)
+        self.assertEqual(len(groups), 2)
+        # arrival order is kept inside a fragment
+        for records in groups.values():
+            offsets = [r["InputInformation"]["KinesisVideo"]["FrameOffsetInSeconds"] for r in records]
+            self.assertEqual(offsets, sorted(offsets))
+        self.assertEqual(sum(len(records) for records in groups.values()), 6)
+
+
+class PartialBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        registry.reset()
+        throttle.reset()
+        kv_media_handler.reset_endpoints()
+        kv_media_handler.fragment_cache.clear()
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.aws = FakeAWS()
+        self.event = kinesis_event(records=5, faces=1, fragments=1, matched=1.0)
+        self.sequence_numbers = [r["kinesis"]["sequenceNumber"] for r in self.event["Records"]]
+        for patcher in (mock.patch("boto3.client", self.aws.client), mock.patch("lambda_function.MIN_INTERVAL", 0),
+                        mock.patch("lambda_function.DEAD_LETTER_DIR", self.directory.name),
+                        mock.patch("builtins.print")):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(registry.reset)
+
+    def failing(self, broken):
+        # identify_face raising for the records at the `broken` indexes of the event
+        offsets = [json.loads(base64.b64decode(self.event["Records"][i]["kinesis"]["data"]))
+                   ["InputInformation"]["KinesisVideo"]["FrameOffsetInSeconds"] for i in broken]
+        identify_face = lambda_function.identify_face
+
+        def identify(face_recognition_record, *args):
+            if face_recognition_record["InputInformation"]["KinesisVideo"]["FrameOffsetInSeconds"] in offsets:
+                raise RuntimeError("broken record")
+            return identify_face(face_recognition_record, *args)
+        return mock.patch("lambda_function.identify_face", identify)
+
+    def test_first_failed_record_reported(self):
+        with self.failing([3, 1]):
+            response = lambda_handler(self.event, None)
+        self.assertEqual(response["batchItemFailures"], [{"itemIdentifier": self.sequence_numbers[1]}])
+        # every frame is archived, the faces of the failed records are not
+        self.assertEqual(self.aws.uploaded(), 8)
+        self.assertEqual(self.aws.written(), 3)
+
+    def test_poison_record_goes_to_dead_letters(self):
+        with self.failing([2]):
+            responses = [lambda_handler(self.event, None) for _ in range(3)]
+        failure = [{"itemIdentifier": self.sequence_numbers[2]}]
+        self.assertEqual([r["batchItemFailures"] for r in responses], [failure, failure, []])
+        dead = DeadLetters(self.directory.name).read()
+        self.assertEqual([(d["sequenceNumber"], d["attempts"]) for d in dead], [(self.sequence_numbers[2], 3)])
+        self.assertIn("broken record", dead[0]["error"])
+
+    def test_undecodable_record(self):
+        self.event["Records"][0]["kinesis"]["data"] = base64.b64encode(b"not json").decode()
+        self.assertEqual(lambda_handler(self.event, None)["batchItemFailures"], [])
+        self.assertEqual(self.aws.written(), 4)
+        self.assertEqual(len(DeadLetters(self.directory.name).read()), 1)
+
+    def test_out_of_time(self):
+        context = mock.Mock(function_name="f", get_remaining_time_in_millis=lambda: 1000)
+        response = lambda_handler(self.event, context)
+        self.assertEqual(response["batchItemFailures"], [{"itemIdentifier": self.sequence_numbers[0]}])
+        self.assertEqual(self.aws.uploaded(), 0)
+
+    def test_failed_write_fails_the_pass(self):
+        flush = DynamoHandler.flush
+
+        def failing(handler):
+            # the first flush takes the buffer and fails
+            failing.calls += 1
+            if failing.calls == 1:
+                handler.buffer = {}
+                raise RuntimeError("table gone")
+            return flush(handler)
+        failing.calls = 0
+
+        face_ids = {decode_base64_and_load_json(r["kinesis"]["data"])["FaceSearchResponse"][0]["MatchedFaces"][0]
+                    ["Face"]["FaceId"] for r in self.event["Records"]}
+        with mock.patch.object(DynamoHandler, "flush", failing), mock.patch("lambda_function.MIN_INTERVAL", 5):
+            response = lambda_handler(self.event, None)
+            self.assertEqual(response["batchItemFailures"], [{"itemIdentifier": self.sequence_numbers[0]}])
+            self.assertEqual(self.aws.written(), 0)
+            # the windows of the failed pass are open again, every face gets its photo recorded
+            self.assertEqual(lambda_handler(self.event, None)["batchItemFailures"], [])
+        self.assertEqual(self.aws.written(), len(face_ids))
+
+
+class ReplayTest(unittest.TestCase):
+
+    def test_capture_round_trip(self):
+        with mock.patch("builtins.open", mock.mock_open(read_data=response_json)):
+            entries = list(capture_event("event.json"))
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "records.jsonl.gz")
+            write_capture(path, entries)
+            self.assertEqual(read_capture(path), [list(entry) for entry in entries])
+        self.assertEqual(len(entries), 2)
+
+    def test_replay_batches(self):
+        entries = [[i * 0.01, {"record": i}] for i in range(50)]
+        batches = []
+        replayer = Replayer(lambda event, context: batches.append(len(event["Records"])), speed=10,
+                            parallel=2, batch_size=20, batch_window=0.05, sample_every=0.01)
+        report = replayer.run(entries)
+        self.assertEqual(sum(batches), 50)
+        self.assertTrue(all(size <= 20 for size in batches))
+        self.assertEqual(report["failed_records"], 0)
+        self.assertEqual(report["records"], 50)
+
+    def test_replay_counts_reported_failures(self):
+        entries = [[i * 0.01, {"record": i}] for i in range(10)]
+
+        def handler(event, context):
+            # the third record of every batch fails
+            sequence_numbers = [r["kinesis"]["sequenceNumber"] for r in event["Records"]]
+            self.assertEqual(len(set(sequence_numbers)), len(sequence_numbers))
+            return {"batchItemFailures": [{"itemIdentifier": sequence_numbers[2]}]}
+        replayer = Replayer(handler, speed=100, batch_size=5, batch_window=1, sample_every=0.01)
+        with mock.patch("sys.stderr"):
+            report = replayer.run(entries)
+        self.assertEqual(report["failed_records"], 6)
+
+
+class FakeKinesis:
+    """One shard of records, served by SubscribeToShard and by shard iterators."""
+
+    def __init__(self, records, per_event=2):
+        self.records = [{"SequenceNumber": str(100 + i), "Data": json.dumps(r).encode()} for i, r in enumerate(records)]
+        self.per_event = per_event
+        self.positions = []
+
+    def remaining(self, position):
+        self.positions.append(position)
+        if position["Type"] == "AFTER_SEQUENCE_NUMBER":
+            return [r for r in self.records if int(r["SequenceNumber"]) > int(position["SequenceNumber"])]
+        return list(self.records)
+
+    def subscribe_to_shard(self, ConsumerARN, ShardId, StartingPosition):
+        records = self.remaining(StartingPosition)
+        events = []
+        for start in range(0, len(records), self.per_event):
+            chunk = records[start:start + self.per_event]
+            events.append({"SubscribeToShardEvent": {"Records": chunk,
+                                                     "ContinuationSequenceNumber": chunk[-1]["SequenceNumber"]}})
+        # the shard is closed once every record has been sent
+        events.append({"SubscribeToShardEvent": {"Records": [], "ChildShards": []}})
+        return {"EventStream": events}
+
+    def get_shard_iterator(self, StreamName, ShardId, ShardIteratorType, StartingSequenceNumber=None):
+        position = {"Type": ShardIteratorType, "SequenceNumber": StartingSequenceNumber}
+        return {"ShardIterator": self.remaining(position)}
+
+    def get_records(self, ShardIterator, Limit):
+        records, rest = ShardIterator[:self.per_event], ShardIterator[self.per_event:]
+        return {"Records": records, "NextShardIterator": rest or None, "MillisBehindLatest": 0}
+
+
+class ConsumerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.checkpoints = FileCheckpoints(self.directory.name)
+        record = decode_base64_and_load_json(json.loads(response_json)["Records"][0]["kinesis"]["data"])
+        self.kinesis = FakeKinesis([record] * 5)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def consume(self, consumer_arn="arn:consumer", process=None):
+        with mock.patch("boto3.client", return_value=self.kinesis):
+            kds_handler = KDSHandler("face-stream")
+        with mock.patch("lambda_function.process_records", process or mock.Mock(return_value=[])) as processed, \
+                mock.patch("consumer.sleep"), mock.patch("builtins.print"):
+            consumer.consume_shard(kds_handler, consumer_arn, "shardId-0", self.checkpoints,
+                                   dead_letters=DeadLetters(self.directory.name + "/dead-letters"))
+        return processed
+
+    def test_fan_out_to_shard_end(self):
+        processed = self.consume()
+        self.assertEqual([len(call.args[0]) for call in processed.call_args_list], [2, 2, 1])
+        self.assertEqual(self.checkpoints.get("shardId-0"), SHARD_END)
+        # a closed shard is not read again
+        self.assertEqual(self.consume().call_count, 0)
+
+    def test_resume_after_failure(self):
+        failing = mock.Mock(side_effect=[[], RuntimeError("throttled")])
+        with self.assertRaises(RuntimeError):
+            self.consume(process=failing)
+        self.assertEqual(self.checkpoints.get("shardId-0"), "101")
+
+        processed = self.consume()
+        self.assertEqual(self.kinesis.positions[-1], {"Type": "AFTER_SEQUENCE_NUMBER", "SequenceNumber": "101"})
+        self.assertEqual(sum(len(call.args[0]) for call in processed.call_args_list), 3)
+
+    def test_failed_record_read_again(self):
+        def process(face_records):
+            # the second record of the first batch fails once
+            if len(face_records) == 2 and process.calls == 0:
+                process.calls += 1
+                return [(face_records[1], RuntimeError("throttled"))]
+            return []
+        process.calls = 0
+        processed = self.consume(process=mock.Mock(side_effect=process))
+        self.assertEqual([len(call.args[0]) for call in processed.call_args_list], [2, 1, 2, 1])
+        self.assertEqual(self.checkpoints.get("shardId-0"), SHARD_END)
+
+    def test_polling(self):
+        processed = self.consume(consumer_arn=None)
+        self.assertEqual(sum(len(call.args[0]) for call in processed.call_args_list), 5)
+        self.assertEqual(self.checkpoints.get("shardId-0"), SHARD_END)
+
+    def test_children_wait_for_parent(self):
+        shards = [{"ShardId": "parent"}, {"ShardId": "child", "ParentShardId": "parent"}]
+        self.assertEqual(consumer.ready_shards(shards, self.checkpoints), ["parent"])
+        self.checkpoints.put("parent", SHARD_END)
+        self.assertEqual(consumer.ready_shards(shards, self.checkpoints), ["child"])
+
+
+class StepGraphTest(unittest.TestCase):
+
+    def test_independent_steps_overlap(self):
+        graph = StepGraph()
+        started = []
+        for name in ["a", "b", "c"]:
+            graph.add(name, lambda name=name: (started.append(name), time.sleep(0.1)))
+        graph.add("d", lambda: started.append("d"), after=["a", "b", "c"])
+        start = time.perf_counter()
+        results = graph.run()
+        self.assertLess(time.perf_counter() - start, 0.25)
+        self.assertEqual(started[-1], "d")
+        self.assertEqual(list(results)[-1], "d")
+        self.assertTrue(all(status == "done" for status, _ in results.values()))
+
+    def test_failure_skips_dependents(self):
+        graph = StepGraph()
+        graph.add("broken", mock.Mock(side_effect=RuntimeError("boom")))
+        graph.add("after broken", mock.Mock(), after=["broken"])
+        graph.add("later", mock.Mock(), after=["after broken"])
+        other = graph.add("other", mock.Mock())
+        with self.assertRaises(StepError) as raised:
+            graph.run()
+        results = raised.exception.results
+        self.assertEqual(results["broken"][0], "failed")
+        self.assertEqual(results["after broken"], ("skipped", None))
+        self.assertEqual(results["later"], ("skipped", None))
+        self.assertEqual(results[other][0], "done")
+
+    def test_unknown_dependency(self):
+        with self.assertRaises(ValueError):
+            StepGraph().add("a", mock.Mock(), after=["b"])
+
+    def test_wait_until_backs_off_and_times_out(self):
+        now = [0.0]
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            now[0] += seconds
+
+        with self.assertRaises(TimeoutError):
+            wait_until(lambda: False, "never", timeout=20, sleep=sleep, clock=lambda: now[0])
+        self.assertEqual(sleeps, [1, 2, 4, 8, 5])
+        self.assertEqual(wait_until(iter([None, None, "ready"]).__next__, "ready", sleep=lambda s: None), "ready")
+
+
+class FakeStack:
+    """Stub of every client the lifecycle uses; resources get ready on the second describe call."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = []
+        self.resources = {}
+
+    def __getattr__(self, name):
+        if name.startswith(("create_", "delete_", "start_", "stop_", "register_")):
+            return lambda **kwargs: self.act(name, kwargs)
+        raise AttributeError(name)
+
+    def act(self, name, kwargs):
+        with self.lock:
+            self.calls.append(name)
+            kind = name.split("_", 1)[1]
+            if name.startswith(("create_", "register_")):
+                self.resources[kind] = ["CREATING", "CREATING", "ACTIVE"]
+            elif name == "start_stream_processor":
+                self.resources["stream_processor"] = ["STARTING", "RUNNING"]
+            elif name == "stop_stream_processor":
+                self.resources["stream_processor"] = ["STOPPING", "STOPPED"]
+            else:
+                self.resources[kind] = ["DELETING", None]
+        if name == "create_stream":
+            return {"StreamARN": "arn:stream"}
+        if name == "create_bucket":
+            return {"Location": "/bucket"}
+        if name == "delete_collection":
+            return {"StatusCode": 200}
+        return {}
+
+    def status(self, kind):
+        with self.lock:
+            states = self.resources.get(kind, [None])
+            if len(states) > 1:
+                return states.pop(0)
+            return states[0]
+
+    def raise_not_found(self, operation):
+        raise ClientError({"Error": {"Code": "ResourceNotFoundException", "Message": "gone"}}, operation)
+
+    def describe_stream(self, StreamName, **kwargs):
+        status = self.status("stream")
+        if status is None:
+            self.raise_not_found("DescribeStream")
+        return {"StreamInfo": {"Status": status, "StreamARN": "arn:stream"},
+                "StreamDescription": {"StreamStatus": status, "StreamARN": "arn:stream"}}
+
+    def describe_stream_consumer(self, **kwargs):
+        status = self.status("stream_consumer")
+        if status is None:
+            self.raise_not_found("DescribeStreamConsumer")
+        return {"ConsumerDescription": {"ConsumerStatus": status, "ConsumerARN": "arn:consumer"}}
+
+    def describe_stream_processor(self, Name):
+        status = self.status("stream_processor")
+        if status is None:
+            self.raise_not_found("DescribeStreamProcessor")
+        return {"Status": "STOPPED" if status == "ACTIVE" else status}
+
+    def describe_table(self, TableName):
+        status = self.status("table")
+        if status is None:
+            self.raise_not_found("DescribeTable")
+        return {"Table": {"TableStatus": status}}
+
+    def head_bucket(self, Bucket):
+        if self.status("bucket") != "ACTIVE":
+            raise ClientError({"Error": {"Code": "404", "Message": "Not Found"}}, "HeadBucket")
+
+
+class LifeCycleTest(unittest.TestCase):
+
+    def make_controller(self, stack):
+        with mock.patch("boto3.client", return_value=stack):
+            return lifecycle.LifeCycleController(timeout=5)
+
+    def test_create_in_dependency_order(self):
+        stack = FakeStack()
+        controller = self.make_controller(stack)
+        with mock.patch("steps.time.sleep"), mock.patch("builtins.print"):
+            results = controller.create()
+        self.assertTrue(all(status == "done" for status, _ in results.values()))
+        calls = stack.calls
+        self.assertLess(calls.index("create_collection"), calls.index("create_stream_processor"))
+        self.assertLess(calls.index("create_stream_processor"), calls.index("start_stream_processor"))
+        self.assertIn("register_stream_consumer", calls)
+        self.assertEqual(calls.count("create_stream"), 2)
+
+    def test_delete_waits_for_the_stream_processor(self):
+        stack = FakeStack()
+        stack.resources["stream_processor"] = ["RUNNING"]
+        controller = self.make_controller(stack)
+        with mock.patch("steps.time.sleep"), mock.patch("builtins.print"), \
+                mock.patch("handler.s3_handler.S3Handler.empty"):
+            results = controller.delete()
+        calls = stack.calls
+        self.assertLess(calls.index("stop_stream_processor"), calls.index("delete_stream_processor"))
+        self.assertLess(calls.index("delete_stream_processor"), calls.index("delete_stream"))
+        self.assertEqual(results["stream processor deleted"][0], "done")
+
+    def test_timeout_is_reported(self):
+        stack = FakeStack()
+        stack.describe_table = lambda TableName: {"Table": {"TableStatus": "CREATING"}}
+        controller = self.make_controller(stack)
+        controller.timeout = 0
+        with mock.patch("builtins.print"), self.assertRaises(StepError) as raised:
+            controller.create()
+        self.assertIsInstance(raised.exception.failed["table active"], TimeoutError)
@@ -1,8 +1,58 @@
-import yaml
+import importlib
+import os
+import threading
+from functools import lru_cache
+
+# looked up next to this file, not in the working directory
+ENV_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "aws_env.yaml")
 
 
 def yaml_handler(dir_):
+    import yaml
+
     with open(dir_) as file:
         # The FullLoader parameter handles the conversion from YAML
         # scalar values to Python the dictionary format
         return yaml.load(file, Loader=yaml.FullLoader)
+
+
+@lru_cache(maxsize=None)
+def load_env():
+    # parsed once per process; every key can be set by its upper case environment variable,
+    # e.g. ARN_KVS, so a deployment can run without the YAML file at all
+    path = os.environ.get("AWS_ENV_FILE", ENV_FILE)
+    env = dict(yaml_handler(path) or {}) if os.path.exists(path) else {}
+    for key in set(env) | {"aws_default_region", "arn_recognition", "arn_kvs"}:
+        value = os.environ.get(key.upper())
+        if value:
+            env[key] = value
+    return env
+
+
+def aws_client(service, **kwargs):
+    # boto3 takes a few hundred milliseconds to import, only pay for it when a client is needed
+    import boto3
+
+    return boto3.client(service, region_name=load_env()['aws_default_region'], **kwargs)
+
+
+def not_found(error):
+    # the error of a describe call on a resource that does not exist (anymore)
+    code = error.response.get("Error", {}).get("Code")
+    return code in ("ResourceNotFoundException", "NoSuchBucket", "NotFound", "404")
+
+
+class LazyModule:
+    """Imports the module on first attribute access, e.g. cv2 = LazyModule("cv2")."""
+
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+        self.lock = threading.Lock()
+
+    def __getattr__(self, attr):
+        if self.module is None:
+            with self.lock:
+                if self.module is None:
+                    self.module = importlib.import_module(self.name)
+        return getattr(self.module, attr)